@@ -1,27 +1,89 @@
 ## IMPORTS
 
 import os
+import io
+import hmac
+import hashlib
+import tempfile
+import functools
 from datetime import datetime
 
-from sklearn.metrics import roc_auc_score
-from sklearn.metrics import confusion_matrix
+import flask
+import pandas as pd
 import dash
+from dash.exceptions import PreventUpdate
 
-from layout import create_layout
+from layout import (
+    create_layout,
+    dropdown_options,
+    counted_dropdown_options,
+    subgroup_table_columns,
+    drift_table_columns,
+    drift_table_styles,
+    drift_alert_list,
+    calibration_table_columns,
+    calibration_summary,
+    default_reference_months,
+    background_progress,
+    CUTOFF_STEP,
+    DEFAULT_CUTOFF,
+    DEFAULT_SHAP_RANKING,
+    DEFAULT_SHAP_DIMENSION,
+    DEFAULT_GRANULARITY,
+    DEFAULT_WINDOW,
+    SHAP_TOP_K_OPTIONS
+)
 from helpers import (
     create_dash_app,
     load_data,
+    load_cube,
+    load_filter_index,
+    appendable_cache,
+    read_batch,
     prepare_data,
-    create_filter_options,
-    calculate_average_shap_values,
-    filter_df,
-    calculate_metrics,
-    create_records_figure,
-    create_complications_figure,
-    create_auroc_figure,
-    create_timeline_figure,
-    create_shap_barplot,
-    create_confusion_matrix
+    calculate_grouped_auroc,
+    calculate_confusion_counts,
+    calculate_grouped_confusion_counts,
+    calculate_grouped_score_hist,
+    calculate_subgroup_metrics,
+    suppress_small_cells,
+    sort_subgroups,
+    create_threshold_summary,
+    create_static_figures,
+    patch_records_figure,
+    patch_complications_figure,
+    patch_auroc_figure,
+    patch_shap_barplot,
+    patch_shap_distribution_figure,
+    patch_shap_subgroup_figure,
+    patch_calibration_figure
+)
+from filter_index import query_filter_index
+from columnar import source_key
+from cache import create_result_cache
+from instrumentation import REGISTRY, CallbackProfiler, instrument_callback, stage_timer, timed, count_rows
+from data_store import DataStore
+from data_source import PandasSource, SQLiteSource, is_sqlite_path
+from bootstrap import bootstrap_intervals
+from drift import cube_drift, drift_alerts
+from calibration import cube_calibration, cube_calibration_by, CALIBRATION_METRICS
+from warmup import CacheWarmer, BackgroundTasks, single_dimension_selections
+from timeseries import timeframe_days, daily_score_hist, prefix_sums, period_hist
+from explainability import shap_ranking, sample_positions, shap_distributions, subgroup_shap_means
+from cube import (
+    build_cube,
+    select_cells,
+    cube_filter_counts,
+    cube_summary_metrics,
+    cube_auroc_error_bound,
+    auroc_from_hist,
+    confusion_counts_from_hist,
+    cube_monthly_auroc,
+    cube_confusion_counts,
+    cube_monthly_confusion_counts,
+    cube_monthly_score_hist,
+    cube_subgroup_metrics,
+    SUBGROUP_DIMENSIONS
 )
 
 
@@ -32,73 +94,728 @@ app, server = create_dash_app()
 
 # Load and prepare data
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-csv_file_path = os.path.join(BASE_DIR, 'sample_data_0504.csv')
-df = load_data(csv_file_path)
-df = prepare_data(df)
+csv_file_path = os.environ.get("DATA_FILE", os.path.join(BASE_DIR, 'sample_data_0504.csv'))
+# DATA_FILE may also be a SQLite database that other jobs append to; the
+# rows they add are read every INGEST_INTERVAL seconds (see INGESTION). It
+# is still read into memory whole, as the stages not run on the source
+# (cube, timelines, SHAP distributions) work on the frame.
+sql_source = SQLiteSource(csv_file_path) if is_sqlite_path(csv_file_path) else None
+with stage_timer("load_data"):
+    if sql_source is not None:
+        df, source_position = sql_source.read_rows()
+    else:
+        df = load_data(csv_file_path)
+with stage_timer("prepare_data"):
+    df = prepare_data(df)
+count_rows("load_data", len(df))
+
+# Metrics of selections above SKETCH_MIN_ROWS rows are approximated from the
+# score sketches of the filter cube, smaller ones are computed exactly from
+# their rows; METRICS_MODE=cube or exact uses one or the other for all
+METRICS_MODE = os.environ.get("METRICS_MODE", "auto")
+SKETCH_MIN_ROWS = int(os.environ.get("SKETCH_MIN_ROWS", 250_000))
+
+# The data store indexes the filter dimensions and dates for fast row
+# selection, builds the cube and the filter options, and takes new batches
+with stage_timer("build_store"):
+    store = DataStore(df, with_cube=METRICS_MODE != "exact", cube=load_cube(csv_file_path, df),
+                      filter_index=load_filter_index(csv_file_path, df),
+                      cache_dir=appendable_cache(csv_file_path) if sql_source is None else None,
+                      source_position=source_position if sql_source is not None else 0)
 
-# Create filter options
-sex_options, age_options, model_options, month_options, run_id_options, site_options, op_type_options = create_filter_options(df)
+# Identifies the data of a snapshot across workers
+@functools.lru_cache(maxsize=1)
+def data_version(data):
+    ingested = ",".join(sorted(data.ingested_files))
+    # A SQL log changes with every append, its rows read so far identify the data
+    source = f"rows:{data.source_position}" if sql_source is not None else sorted(source_key(csv_file_path).items())
+    return hashlib.sha1(f"{source}|{ingested}".encode()).hexdigest()
 
-# Calculate average SHAP values
-sorted_shap_values = calculate_average_shap_values(df)
+# Bootstrap resamples of the confidence intervals (0 turns them off) and
+# worker processes to spread them over
+BOOTSTRAP_RESAMPLES = int(os.environ.get("BOOTSTRAP_RESAMPLES", 1000))
+BOOTSTRAP_WORKERS = int(os.environ.get("BOOTSTRAP_WORKERS", 0))
+# Timelines with more periods (days of a long timeframe) are drawn without
+# bands, as their bootstrap would hold up the timeline
+BOOTSTRAP_MAX_PERIODS = int(os.environ.get("BOOTSTRAP_MAX_PERIODS", 60))
+
+# Subgroups with fewer records are suppressed in the subgroup matrix; the
+# dashboard and the API can only raise this minimum
+SUBGROUP_MIN_COUNT = int(os.environ.get("SUBGROUP_MIN_COUNT", 10))
+
+# Alert limits of the drift statistics: PSI, KS distance and mean shift in
+# reference standard deviations
+DRIFT_PSI_ALERT = float(os.environ.get("DRIFT_PSI_ALERT", 0.2))
+DRIFT_KS_ALERT = float(os.environ.get("DRIFT_KS_ALERT", 0.1))
+DRIFT_MEAN_SHIFT_ALERT = float(os.environ.get("DRIFT_MEAN_SHIFT_ALERT", 0.25))
+
+# Cache of selections and metrics; RESULT_CACHE=disk shares it between the
+# workers on one host. Results are keyed by the version of the snapshot
+# they are computed from, which keys out results of older data.
+result_cache = create_result_cache(
+    backend=os.environ.get("RESULT_CACHE", "memory"),
+    max_megabytes=float(os.environ.get("RESULT_CACHE_MB", 256)),
+    directory=os.environ.get("RESULT_CACHE_DIR"),
+    version=lambda: data_version(store.current()),
+)
+
+@REGISTRY.add_collector
+def collect_cache_metrics():
+    stats = result_cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    return [
+        ("modelmonitor_result_cache_hits_total", "counter", "Result cache hits", {}, stats["hits"]),
+        ("modelmonitor_result_cache_misses_total", "counter", "Result cache misses", {}, stats["misses"]),
+        ("modelmonitor_result_cache_evictions_total", "counter", "Result cache evictions", {}, stats["evictions"]),
+        ("modelmonitor_result_cache_hit_ratio", "gauge", "Share of result cache lookups that hit", {},
+         stats["hits"] / lookups if lookups else 0),
+        ("modelmonitor_result_cache_bytes", "gauge", "Size of the result cache", {}, stats["bytes"]),
+    ] + [
+        (f"modelmonitor_lru_cache_{field}_total", "counter", f"Per-process LRU cache {field}", {"cache": name},
+         getattr(function.cache_info(), field))
+        for name, function in [("filtered_df", get_filtered_df), ("cube_cells", get_cube_cells)]
+        for field in ["hits", "misses"]
+    ]
+
+# Results of the most common selections are computed in the background at
+# startup and after every data update (WARMUP=0 turns this off): the
+# default view, the WARMUP_RECENT most requested selections and every
+# single-filter selection. Callbacks computing longer than BACKGROUND_WAIT
+# seconds finish in the background while the page polls for them.
+WARMUP = os.environ.get("WARMUP", "1") != "0"
+WARMUP_RECENT = int(os.environ.get("WARMUP_RECENT", 20))
+BACKGROUND_WAIT = float(os.environ.get("BACKGROUND_WAIT", 0.5))
+background_tasks = BackgroundTasks(workers=int(os.environ.get("BACKGROUND_WORKERS", 2)))
+
+# Opt-in profiling: callbacks slower than PROFILE_BUDGET_MS are sampled and
+# their folded stacks written to PROFILE_DIR
+callback_profiler = CallbackProfiler(
+    budget_ms=float(os.environ["PROFILE_BUDGET_MS"]),
+    directory=os.environ.get("PROFILE_DIR"),
+    interval_ms=float(os.environ.get("PROFILE_INTERVAL_MS", 5)),
+) if os.environ.get("PROFILE_BUDGET_MS") else None
 
 
 ## LAYOUT
-app.layout = create_layout(month_options, sex_options, age_options, site_options, op_type_options, model_options, run_id_options)
 
+# Figures are built once with their full layout; the callbacks only send
+# the data that changed as partial updates
+static_figures = create_static_figures()
+
+# Built per page load so new sessions see the current filter options
+def serve_layout():
+    sex_options, age_options, model_options, month_options, run_id_options, site_options, op_type_options = store.current().filter_options
+    return create_layout(month_options, sex_options, age_options, site_options, op_type_options, model_options, run_id_options,
+                         static_figures, SUBGROUP_MIN_COUNT)
+
+app.layout = serve_layout
+
+
+## SELECTION STAGE
+
+# The filtered selection and the metrics derived from it are cached per
+# normalized filter tuple, so a callback only recomputes the stages that its
+# own inputs invalidate. The row-level stages run on the data source: a
+# SQLite log filters, counts and fetches the scores of the selected rows in
+# its queries, the frame in memory takes them from the cached selection.
+# Every stage works on the snapshot of the data its callback started with
+# (store.current()), so positions and cells always match the rows and the
+# cube they index.
+
+@result_cache.memoize("selection")
+@timed("selection")
+def get_selection(*filters):
+    data = store.current()
+    if sql_source is not None:
+        positions = sql_source.select(*filters, rows=len(data.df))
+    else:
+        positions = query_filter_index(data.filter_index, *filters)
+    count_rows("selection", len(positions))
+    return positions
+
+@functools.lru_cache(maxsize=1)
+def get_source(data):
+    if sql_source is not None:
+        return sql_source
+    return PandasSource(data.df, data.filter_index, selection=get_selection)
+
+@functools.lru_cache(maxsize=8)
+@timed("filtered_df")
+def get_filtered_df(data, *filters):
+    return data.df.take(get_selection(*filters))
+
+@functools.lru_cache(maxsize=32)
+@timed("cube_cells")
+def get_cube_cells(data, *filters):
+    return select_cells(data.cube, *filters)
+
+def use_sketch(*filters):
+    if METRICS_MODE != "auto":
+        return METRICS_MODE == "cube"
+    data = store.current()
+    return data.cube["cells"]["count"].to_numpy()[get_cube_cells(data, *filters)].sum() > SKETCH_MIN_ROWS
+
+@result_cache.memoize("summary")
+@timed("summary")
+def get_summary_metrics(*filters):
+    data = store.current()
+    if use_sketch(*filters):
+        return cube_summary_metrics(data.cube, get_cube_cells(data, *filters))
+    return get_source(data).calculate_summary_metrics(*filters)
+
+# Threshold sweeps are built once per selection; moving a cutoff slider
+# only runs a binary search over them
+@result_cache.memoize("threshold_sweep")
+@timed("threshold_sweep")
+def get_threshold_sweep(*filters):
+    return get_source(store.current()).calculate_threshold_sweep(*filters)
+
+@result_cache.memoize("monthly_sweep")
+@timed("monthly_sweep")
+def get_monthly_sweep(*filters):
+    return get_source(store.current()).calculate_monthly_sweep(*filters)
+
+@result_cache.memoize("monthly_auroc")
+@timed("monthly_auroc")
+def get_monthly_auroc(*filters):
+    data = store.current()
+    if use_sketch(*filters):
+        return cube_monthly_auroc(data.cube, get_cube_cells(data, *filters))
+    return calculate_grouped_auroc(get_monthly_sweep(*filters))
+
+# Confidence intervals are bootstrapped from the monthly score histograms;
+# the overall AUROC only needs their sum
+@result_cache.memoize("score_hist")
+@timed("score_hist")
+def get_monthly_score_hist(*filters):
+    data = store.current()
+    if use_sketch(*filters):
+        return cube_monthly_score_hist(data.cube, get_cube_cells(data, *filters))
+    return calculate_grouped_score_hist(get_monthly_sweep(*filters))
+
+# Worst-case error of an AUROC from the sketch; None when computed exactly
+@result_cache.memoize("auroc_error_bound")
+def get_auroc_error_bound(*filters):
+    if not use_sketch(*filters):
+        return None
+    data = store.current()
+    return cube_auroc_error_bound(data.cube, get_cube_cells(data, *filters))
+
+@result_cache.memoize("auroc_interval")
+@timed("auroc_interval")
+def get_auroc_interval(*filters):
+    if not BOOTSTRAP_RESAMPLES:
+        return None
+    hist = get_monthly_score_hist(*filters).sum(axis=0, keepdims=True)
+    low, high = bootstrap_intervals(hist, n_resamples=BOOTSTRAP_RESAMPLES, workers=BOOTSTRAP_WORKERS)["auroc"]
+    return float(low[0]), float(high[0])
+
+@result_cache.memoize("monthly_intervals")
+@timed("monthly_intervals")
+def get_monthly_intervals(*filters):
+    if not BOOTSTRAP_RESAMPLES:
+        return None
+    return bootstrap_intervals(get_monthly_score_hist(*filters), CUTOFF_THRESHOLDS,
+                               n_resamples=BOOTSTRAP_RESAMPLES, workers=BOOTSTRAP_WORKERS)
+
+# Timelines by day or week, and over rolling windows, are differences of
+# prefix sums of the daily score histograms of the selection
+# (timeseries.py), which read three columns of the selected rows once; the
+# AUROC of their periods is binned, like that of the cube
+@result_cache.memoize("daily_prefix")
+@timed("daily_prefix")
+def get_daily_prefix(*filters):
+    positions = get_selection(*filters)
+    days = timeframe_days(filters[3], filters[4])
+    df = store.current().df
+    columns = [df[column].to_numpy()[positions] for column in ["date", "outcome", "pred_prob"]]
+    return days, prefix_sums(daily_score_hist(*columns, days))
+
+@result_cache.memoize("period_score_hist")
+@timed("period_score_hist")
+def get_period_score_hist(granularity, window, *filters):
+    days, prefix = get_daily_prefix(*filters)
+    return period_hist(prefix, days, granularity, window)
+
+@result_cache.memoize("period_intervals")
+@timed("period_intervals")
+def get_period_intervals(granularity, window, *filters):
+    _, hist = get_period_score_hist(granularity, window, *filters)
+    if not BOOTSTRAP_RESAMPLES or len(hist) > BOOTSTRAP_MAX_PERIODS:
+        return None
+    return bootstrap_intervals(hist, CUTOFF_THRESHOLDS, n_resamples=BOOTSTRAP_RESAMPLES, workers=BOOTSTRAP_WORKERS)
+
+# Confusion counts at every cutoff the sliders can select, overall and per
+# period of the timeline; the browser redraws the confusion matrix and the
+# timeline from it while a slider moves, without a round trip to the server
+@result_cache.memoize("threshold_summary")
+@timed("threshold_summary")
+def get_threshold_summary(granularity, window, *filters):
+    monthly = granularity == "month" and not window
+    if use_sketch(*filters):
+        data = store.current()
+        cells = get_cube_cells(data, *filters)
+        counts = cube_confusion_counts(data.cube, cells, CUTOFF_THRESHOLDS)
+        if monthly:
+            period_counts = cube_monthly_confusion_counts(data.cube, cells, CUTOFF_THRESHOLDS)
+    else:
+        counts = calculate_confusion_counts(get_threshold_sweep(*filters), CUTOFF_THRESHOLDS)
+        if monthly:
+            period_counts = calculate_grouped_confusion_counts(get_monthly_sweep(*filters), CUTOFF_THRESHOLDS)
+    if monthly:
+        return create_threshold_summary(CUTOFF_THRESHOLDS, counts, get_monthly_auroc(*filters), period_counts,
+                                        get_monthly_intervals(*filters))
+
+    periods, hist = get_period_score_hist(granularity, window, *filters)
+    period_auroc = pd.Series(auroc_from_hist(hist), index=periods)
+    # Rows are thresholds, columns periods
+    period_counts = tuple(values.T for values in confusion_counts_from_hist(hist, CUTOFF_THRESHOLDS))
+    return create_threshold_summary(CUTOFF_THRESHOLDS, counts, period_auroc, period_counts,
+                                    get_period_intervals(granularity, window, *filters))
+
+# Every combination of the subgroup dimensions within the selection, in one
+# grouped pass over the cube cells or the rows
+@result_cache.memoize("subgroups")
+@timed("subgroups")
+def get_subgroup_metrics(dimensions, threshold, *filters):
+    data = store.current()
+    if use_sketch(*filters):
+        return cube_subgroup_metrics(data.cube, get_cube_cells(data, *filters), dimensions, threshold)
+    return calculate_subgroup_metrics(get_filtered_df(data, *filters), dimensions, threshold)
+
+def get_subgroup_table(dimensions, threshold, min_count, filters, sort_by="auroc", ascending=True):
+    subgroups = get_subgroup_metrics(tuple(dimensions), normalize_threshold(threshold), *filters)
+    subgroups = suppress_small_cells(subgroups, max(min_count or 0, SUBGROUP_MIN_COUNT))
+    return sort_subgroups(subgroups, sort_by, ascending)
+
+def table_records(table):
+    return table.astype(object).where(table.notna(), None).to_dict("records")
+
+# Drift statistics, SHAP rankings and the record counts of the filter
+# options come from the cube; in exact mode a cube is built for them on
+# first use
+@functools.lru_cache(maxsize=1)
+def get_cube(data):
+    return data.cube if data.cube is not None else build_cube(data.df)
+
+@result_cache.memoize("drift")
+@timed("drift")
+def get_drift(by, reference_start, reference_end, *filters):
+    cube = get_cube(store.current())
+    sex, age, model, _, _, run_id, site, op_type = filters
+    reference = select_cells(cube, sex, age, model, reference_start, reference_end, run_id, site, op_type)
+    return cube_drift(cube, select_cells(cube, *filters), reference, by)
+
+# Calibration comes from the score histograms and risk sums of the cube
+@result_cache.memoize("calibration")
+@timed("calibration")
+def get_calibration(*filters):
+    cube = get_cube(store.current())
+    return cube_calibration(cube, select_cells(cube, *filters))
+
+@result_cache.memoize("calibration_by")
+@timed("calibration_by")
+def get_calibration_by(by, *filters):
+    cube = get_cube(store.current())
+    return cube_calibration_by(cube, select_cells(cube, *filters), by)
+
+@result_cache.memoize("filter_counts")
+@timed("filter_counts")
+def get_filter_counts(*filters):
+    counts = cube_filter_counts(get_cube(store.current()), *filters)
+    counts["month"] = counts["month"].rename(lambda month: month.strftime("%B %Y"))
+    return {column: by_value.to_dict() for column, by_value in counts.items()}
+
+@result_cache.memoize("shap_ranking")
+@timed("shap_ranking")
+def get_shap_ranking(by, k, *filters):
+    cube = get_cube(store.current())
+    return shap_ranking(cube, select_cells(cube, *filters), by, k)
+
+@result_cache.memoize("shap_distributions")
+@timed("shap_distributions")
+def get_shap_distributions(columns, *filters):
+    return shap_distributions(store.current().df, sample_positions(get_selection(*filters)), columns)
+
+@result_cache.memoize("shap_subgroups")
+@timed("shap_subgroups")
+def get_shap_subgroups(dimension, by, columns, *filters):
+    cube = get_cube(store.current())
+    return subgroup_shap_means(cube, select_cells(cube, *filters), dimension, list(columns), by)
+
+@store.on_update
+def invalidate_results(store):
+    result_cache.invalidate()
+    get_filtered_df.cache_clear()
+    get_cube_cells.cache_clear()
+
+def normalize_filters(sex, age, model, start_month, end_month, run_id, site, op_type):
+    start, end = datetime.strptime(start_month, "%B %Y"), datetime.strptime(end_month, "%B %Y")
+    if start > end:
+        # Start month must be smaller or equal to end month
+        raise PreventUpdate
+    return (sex, age, model, start.strftime("%Y-%m"), end.strftime("%Y-%m"), run_id, site, op_type)
+
+def normalize_threshold(threshold):
+    return round(float(threshold), 6)
+
+CUTOFF_THRESHOLDS = [normalize_threshold(i * CUTOFF_STEP) for i in range(int(round(1 / CUTOFF_STEP)) + 1)]
 
-## CALLBACK FUNCTION
+
+## CACHE WARMING
+
+def default_selection():
+    month_options = store.current().filter_options[3]
+    return normalize_filters("All", "All", "All", month_options[0], month_options[-1], "All", "All", "All")
+
+def common_selections():
+    sex_options, age_options, model_options, _, run_id_options, site_options, op_type_options = store.current().filter_options
+    options = {0: sex_options, 1: age_options, 2: model_options, 5: run_id_options, 6: site_options, 7: op_type_options}
+    return single_dimension_selections(default_selection(), options)
+
+# Only results up to this size are kept: the views need the small final
+# results, while the selections and threshold sweeps they are computed from
+# would fill the result cache
+WARMUP_MAX_ENTRY_BYTES = 1024 * 1024
+
+@store.read
+@result_cache.entry_limit(WARMUP_MAX_ENTRY_BYTES)
+def warm_selection(filters):
+    # The stages behind every tab with its controls as the page opens
+    get_summary_metrics(*filters)
+    get_auroc_interval(*filters)
+    get_auroc_error_bound(*filters)
+    get_threshold_summary(DEFAULT_GRANULARITY, DEFAULT_WINDOW, *filters)
+    get_filter_counts(*filters)
+    ranking = get_shap_ranking(DEFAULT_SHAP_RANKING, SHAP_TOP_K_OPTIONS[0], *filters)
+    get_shap_distributions(tuple(ranking.index), *filters)
+    get_shap_subgroups(DEFAULT_SHAP_DIMENSION, DEFAULT_SHAP_RANKING, tuple(ranking.index), *filters)
+    get_subgroup_table(SUBGROUP_DIMENSIONS, DEFAULT_CUTOFF, SUBGROUP_MIN_COUNT, filters)
+    reference = normalize_filters("All", "All", "All", *default_reference_months(store.current().filter_options[3]), "All", "All", "All")
+    get_drift("month", reference[3], reference[4], *filters)
+    get_calibration(*filters)
+    get_calibration_by("month", *filters)
+
+warmer = CacheWarmer(warm_selection, common_selections, recent=WARMUP_RECENT)
+
+if WARMUP:
+    warmer.start()
+    store.on_update(lambda store: warmer.start())
+
+@REGISTRY.add_collector
+def collect_warmup_metrics():
+    stats = warmer.stats()
+    return [
+        ("modelmonitor_warmup_selections", "gauge", "Selections of the current cache warm-up run", {}, stats["selections"]),
+        ("modelmonitor_warmup_warmed", "gauge", "Selections warmed by the current run", {}, stats["warmed"]),
+        ("modelmonitor_warmup_coverage", "gauge", "Share of the selections of the current run warmed", {},
+         stats["warmed"] / stats["selections"] if stats["selections"] else 0),
+        ("modelmonitor_warmup_seconds", "gauge", "Duration of the current (or last) warm-up run", {}, stats["seconds"]),
+        ("modelmonitor_warmup_running", "gauge", "Whether a warm-up run is going", {}, int(stats["running"])),
+        ("modelmonitor_warmup_runs_total", "counter", "Completed warm-up runs", {}, stats["runs"]),
+        ("modelmonitor_warmup_errors", "gauge", "Selections of the current run that failed", {}, stats["errors"]),
+        ("modelmonitor_warmup_requests_total", "counter", "Selections requested by the dashboard", {}, stats["requests"]),
+        ("modelmonitor_warmup_requests_warmed_total", "counter", "Requested selections that had been warmed", {},
+         stats["requests_warmed"]),
+    ]
+
+
+## CALLBACK FUNCTIONS
+
+filter_inputs = [
+    dash.dependencies.Input("sex-dropdown", "value"),
+    dash.dependencies.Input("age-dropdown", "value"),
+    dash.dependencies.Input("model-dropdown", "value"),
+    dash.dependencies.Input("start-month-dropdown", "value"),
+    dash.dependencies.Input("end-month-dropdown", "value"),
+    dash.dependencies.Input("run-id-dropdown", "value"),
+    dash.dependencies.Input("site-dropdown", "value"),
+    dash.dependencies.Input("op-type-dropdown", "value"),
+]
 
 @app.callback(
     [dash.dependencies.Output("indicator-records", "figure"),
      dash.dependencies.Output("indicator-complications", "figure"),
-     dash.dependencies.Output("indicator-auroc", "figure"),
-     dash.dependencies.Output("timeline", "figure"),
-     dash.dependencies.Output("shap-barplot", "figure"),
-     dash.dependencies.Output("confusion-matrix", "figure")], 
-    [dash.dependencies.Input("sex-dropdown", "value"),
-     dash.dependencies.Input("age-dropdown", "value"),
-     dash.dependencies.Input("model-dropdown", "value"),
-     dash.dependencies.Input("start-month-dropdown", "value"),
-     dash.dependencies.Input("end-month-dropdown", "value"),
-     dash.dependencies.Input("run-id-dropdown", "value"),
-     dash.dependencies.Input("site-dropdown", "value"),
-     dash.dependencies.Input("op-type-dropdown", "value"),
-     dash.dependencies.Input("cutoff-slider", "value"),
+     dash.dependencies.Output("indicator-auroc", "figure")],
+    filter_inputs)
+
+@instrument_callback(callback_profiler)
+@store.read
+def update_indicators(sex, age, model, start_month, end_month, run_id, site, op_type):
+    filters = normalize_filters(sex, age, model, start_month, end_month, run_id, site, op_type)
+    warmer.record(filters)
+
+    records, avg_complications, auroc = get_summary_metrics(*filters)
+    auroc_interval = get_auroc_interval(*filters)
+    auroc_error_bound = get_auroc_error_bound(*filters)
+
+    with stage_timer("figures"):
+        records_figure = patch_records_figure(records)
+        complications_figure = patch_complications_figure(avg_complications)
+        auroc_figure = patch_auroc_figure(auroc, auroc_interval, auroc_error_bound)
+
+    return records_figure, complications_figure, auroc_figure
+
+# The threshold summary, the subgroup matrix and the drift table are
+# computed as background tasks: past BACKGROUND_WAIT seconds the callback
+# returns a progress note and enables its poll, which calls it again until
+# the result is ready
+@app.callback(
+    [dash.dependencies.Output("threshold-summary", "data"),
+     dash.dependencies.Output("threshold-summary-progress", "children"),
+     dash.dependencies.Output("threshold-summary-poll", "disabled")],
+    filter_inputs + [
+        dash.dependencies.Input("granularity-dropdown", "value"),
+        dash.dependencies.Input("window-dropdown", "value"),
+        dash.dependencies.Input("threshold-summary-poll", "n_intervals")])
+
+@instrument_callback(callback_profiler)
+@store.read
+def update_threshold_summary(sex, age, model, start_month, end_month, run_id, site, op_type, granularity, window,
+                             n_intervals):
+    filters = normalize_filters(sex, age, model, start_month, end_month, run_id, site, op_type)
+    window = int(window or 0)
+    summary, elapsed = background_tasks.run(("threshold_summary", granularity, window) + filters, get_threshold_summary,
+                                            granularity, window, *filters, wait=BACKGROUND_WAIT)
+    if elapsed is not None:
+        return dash.no_update, background_progress(elapsed), False
+    return summary, None, True
+
+# The cutoff sliders and the metric checkboxes are handled in the browser
+# (assets/thresholds.js) from the threshold summary
+app.clientside_callback(
+    dash.dependencies.ClientsideFunction(namespace="thresholds", function_name="timeline"),
+    dash.dependencies.Output("timeline", "figure"),
+    [dash.dependencies.Input("threshold-summary", "data"),
      dash.dependencies.Input("cutoff-slider-2", "value"),
-     dash.dependencies.Input("metrics-checkboxes", "value")])
+     dash.dependencies.Input("metrics-checkboxes", "value")],
+    [dash.dependencies.State("timeline", "figure")])
 
-def update_graph(sex, age, model, start_month, end_month, run_id, site, op_type, cutoff_threshold_cm, cutoff_threshold_timeline, selected_metrics):
-    if datetime.strptime(start_month, "%B %Y") > datetime.strptime(end_month, "%B %Y"):
-        return dash.no_update, dcc.alert(
-            "Start month must be smaller or equal to end month",
-            id="month-range-alert",
-            color="danger",
-            style={"display": "block"}
-        )
+@app.callback(
+    [dash.dependencies.Output("shap-barplot", "figure"),
+     dash.dependencies.Output("shap-distribution", "figure")],
+    filter_inputs + [
+        dash.dependencies.Input("shap-ranking", "value"),
+        dash.dependencies.Input("shap-top-k", "value")])
 
-    filtered_df = filter_df(df, sex, age, model, start_month, end_month, run_id, site, op_type)
-    avg_complications, auroc, monthly_auroc, monthly_sensitivity_specificity = calculate_metrics(filtered_df, cutoff_threshold_timeline)
+@instrument_callback(callback_profiler)
+@store.read
+def update_shap_figures(sex, age, model, start_month, end_month, run_id, site, op_type, by, k):
+    filters = normalize_filters(sex, age, model, start_month, end_month, run_id, site, op_type)
+    ranking = get_shap_ranking(by, k, *filters)
+    quantiles, points = get_shap_distributions(tuple(ranking.index), *filters)
+    with stage_timer("figures"):
+        return patch_shap_barplot(ranking, by), patch_shap_distribution_figure(quantiles, points)
 
-    records_figure = create_records_figure(filtered_df)
-    complications_figure = create_complications_figure(avg_complications)
-    auroc_figure = create_auroc_figure(auroc)
-    timeline_figure = create_timeline_figure(monthly_auroc, monthly_sensitivity_specificity, selected_metrics)
-    shap_barplot = create_shap_barplot(filtered_df)
-    confusion_matrix_figure = create_confusion_matrix(filtered_df, cutoff_threshold_cm)
+@app.callback(
+    dash.dependencies.Output("shap-subgroups", "figure"),
+    filter_inputs + [
+        dash.dependencies.Input("shap-ranking", "value"),
+        dash.dependencies.Input("shap-top-k", "value"),
+        dash.dependencies.Input("shap-subgroup-dimension", "value")])
 
-    return records_figure, complications_figure, auroc_figure, timeline_figure, shap_barplot, confusion_matrix_figure
+@instrument_callback(callback_profiler)
+@store.read
+def update_shap_subgroups(sex, age, model, start_month, end_month, run_id, site, op_type, by, k, dimension):
+    filters = normalize_filters(sex, age, model, start_month, end_month, run_id, site, op_type)
+    columns = tuple(get_shap_ranking(by, k, *filters).index)
+    subgroup_means = get_shap_subgroups(dimension, by, columns, *filters)
+    with stage_timer("figures"):
+        return patch_shap_subgroup_figure(subgroup_means, by)
 
+app.clientside_callback(
+    dash.dependencies.ClientsideFunction(namespace="thresholds", function_name="confusion_matrix"),
+    dash.dependencies.Output("confusion-matrix", "figure"),
+    [dash.dependencies.Input("threshold-summary", "data"),
+     dash.dependencies.Input("cutoff-slider", "value")],
+    [dash.dependencies.State("confusion-matrix", "figure")])
 
 
-## START APP
+@app.callback(
+    [dash.dependencies.Output("subgroup-table", "columns"),
+     dash.dependencies.Output("subgroup-table", "data"),
+     dash.dependencies.Output("subgroup-table-progress", "children"),
+     dash.dependencies.Output("subgroup-table-poll", "disabled")],
+    filter_inputs + [
+        dash.dependencies.Input("subgroup-dimensions", "value"),
+        dash.dependencies.Input("subgroup-cutoff-slider", "value"),
+        dash.dependencies.Input("subgroup-min-count", "value"),
+        dash.dependencies.Input("subgroup-table-poll", "n_intervals")])
 
-# Create Dash app
-app = dash.Dash(__name__)
+@instrument_callback(callback_profiler)
+@store.read
+def update_subgroup_table(sex, age, model, start_month, end_month, run_id, site, op_type, dimensions, cutoff_threshold, min_count,
+                          n_intervals):
+    filters = normalize_filters(sex, age, model, start_month, end_month, run_id, site, op_type)
+    dimensions = [dimension for dimension in SUBGROUP_DIMENSIONS if dimension in dimensions]
+    table, elapsed = background_tasks.run(("subgroup_table", tuple(dimensions), cutoff_threshold, min_count) + filters,
+                                          get_subgroup_table, dimensions, cutoff_threshold, min_count, filters,
+                                          wait=BACKGROUND_WAIT)
+    if elapsed is not None:
+        return dash.no_update, dash.no_update, background_progress(elapsed), False
+    return subgroup_table_columns(dimensions), table_records(table), None, True
 
-# For Gunicorn to run the app correctly
-server = app.server
+@app.callback(
+    [dash.dependencies.Output("drift-table", "columns"),
+     dash.dependencies.Output("drift-table", "data"),
+     dash.dependencies.Output("drift-table", "style_data_conditional"),
+     dash.dependencies.Output("drift-alerts", "children"),
+     dash.dependencies.Output("drift-progress", "children"),
+     dash.dependencies.Output("drift-poll", "disabled")],
+    filter_inputs + [
+        dash.dependencies.Input("drift-reference-start", "value"),
+        dash.dependencies.Input("drift-reference-end", "value"),
+        dash.dependencies.Input("drift-group-by", "value"),
+        dash.dependencies.Input("drift-poll", "n_intervals")])
+
+@instrument_callback(callback_profiler)
+@store.read
+def update_drift(sex, age, model, start_month, end_month, run_id, site, op_type, reference_start, reference_end, by, n_intervals):
+    filters = normalize_filters(sex, age, model, start_month, end_month, run_id, site, op_type)
+    reference = normalize_filters(sex, age, model, reference_start, reference_end, run_id, site, op_type)
+    drift, elapsed = background_tasks.run(("drift", by, reference[3], reference[4]) + filters,
+                                          get_drift, by, reference[3], reference[4], *filters, wait=BACKGROUND_WAIT)
+    if elapsed is not None:
+        return (dash.no_update,) * 4 + (background_progress(elapsed), False)
+    alerts = drift_alerts(drift, DRIFT_PSI_ALERT, DRIFT_KS_ALERT, DRIFT_MEAN_SHIFT_ALERT, SUBGROUP_MIN_COUNT)
+    table = suppress_small_cells(drift, SUBGROUP_MIN_COUNT, counts=("count", "reference_count"),
+                                 metrics=("psi", "ks", "mean_shift"))
+    return (drift_table_columns(by), table_records(table),
+            drift_table_styles(DRIFT_PSI_ALERT, DRIFT_KS_ALERT, DRIFT_MEAN_SHIFT_ALERT),
+            drift_alert_list(alerts.to_dict("records")), None, True)
+
+@app.callback(
+    [dash.dependencies.Output("calibration-summary", "children"),
+     dash.dependencies.Output("calibration-curve", "figure"),
+     dash.dependencies.Output("calibration-table", "columns"),
+     dash.dependencies.Output("calibration-table", "data")],
+    filter_inputs + [dash.dependencies.Input("calibration-group-by", "value")])
+
+@instrument_callback(callback_profiler)
+@store.read
+def update_calibration(sex, age, model, start_month, end_month, run_id, site, op_type, by):
+    filters = normalize_filters(sex, age, model, start_month, end_month, run_id, site, op_type)
+    curve, metrics = get_calibration(*filters)
+    table = suppress_small_cells(get_calibration_by(by, *filters), SUBGROUP_MIN_COUNT, metrics=CALIBRATION_METRICS)
+    with stage_timer("figures"):
+        figure = patch_calibration_figure(curve)
+    return calibration_summary(metrics), figure, calibration_table_columns(by), table_records(table)
+
+@app.callback(
+    [dash.dependencies.Output("sex-dropdown", "options"),
+     dash.dependencies.Output("age-dropdown", "options"),
+     dash.dependencies.Output("model-dropdown", "options"),
+     dash.dependencies.Output("start-month-dropdown", "options"),
+     dash.dependencies.Output("end-month-dropdown", "options"),
+     dash.dependencies.Output("run-id-dropdown", "options"),
+     dash.dependencies.Output("site-dropdown", "options"),
+     dash.dependencies.Output("op-type-dropdown", "options"),
+     dash.dependencies.Output("drift-reference-start", "options"),
+     dash.dependencies.Output("drift-reference-end", "options")],
+    filter_inputs)
+
+@instrument_callback(callback_profiler)
+@store.read
+def update_filter_options(sex, age, model, start_month, end_month, run_id, site, op_type):
+    # Every dropdown lists the values with records under the other filters,
+    # with their counts, including values of newly ingested batches
+    counts = get_filter_counts(*normalize_filters(sex, age, model, start_month, end_month, run_id, site, op_type))
+    sex_options, age_options, model_options, month_options, run_id_options, site_options, op_type_options = store.current().filter_options
+    return (counted_dropdown_options(sex_options, counts["sex"], sex),
+            counted_dropdown_options(age_options, counts["age_group"], age),
+            counted_dropdown_options(model_options, counts["model_version"], model),
+            counted_dropdown_options(month_options, counts["month"], start_month),
+            counted_dropdown_options(month_options, counts["month"], end_month),
+            counted_dropdown_options(run_id_options, counts["run_id"], run_id),
+            counted_dropdown_options(site_options, counts["site"], site),
+            counted_dropdown_options(op_type_options, counts["op_type"], op_type),
+            dropdown_options(month_options), dropdown_options(month_options))
+
+
+## SUBGROUP API
+
+# The subgroup matrix as JSON: GET /api/subgroups with the sidebar filters
+# (months as YYYY-MM), threshold, dimensions (comma separated), min_count,
+# sort and ascending as query parameters
+@server.route("/api/subgroups")
+@store.read
+def subgroups_api():
+    args = flask.request.args
+    month_options = store.current().filter_options[3]
+    try:
+        filters = normalize_filters(
+            args.get("sex", "All"), args.get("age", "All"), args.get("model", "All"),
+            datetime.strptime(args["start_month"], "%Y-%m").strftime("%B %Y") if "start_month" in args else month_options[0],
+            datetime.strptime(args["end_month"], "%Y-%m").strftime("%B %Y") if "end_month" in args else month_options[-1],
+            args.get("run_id", "All"), args.get("site", "All"), args.get("op_type", "All"))
+        threshold = float(args.get("threshold", 0.075))
+        min_count = int(args.get("min_count", SUBGROUP_MIN_COUNT))
+    except PreventUpdate:
+        return flask.jsonify(error="start_month is after end_month"), 400
+    except ValueError as error:
+        return flask.jsonify(error=str(error)), 400
+
+    dimensions = args.get("dimensions", ",".join(SUBGROUP_DIMENSIONS)).split(",")
+    dimensions = [dimension for dimension in dimensions if dimension]
+    unknown = sorted(set(dimensions) - set(SUBGROUP_DIMENSIONS))
+    if unknown:
+        return flask.jsonify(error=f"Unknown dimensions: {', '.join(unknown)}"), 400
+    sort_by = args.get("sort", "auroc")
+    if sort_by not in dimensions + ["count", "complication_rate", "auroc", "sensitivity", "specificity"]:
+        return flask.jsonify(error=f"Cannot sort by {sort_by}"), 400
+
+    table = get_subgroup_table(dimensions, threshold, min_count, filters, sort_by,
+                               args.get("ascending", "true").lower() != "false")
+    return flask.jsonify(threshold=normalize_threshold(threshold), min_count=max(min_count, SUBGROUP_MIN_COUNT),
+                         suppressed=int(table["suppressed"].sum()), subgroups=table_records(table))
+
+
+## INGESTION
+
+# New prediction batches are CSV files with the same columns as the log.
+# They are picked up from INGEST_DIR by every worker, and can be posted to
+# /api/ingest when INGEST_TOKEN is set.
+INGEST_DIR = os.environ.get("INGEST_DIR", os.path.join(BASE_DIR, "incoming"))
+INGEST_TOKEN = os.environ.get("INGEST_TOKEN")
+
+if INGEST_TOKEN:
+    os.makedirs(INGEST_DIR, exist_ok=True)
+
+if os.path.isdir(INGEST_DIR):
+    store.ingest_directory(INGEST_DIR)
+    store.watch_directory(INGEST_DIR, interval=float(os.environ.get("INGEST_INTERVAL", 30)))
+
+if sql_source is not None:
+    store.watch_source(sql_source, interval=float(os.environ.get("INGEST_INTERVAL", 30)))
+
+if INGEST_TOKEN:
+    @server.route("/api/ingest", methods=["POST"])
+    def ingest_batch():
+        if not hmac.compare_digest(flask.request.headers.get("Authorization", ""), f"Bearer {INGEST_TOKEN}"):
+            return flask.jsonify(error="Unauthorized"), 401
+
+        # The whole batch is parsed as it will be ingested, so a batch that
+        # cannot be is rejected here instead of being published
+        body = flask.request.get_data()
+        try:
+            read_batch(io.BytesIO(body), list(store.snapshot.df.columns))
+        except ValueError as error:
+            return flask.jsonify(error=f"Invalid batch: {error}"), 400
+
+        # Publish the batch into the drop directory so every worker (and
+        # every later start) ingests it, then ingest it here right away
+        name = f"batch-{datetime.utcnow():%Y%m%dT%H%M%S%f}.csv"
+        fd, tmp_path = tempfile.mkstemp(dir=INGEST_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(body)
+        os.replace(tmp_path, os.path.join(INGEST_DIR, name))
+        rows = store.ingest_directory(INGEST_DIR)
+        return flask.jsonify(file=name, rows=rows, records=len(store.snapshot.df))
+
+
+## START APP
 
+# Gunicorn serves the `server` created in SETUP (see gunicorn.conf.py)
 if __name__ == '__main__':
     app.run_server(debug=True)
 
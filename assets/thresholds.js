@@ -0,0 +1,99 @@
+/* redraw the confusion matrix and the timeline when a cutoff slider moves,
+   from the threshold summary that the server sends once per filter change;
+   the timeline draws the bootstrap confidence bands of the summary */
+
+if(!window.dash_clientside) {window.dash_clientside = {};}
+
+function thresholdIndex(thresholds, cutoff) {
+    // First threshold at or above the cutoff (the sliders only select listed ones)
+    var lo = 0, hi = thresholds.length - 1;
+    while (lo < hi) {
+        var mid = (lo + hi) >> 1;
+        if (thresholds[mid] < cutoff - 1e-9) { lo = mid + 1; } else { hi = mid; }
+    }
+    return lo;
+}
+
+// Fixed colors, so a metric and its band keep them whichever are shown
+var METRICS = [
+    {key: "auroc", name: "AUROC", color: "#636efa", band: "rgba(99, 110, 250, 0.2)"},
+    {key: "sensitivity", name: "Sensitivity", color: "#EF553B", band: "rgba(239, 85, 59, 0.2)"},
+    {key: "specificity", name: "Specificity", color: "#00cc96", band: "rgba(0, 204, 150, 0.2)"},
+    {key: "complication_rate", name: "Complication rate", color: "#ab63fa", band: "rgba(171, 99, 250, 0.2)"}
+];
+
+window.dash_clientside.thresholds = {
+    confusion_matrix: function (summary, cutoff, figure) {
+        if (!summary || !figure) {return window.dash_clientside.no_update;}
+        var j = thresholdIndex(summary.thresholds, cutoff);
+        var tn = summary.tn[j], fn = summary.fn[j];
+        var z = [[tn, summary.n_neg - tn], [fn, summary.n_pos - fn]];
+
+        // Same text and colors as ff.create_annotated_heatmap with the Blues scale
+        var x = ['Predicted low risk', 'Predicted high risk'];
+        var y = ['Successful surgery', 'Complication'];
+        var values = z[0].concat(z[1]);
+        var zmid = (Math.max.apply(null, values) + Math.min.apply(null, values)) / 2;
+        var annotations = [];
+        z.forEach(function (row, i) {
+            row.forEach(function (value, k) {
+                annotations.push({
+                    text: String(value), x: x[k], y: y[i], xref: "x", yref: "y",
+                    font: {color: value < zmid ? "#000000" : "#FFFFFF"}, showarrow: false
+                });
+            });
+        });
+
+        var title = Object.assign({}, figure.layout.title,
+                                  {text: 'Confusion Matrix (Threshold: ' + cutoff.toFixed(3) + ')'});
+        return {
+            data: [Object.assign({}, figure.data[0], {z: z})],
+            layout: Object.assign({}, figure.layout, {annotations: annotations, title: title})
+        };
+    },
+
+    timeline: function (summary, cutoff, selected_metrics, figure) {
+        if (!summary || !figure) {return window.dash_clientside.no_update;}
+        var j = thresholdIndex(summary.thresholds, cutoff);
+        var values = {auroc: summary.period_auroc, sensitivity: [], specificity: [], complication_rate: []};
+        var bands = {auroc: [summary.period_auroc_low, summary.period_auroc_high]};
+        if (summary.period_sensitivity_low) {
+            bands.sensitivity = [summary.period_sensitivity_low[j], summary.period_sensitivity_high[j]];
+            bands.specificity = [summary.period_specificity_low[j], summary.period_specificity_high[j]];
+        }
+        summary.periods.forEach(function (period, m) {
+            var records = summary.period_n_neg[m] + summary.period_n_pos[m];
+            values.complication_rate.push(records ? summary.period_n_pos[m] / records : null);
+            // Undefined where a period has a single class, like its AUROC
+            if (summary.period_auroc[m] === null) {
+                values.sensitivity.push(null);
+                values.specificity.push(null);
+                return;
+            }
+            var tn = summary.period_tn[j][m], fn = summary.period_fn[j][m];
+            var fp = summary.period_n_neg[m] - tn, tp = summary.period_n_pos[m] - fn;
+            values.sensitivity.push(tp / (tp + fn));
+            values.specificity.push(tn / (tn + fp));
+        });
+
+        var traces = [];
+        METRICS.forEach(function (metric) {
+            if (selected_metrics.indexOf(metric.key) < 0) {return;}
+            var band = bands[metric.key];
+            if (band && band[0]) {
+                // Confidence band: the upper bound fills down to the lower one
+                var undefinedPeriod = function (bound) {
+                    return bound.map(function (value, m) {return values[metric.key][m] === null ? null : value;});
+                };
+                traces.push({x: summary.periods, y: undefinedPeriod(band[0]), mode: 'lines', line: {width: 0},
+                             legendgroup: metric.key, showlegend: false, hoverinfo: 'skip'});
+                traces.push({x: summary.periods, y: undefinedPeriod(band[1]), mode: 'lines', line: {width: 0},
+                             fill: 'tonexty', fillcolor: metric.band, legendgroup: metric.key,
+                             showlegend: false, hoverinfo: 'skip'});
+            }
+            traces.push({x: summary.periods, y: values[metric.key], mode: 'lines+markers', name: metric.name,
+                         legendgroup: metric.key, line: {color: metric.color}, marker: {color: metric.color}});
+        });
+        return Object.assign({}, figure, {data: traces});
+    }
+}
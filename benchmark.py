@@ -0,0 +1,733 @@
+# Benchmark suite for the monitoring pipeline.
+#
+# Usage: python benchmark.py [filter] [metrics] [load] [ingest] [figures] [pipeline] [callbacks] [bootstrap] [sketch] [startup] [shap] [backends]
+#            [warmup] [calibration] [timeseries]
+#            [--sizes 10000 1000000 10000000] [--json results.json] [--compare previous.json]
+#
+# Every measurement is printed and, with --json, written to a file together
+# with the commit and library versions, so runs of different commits can be
+# compared with --compare.
+
+# IMPORTS
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue as queue_module
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from sklearn.metrics import roc_auc_score, confusion_matrix
+from plotly.io.json import to_json_plotly
+
+from data_generator import generate_data, write_data
+from helpers import (
+    load_data,
+    prepare_data,
+    filter_df,
+    calculate_metrics,
+    calculate_summary_metrics,
+    calculate_threshold_sweep,
+    calculate_monthly_sweep,
+    calculate_grouped_auroc,
+    calculate_grouped_sensitivity_specificity,
+    calculate_confusion_matrix,
+    calculate_grouped_score_hist,
+    calculate_metric_intervals,
+    create_records_figure,
+    create_complications_figure,
+    create_auroc_figure,
+    create_timeline_figure,
+    create_shap_barplot,
+    create_shap_distribution_figure,
+    create_confusion_matrix,
+    patch_records_figure,
+    patch_complications_figure,
+    patch_auroc_figure,
+    patch_timeline_figure,
+    patch_shap_barplot,
+    patch_shap_distribution_figure,
+    patch_confusion_matrix
+)
+from filter_index import build_filter_index
+from cube import (build_cube, select_cells, score_to_bin, threshold_to_bin, confusion_counts_from_hist, cube_summary_metrics,
+                  cube_auroc_error_bound)
+from timeseries import GRANULARITIES, timeframe_days, daily_score_hist, prefix_sums, period_hist
+from calibration import cube_calibration, quantile_bins, CALIBRATION_BINS
+from metrics import build_threshold_sweep, auroc, roc_auc_score as numpy_roc_auc_score
+from bootstrap import bootstrap_intervals
+from explainability import shap_ranking, sample_positions, shap_distributions, subgroup_shap_means
+from streaming import stream_ingest
+from data_source import PandasSource, SQLiteSource, import_csv
+
+
+# REFERENCE IMPLEMENTATIONS
+
+def copy_then_mask_filter_df(df, sex, age, model, start_month, end_month, run_id, site, op_type):
+    # The previous filter_df: copy the whole frame, then apply chained masks
+    filtered_df = df.copy()
+    if sex != "All":
+        filtered_df = filtered_df[filtered_df["sex"] == sex]
+    if age != "All":
+        filtered_df = filtered_df[filtered_df["age_group"] == age]
+    if model != "All":
+        filtered_df = filtered_df[filtered_df["model_version"] == model]
+    if run_id != "All":
+        filtered_df = filtered_df[filtered_df["run_id"] == run_id]
+    if site != "All":
+        filtered_df = filtered_df[filtered_df["site"] == site]
+    if op_type != "All":
+        filtered_df = filtered_df[filtered_df["op_type"] == op_type]
+
+    filtered_df["date"] = pd.to_datetime(filtered_df["date"])
+
+    start_date = pd.to_datetime(start_month)
+    end_date = pd.to_datetime(end_month) + pd.offsets.MonthBegin(1)
+    return filtered_df[(filtered_df["date"] >= start_date) & (filtered_df["date"] < end_date)]
+
+
+def groupby_apply_monthly_metrics(filtered_df, cutoff_threshold):
+    # The previous monthly metrics: a Python function per month group
+    def auroc_if_possible(x):
+        if len(x['outcome'].unique()) < 2:
+            return None
+        return roc_auc_score(x['outcome'], x['pred_prob'])
+
+    def sensitivity_specificity_if_possible(x, threshold):
+        if len(x['outcome'].unique()) < 2:
+            return pd.Series({"sensitivity": None, "specificity": None})
+        tn, fp, fn, tp = confusion_matrix(x['outcome'], x['pred_prob'] > threshold).ravel()
+        return pd.Series({"sensitivity": tp / (tp + fn), "specificity": tn / (tn + fp)})
+
+    filtered_df = filtered_df.copy()
+    filtered_df['month'] = filtered_df['date'].dt.to_period('M')
+    monthly_auroc = filtered_df.groupby('month').apply(auroc_if_possible)
+    monthly_sensitivity_specificity = filtered_df.groupby('month').apply(sensitivity_specificity_if_possible, threshold=cutoff_threshold)
+    return monthly_auroc, monthly_sensitivity_specificity
+
+
+def grouped_sweep_monthly_metrics(filtered_df, cutoff_threshold):
+    monthly_sweep = calculate_monthly_sweep(filtered_df)
+    return calculate_grouped_auroc(monthly_sweep), calculate_grouped_sensitivity_specificity(monthly_sweep, cutoff_threshold)
+
+
+def groupby_apply_period_counts(filtered_df, granularity, window, ends, cutoff_threshold):
+    # Records, complications and predicted high risk records with and
+    # without the outcome of every period (a Python function per period
+    # group), or of the window up to each end day (a mask per window)
+    high = score_to_bin(filtered_df["pred_prob"].to_numpy(), 200) >= threshold_to_bin(cutoff_threshold, 200)
+    rows = filtered_df.assign(high=high)
+
+    def counts(x):
+        return pd.Series({"records": len(x), "complications": x["outcome"].sum(),
+                          "tp": (x["high"] & (x["outcome"] == 1)).sum(), "fp": (x["high"] & (x["outcome"] == 0)).sum()})
+
+    if window:
+        days = rows["date"].dt.normalize()
+        return pd.DataFrame([counts(rows[(days > end - pd.Timedelta(days=window)) & (days <= end)]) for end in ends])
+    periods = rows["date"].dt.to_period(GRANULARITIES[granularity])
+    return rows.groupby(periods).apply(counts)
+
+
+def prefix_sum_period_counts(filtered_df, granularity, window, start_month, end_month, cutoff_threshold):
+    days = timeframe_days(start_month, end_month)
+    prefix = prefix_sums(daily_score_hist(filtered_df["date"].to_numpy(), filtered_df["outcome"].to_numpy(),
+                                          filtered_df["pred_prob"].to_numpy(), days))
+    labels, hist = period_hist(prefix, days, granularity, window)
+    _, fp, _, tp = confusion_counts_from_hist(hist, [cutoff_threshold])
+    return labels, pd.DataFrame({"records": hist.sum(axis=(1, 2)), "complications": hist[:, 1].sum(axis=1),
+                                 "tp": tp[:, 0], "fp": fp[:, 0]})
+
+
+# RESULTS
+
+RESULTS = []
+
+
+def report(benchmark, n_samples, case, **values):
+    RESULTS.append({"benchmark": benchmark, "n_samples": n_samples, "case": case, **values})
+    measurements = "  ".join(f"{name}: {value:10.6f}" if isinstance(value, float) else f"{name}: {value:>10,}"
+                             for name, value in values.items())
+    print(f"{n_samples:>12,} rows  {benchmark:<9} {case:<36} {measurements}")
+
+
+def run_metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def write_results(path):
+    with open(path, "w") as f:
+        json.dump({"metadata": run_metadata(), "results": RESULTS}, f, indent=1)
+
+
+def compare_results(path):
+    # Ratio of every measurement to the same one in an earlier run; for
+    # seconds and bytes a ratio above 1 is a regression
+    with open(path) as f:
+        previous = json.load(f)
+    keys = ("benchmark", "n_samples", "case")
+    baseline = {tuple(result[key] for key in keys): result for result in previous["results"]}
+    print(f"\nCompared with {previous['metadata'].get('commit')} ({path}):")
+    for result in RESULTS:
+        old = baseline.get(tuple(result[key] for key in keys))
+        if old is None:
+            continue
+        for name, value in result.items():
+            if name in keys or not isinstance(old.get(name), (int, float)) or not old[name]:
+                continue
+            print(f"{result['n_samples']:>12,} rows  {result['benchmark']:<9} {result['case']:<36} "
+                  f"{name}: {old[name]:12.6g} -> {value:12.6g}  ({value / old[name]:5.2f}x)")
+
+
+# BENCHMARKS
+
+FILTER_CASES = {
+    "all": ("All", "All", "All", "July 2022", "April 2023", "All", "All", "All"),
+    "one_site": ("All", "All", "All", "July 2022", "April 2023", "All", "NSEC", "All"),
+    "narrow": ("Male", "61-70", "v1", "September 2022", "November 2022", "Run 2", "NSEC", "hip"),
+}
+
+FILTER_IDS = ["sex-dropdown", "age-dropdown", "model-dropdown", "start-month-dropdown", "end-month-dropdown",
+              "run-id-dropdown", "site-dropdown", "op-type-dropdown"]
+
+# Values of the other inputs of server callbacks, as on page load
+CONTROL_VALUES = {
+    "subgroup-dimensions": ["sex", "age_group", "site", "op_type"],
+    "subgroup-cutoff-slider": 0.075,
+    "subgroup-min-count": 10,
+    "drift-reference-start": "July 2022",
+    "drift-reference-end": "September 2022",
+    "drift-group-by": "month",
+    "shap-ranking": "mean",
+    "shap-top-k": 5,
+    "shap-subgroup-dimension": "sex",
+    "threshold-summary-poll": None,
+    "subgroup-table-poll": None,
+    "drift-poll": None,
+    "calibration-group-by": "month",
+    "granularity-dropdown": "month",
+    "window-dropdown": 0,
+}
+
+
+def best_of(function, repeat=5, clock=time.perf_counter):
+    timings = []
+    for _ in range(repeat):
+        start = clock()
+        function()
+        timings.append(clock() - start)
+    return min(timings)
+
+
+def run_once(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def benchmark_filter_df(n_samples, repeat):
+    df = prepare_data(generate_data(n_samples))
+    raw_dates = df["date"].dt.strftime("%Y-%m-%d")
+
+    seconds, index = run_once(lambda: build_filter_index(df))
+    report("filter", n_samples, "build_filter_index", seconds=seconds)
+
+    for name, filters in FILTER_CASES.items():
+        # The old implementation re-parsed the raw date strings on every call
+        legacy_df = df.assign(date=raw_dates)
+        legacy = best_of(lambda: copy_then_mask_filter_df(legacy_df, *filters), repeat)
+        indexed = best_of(lambda: filter_df(df, *filters, index=index), repeat)
+        report("filter", n_samples, name, copy_then_mask=legacy, indexed=indexed, speedup=legacy / indexed)
+
+
+def benchmark_load_data(n_samples, repeat):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file_path = os.path.join(tmp_dir, "data.csv")
+        write_data(csv_file_path, n_samples)
+
+        plain = best_of(lambda: pd.read_csv(csv_file_path), repeat)
+        cold, _ = run_once(lambda: load_data(csv_file_path))
+        cached = best_of(lambda: load_data(csv_file_path), repeat)
+        report("load", n_samples, "load_data", read_csv=plain, first_load_data=cold, cached_load_data=cached)
+
+
+def benchmark_monthly_metrics(n_samples, repeat):
+    df = prepare_data(generate_data(n_samples))
+    legacy = best_of(lambda: groupby_apply_monthly_metrics(df, 0.075), repeat)
+    grouped = best_of(lambda: grouped_sweep_monthly_metrics(df, 0.075), repeat)
+    report("metrics", n_samples, "monthly_metrics", groupby_apply=legacy, grouped_sweep=grouped, speedup=legacy / grouped)
+
+
+def peak_rss_kb():
+    # ru_maxrss survives exec on Linux, so prefer the per-process high water mark
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def address_space_bytes():
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmSize:"))
+
+
+def measure_streaming_ingest(csv_file_path, directory, memory_cap_mb, queue):
+    # Runs in a fresh process so that its peak RSS only reflects the ingest;
+    # where /proc is available, its address space may only grow by the cap,
+    # so an ingest that needs more fails instead of passing unnoticed
+    baseline = peak_rss_kb()
+    try:
+        limit = address_space_bytes() + memory_cap_mb * 2 ** 20
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except OSError:
+        pass
+    try:
+        stream_ingest(csv_file_path, directory, prepare=prepare_data)
+        completed = True
+    except MemoryError:
+        completed = False
+    queue.put((baseline, peak_rss_kb(), completed))
+
+
+def run_in_fresh_process(target, *args):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=target, args=args + (queue,))
+    process.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except queue_module.Empty:
+            if not process.is_alive():
+                raise RuntimeError(f"{target.__name__} exited with code {process.exitcode}")
+    process.join()
+    return result
+
+
+def benchmark_streaming_ingest(n_samples, repeat, memory_cap_mb=512):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file_path = os.path.join(tmp_dir, "data.csv")
+        write_data(csv_file_path, n_samples)
+
+        start = time.perf_counter()
+        baseline, peak, completed = run_in_fresh_process(measure_streaming_ingest, csv_file_path,
+                                                         os.path.join(tmp_dir, "columns"), memory_cap_mb)
+        elapsed = time.perf_counter() - start
+
+        growth_mb = (peak - baseline) / 1024
+        report("ingest", n_samples, "stream_ingest", seconds=elapsed, csv_mb=os.path.getsize(csv_file_path) / 2 ** 20,
+               peak_rss_growth_mb=growth_mb, within_cap=int(completed and growth_mb <= memory_cap_mb))
+
+
+def benchmark_figures(n_samples, repeat):
+    # Server CPU and response bytes of building and serializing each figure,
+    # as a full figure versus a partial update of the static figure
+    df = prepare_data(generate_data(n_samples))
+    records, avg_complications, auroc = calculate_summary_metrics(df)
+    monthly_sweep = calculate_monthly_sweep(df)
+    monthly_auroc = calculate_grouped_auroc(monthly_sweep)
+    monthly_sensitivity_specificity = calculate_grouped_sensitivity_specificity(monthly_sweep, 0.075)
+    cube = build_cube(df)
+    ranking = shap_ranking(cube, np.ones(len(cube["cells"]), dtype=bool))
+    quantiles, points = shap_distributions(df, sample_positions(np.arange(len(df))), list(ranking.index))
+    cm = calculate_confusion_matrix(calculate_threshold_sweep(df), 0.075)
+    metrics = ["auroc", "sensitivity", "specificity"]
+
+    cases = {
+        "records": (lambda: create_records_figure(records), lambda: patch_records_figure(records)),
+        "complications": (lambda: create_complications_figure(avg_complications),
+                          lambda: patch_complications_figure(avg_complications)),
+        "auroc": (lambda: create_auroc_figure(auroc), lambda: patch_auroc_figure(auroc)),
+        "timeline": (lambda: create_timeline_figure(monthly_auroc, monthly_sensitivity_specificity, metrics),
+                     lambda: patch_timeline_figure(monthly_auroc, monthly_sensitivity_specificity, metrics)),
+        "shap": (lambda: create_shap_barplot(ranking), lambda: patch_shap_barplot(ranking)),
+        "shap_distribution": (lambda: create_shap_distribution_figure(quantiles, points),
+                              lambda: patch_shap_distribution_figure(quantiles, points)),
+        "confusion": (lambda: create_confusion_matrix(cm, 0.075), lambda: patch_confusion_matrix(cm, 0.075)),
+    }
+    for name, (full, patch) in cases.items():
+        full_cpu = best_of(lambda: to_json_plotly(full()), max(repeat, 20), time.process_time)
+        patch_cpu = best_of(lambda: to_json_plotly(patch()), max(repeat, 20), time.process_time)
+        report("figures", n_samples, name, full_cpu=full_cpu, full_bytes=len(to_json_plotly(full())),
+               patch_cpu=patch_cpu, patch_bytes=len(to_json_plotly(patch())))
+
+
+def benchmark_pipeline(n_samples, repeat):
+    # Every stage between the CSV and the metrics, one after the other
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file_path = os.path.join(tmp_dir, "data.csv")
+        write_data(csv_file_path, n_samples)
+
+        seconds, raw_df = run_once(lambda: load_data(csv_file_path, use_cache=False))
+        report("pipeline", n_samples, "load_data (csv)", seconds=seconds)
+        seconds, _ = run_once(lambda: prepare_data(raw_df))
+        report("pipeline", n_samples, "prepare_data", seconds=seconds)
+        seconds, _ = run_once(lambda: load_data(csv_file_path))
+        report("pipeline", n_samples, "load_data (writes cache)", seconds=seconds)
+        report("pipeline", n_samples, "load_data (cached)", seconds=best_of(lambda: load_data(csv_file_path), repeat))
+
+        df = prepare_data(load_data(csv_file_path))
+        seconds, index = run_once(lambda: build_filter_index(df))
+        report("pipeline", n_samples, "build_filter_index", seconds=seconds)
+        seconds, _ = run_once(lambda: build_cube(df))
+        report("pipeline", n_samples, "build_cube", seconds=seconds)
+
+        for name, filters in FILTER_CASES.items():
+            filtered_df = filter_df(df, *filters, index=index)
+            report("pipeline", n_samples, f"filter_df {name}",
+                   seconds=best_of(lambda: filter_df(df, *filters, index=index), repeat), rows=len(filtered_df))
+            report("pipeline", n_samples, f"calculate_metrics {name}",
+                   seconds=best_of(lambda: calculate_metrics(filtered_df, 0.075), repeat))
+
+
+def callback_requests(app, filters):
+    # (name, request body) of every server callback, with the given sidebar
+    # values and the other controls as on page load
+    values = dict(zip(FILTER_IDS, filters), **CONTROL_VALUES)
+    for output, callback in app.app.callback_map.items():
+        if not all(item["id"] in values for item in callback["inputs"]):
+            continue  # Clientside callbacks, driven by the sliders
+        if output.startswith(".."):
+            outputs = [dict(zip(("id", "property"), key.rsplit(".", 1))) for key in output[2:-2].split("...")]
+        else:
+            outputs = dict(zip(("id", "property"), output.rsplit(".", 1)))
+        inputs = [dict(item, value=values[item["id"]]) for item in callback["inputs"]]
+        yield callback["callback"].__name__, {"output": output, "outputs": outputs, "inputs": inputs, "state": [],
+                                              "changedPropIds": [f"{FILTER_IDS[0]}.value"]}
+
+
+def measure_callbacks(csv_file_path, repeat, queue):
+    # Imports the app on the given data in a fresh process and calls every
+    # server callback through the Dash endpoint, as the browser would. The
+    # cache warm-up is off and callbacks wait for their background tasks,
+    # so cold calls compute everything.
+    os.environ.update(DATA_FILE=csv_file_path, WARMUP="0", BACKGROUND_WAIT="600")
+    seconds, app = run_once(lambda: __import__("app"))
+    results = [("startup", {"seconds": seconds})]
+
+    client = app.server.test_client()
+    for name, filters in FILTER_CASES.items():
+        for callback_name, body in callback_requests(app, filters):
+            cold, response = run_once(lambda: client.post("/_dash-update-component", json=body))
+            warm = best_of(lambda: client.post("/_dash-update-component", json=body), repeat)
+            results.append((f"{callback_name} {name}", {"cold": cold, "warm": warm, "bytes": len(response.data)}))
+    queue.put(results)
+
+
+def benchmark_callbacks(n_samples, repeat):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file_path = os.path.join(tmp_dir, "data.csv")
+        write_data(csv_file_path, n_samples)
+        # The first start converts the CSV, the second one maps the cache
+        for startup in ["first", "cached"]:
+            for case, values in run_in_fresh_process(measure_callbacks, csv_file_path, repeat):
+                if case == "startup":
+                    report("callbacks", n_samples, f"startup ({startup})", **values)
+                elif startup == "cached":
+                    report("callbacks", n_samples, case, **values)
+
+
+def measure_first_views(csv_file_path, warmup, queue):
+    # Time of the first request of every server callback for each single-site
+    # selection, as the first user of the day opening it, with or without
+    # waiting for the cache warm-up
+    os.environ.update(DATA_FILE=csv_file_path, WARMUP="1" if warmup else "0", BACKGROUND_WAIT="600")
+    import app
+    results = []
+    if warmup:
+        app.warmer.future.result()
+        stats = app.warmer.stats()
+        results.append(("warm-up", {"seconds": stats["seconds"], "selections": stats["selections"],
+                                    "coverage": stats["warmed"] / stats["selections"]}))
+
+    client = app.server.test_client()
+    month_options = app.store.snapshot.filter_options[3]
+    for site in app.store.snapshot.filter_options[5][1:]:
+        filters = ("All", "All", "All", month_options[0], month_options[-1], "All", site, "All")
+        seconds = sum(run_once(lambda: client.post("/_dash-update-component", json=body))[0]
+                      for _, body in callback_requests(app, filters))
+        results.append((f"first view site={site}", {"seconds": seconds}))
+    queue.put(results)
+
+
+def benchmark_warmup(n_samples, repeat):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file_path = os.path.join(tmp_dir, "data.csv")
+        write_data(csv_file_path, n_samples)
+        load_data(csv_file_path)  # Both runs start from the columnar cache
+        for warmup in [False, True]:
+            for case, values in run_in_fresh_process(measure_first_views, csv_file_path, warmup):
+                report("warmup", n_samples, f"{case} ({'warmed' if warmup else 'cold'})" if case != "warm-up" else case,
+                       **values)
+
+
+def benchmark_bootstrap(n_samples, repeat, n_resamples=1000):
+    # 1,000-resample intervals of the AUROC and the monthly metrics at all
+    # 201 slider cutoffs, inline and spread over worker processes
+    df = prepare_data(generate_data(n_samples))
+    monthly_sweep = calculate_monthly_sweep(df)
+    report("bootstrap", n_samples, "score_hist (from sweep)",
+           seconds=best_of(lambda: calculate_grouped_score_hist(monthly_sweep), repeat))
+    monthly_hist = calculate_grouped_score_hist(monthly_sweep)
+    thresholds = [i * 0.005 for i in range(201)]
+
+    report("bootstrap", n_samples, "auroc interval",
+           seconds=best_of(lambda: bootstrap_intervals(monthly_hist.sum(axis=0, keepdims=True), n_resamples=n_resamples), repeat))
+    for workers in [0, 4]:
+        bootstrap_intervals(monthly_hist, thresholds, n_resamples=n_resamples, workers=workers)  # Starts the pool
+        report("bootstrap", n_samples, f"monthly intervals (workers={workers})",
+               seconds=best_of(lambda: bootstrap_intervals(monthly_hist, thresholds, n_resamples=n_resamples, workers=workers), repeat))
+    report("bootstrap", n_samples, "calculate_metric_intervals",
+           seconds=best_of(lambda: calculate_metric_intervals(df, 0.075, n_resamples), repeat))
+
+
+def benchmark_sketch(n_samples, repeat):
+    # AUROC from the score sketches of the cube against the exact one from
+    # the rows, with the error bound the app reports; within_bound must hold
+    df = prepare_data(generate_data(n_samples))
+    index = build_filter_index(df)
+    cube = build_cube(df)
+    for name, filters in FILTER_CASES.items():
+        filtered_df = filter_df(df, *filters, index=index)
+        mask = select_cells(cube, *filters)
+        exact = auroc(build_threshold_sweep(filtered_df["outcome"], filtered_df["pred_prob"]))
+        if exact is None:
+            continue
+        approximate = cube_summary_metrics(cube, mask)[2]
+        bound = cube_auroc_error_bound(cube, mask)
+        report("sketch", n_samples, name, exact_auroc=exact, sketch_auroc=approximate,
+               error=abs(approximate - exact), bound=bound, within_bound=bool(abs(approximate - exact) <= bound + 1e-12),
+               exact_seconds=best_of(lambda: auroc(build_threshold_sweep(filtered_df["outcome"], filtered_df["pred_prob"])), repeat),
+               sketch_seconds=best_of(lambda: cube_summary_metrics(cube, select_cells(cube, *filters)), repeat))
+
+
+def row_calibration(filtered_df, starts, n_bins):
+    # Brier score, O/E ratio and ECE from the rows, the ECE over the coarse
+    # bins of the cube
+    p = filtered_df["pred_prob"].to_numpy(dtype=float)
+    y = filtered_df["outcome"].to_numpy()
+    coarse = np.searchsorted(starts, score_to_bin(p, n_bins), side="right") - 1
+    return np.mean((p - y) ** 2), y.sum() / p.sum(), np.abs(np.bincount(coarse, weights=y - p)).sum() / len(p)
+
+
+def benchmark_calibration(n_samples, repeat):
+    # Calibration metrics from the cube against the rows: the Brier score
+    # and O/E ratio are exact, the ECE is within half a score bin
+    # (within_bound must hold)
+    df = prepare_data(generate_data(n_samples))
+    index = build_filter_index(df)
+    cube = build_cube(df)
+    for name, filters in FILTER_CASES.items():
+        filtered_df = filter_df(df, *filters, index=index)
+        if not len(filtered_df):
+            continue
+        mask = select_cells(cube, *filters)
+        _, metrics = cube_calibration(cube, mask)
+        starts = quantile_bins(cube["score_hist"][mask].sum(axis=(0, 1)), CALIBRATION_BINS)
+        brier, oe_ratio, ece = row_calibration(filtered_df, starts, cube["n_bins"])
+        exact = np.isclose(metrics["brier"], brier, rtol=1e-9) and np.isclose(metrics["oe_ratio"], oe_ratio, rtol=1e-9, equal_nan=True)
+        report("calibration", n_samples, name, brier=metrics["brier"], oe_ratio=metrics["oe_ratio"], ece=metrics["ece"],
+               ece_error=abs(metrics["ece"] - ece), within_bound=bool(exact and abs(metrics["ece"] - ece) <= 0.5 / cube["n_bins"]),
+               rows_seconds=best_of(lambda: row_calibration(filter_df(df, *filters, index=index), starts, cube["n_bins"]), repeat),
+               cube_seconds=best_of(lambda: cube_calibration(cube, select_cells(cube, *filters)), repeat))
+
+
+def benchmark_timeseries(n_samples, repeat, cases=(("day", 0), ("week", 0), ("month", 0), ("week", 30), ("month", 90))):
+    # Timeline counts from prefix sums of daily histograms against a groupby
+    # per period or a mask per rolling window (mismatches must be 0)
+    df = prepare_data(generate_data(n_samples))
+    index = build_filter_index(df)
+    filters = FILTER_CASES["all"]
+    start_month, end_month = filters[3], filters[4]
+    filtered_df = filter_df(df, *filters, index=index)
+    for granularity, window in cases:
+        labels, counts = prefix_sum_period_counts(filtered_df, granularity, window, start_month, end_month, 0.075)
+        expected = groupby_apply_period_counts(filtered_df, granularity, window, labels, 0.075)
+        if not window:
+            expected = expected.reindex(labels.to_period(GRANULARITIES[granularity]), fill_value=0)
+        mismatches = int((expected.to_numpy() != counts.to_numpy()).any(axis=1).sum())
+        legacy = best_of(lambda: groupby_apply_period_counts(filtered_df, granularity, window, labels, 0.075), repeat)
+        prefix = best_of(lambda: prefix_sum_period_counts(filtered_df, granularity, window, start_month, end_month, 0.075), repeat)
+        report("timeseries", n_samples, f"{granularity} window={window}", periods=len(labels), mismatches=mismatches,
+               groupby_apply=legacy, prefix_sums=prefix, speedup=legacy / prefix)
+
+
+# Run in a new interpreter so that nothing is imported yet; the app serves
+# the page and its layout from the test client right after the import
+STARTUP_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.server.test_client()
+for path in ["/", "/_dash-layout", "/_dash-dependencies"]:
+    assert client.get(path).status_code == 200
+print(json.dumps({"import_app": imported - start, "first_response": time.perf_counter() - imported}))
+"""
+
+
+def import_times(stderr, depth=1):
+    # Cumulative seconds of the modules imported at the given depth below
+    # the script, from the -X importtime report
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or line.endswith("imported package"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if len(name) - len(name.lstrip()) == 1 + 2 * depth:
+            times[name.strip()] = times.get(name.strip(), 0) + int(cumulative) / 1e6
+    return times
+
+
+def benchmark_startup(n_samples, repeat, top_modules=10):
+    # Time from starting a worker process to its first response, and the
+    # import cost of every module the app imports
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file_path = os.path.join(tmp_dir, "data.csv")
+        write_data(csv_file_path, n_samples)
+        env = dict(os.environ, DATA_FILE=csv_file_path, INGEST_DIR=os.path.join(tmp_dir, "incoming"))
+        command = [sys.executable, "-X", "importtime", "-c", STARTUP_SCRIPT]
+        cwd = os.path.dirname(os.path.abspath(__file__))
+
+        # The first start converts the CSV, later ones map the cache
+        runs = []
+        for _ in range(repeat + 1):
+            seconds, process = run_once(lambda: subprocess.run(command, env=env, cwd=cwd, capture_output=True, text=True, check=True))
+            runs.append((seconds, json.loads(process.stdout.splitlines()[-1]), process.stderr))
+        for startup, (seconds, values, _) in [("first", runs[0]), ("cached", min(runs[1:], key=lambda run: run[0]))]:
+            report("startup", n_samples, f"time to first response ({startup})", seconds=seconds, **values)
+
+        modules = import_times(min(runs[1:], key=lambda run: run[0])[2])
+        for name, seconds in sorted(modules.items(), key=lambda item: -item[1])[:top_modules]:
+            report("startup", n_samples, f"import {name}", seconds=seconds)
+
+    # The numpy kernel against the scikit-learn function it replaces
+    df = prepare_data(generate_data(n_samples))
+    difference = abs(numpy_roc_auc_score(df["outcome"], df["pred_prob"]) - roc_auc_score(df["outcome"], df["pred_prob"]))
+    report("startup", n_samples, "roc_auc_score", difference=difference,
+           sklearn=best_of(lambda: roc_auc_score(df["outcome"], df["pred_prob"]), repeat),
+           numpy=best_of(lambda: numpy_roc_auc_score(df["outcome"], df["pred_prob"]), repeat))
+
+
+def benchmark_shap(n_samples, repeat, max_rows=200_000):
+    # The SHAP views of the top 10 features as the number of SHAP columns
+    # grows, against a full mean and sort of every column; rows are capped
+    # so that hundreds of columns fit in memory
+    n_rows = min(n_samples, max_rows)
+    for n_features in [10, 100, 500]:
+        df = prepare_data(generate_data(n_rows, n_shap_features=n_features))
+        shap_columns = [col for col in df.columns if col.startswith("SHAP_")]
+        cube = build_cube(df)
+        mask = np.ones(len(cube["cells"]), dtype=bool)
+        positions = np.arange(len(df))
+        columns = list(shap_ranking(cube, mask, "mean_abs", 10).index)
+        report("shap", n_rows, f"{n_features} features",
+               full_mean_sort=best_of(lambda: df[shap_columns].abs().mean().sort_values(ascending=False), repeat),
+               ranking=best_of(lambda: shap_ranking(cube, mask, "mean_abs", 10), repeat),
+               distributions=best_of(lambda: shap_distributions(df, sample_positions(positions), columns), repeat),
+               subgroups=best_of(lambda: subgroup_shap_means(cube, mask, "sex", columns, "mean_abs"), repeat))
+
+
+def same_metrics(expected, actual):
+    # Equal up to float32 rounding (SHAP values are stored as float32); NaN
+    # and None (undefined metrics) match each other
+    if isinstance(expected, (pd.Series, pd.DataFrame)):
+        return expected.index.equals(actual.index) and same_metrics(expected.to_numpy(), actual.to_numpy())
+    expected = np.asarray(expected, dtype=float)
+    actual = np.asarray(actual, dtype=float)
+    return expected.shape == actual.shape and bool(np.allclose(expected, actual, rtol=1e-6, atol=1e-9, equal_nan=True))
+
+
+def benchmark_backends(n_samples, repeat):
+    # The pandas and SQLite sources on the same log: every metric must agree
+    # (equivalent counts the mismatches, 0 is a pass), with their timings
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file_path = os.path.join(tmp_dir, "data.csv")
+        write_data(csv_file_path, n_samples)
+        seconds, _ = run_once(lambda: import_csv(csv_file_path, os.path.join(tmp_dir, "data.sqlite")))
+        report("backends", n_samples, "import_csv", seconds=seconds)
+
+        sources = {"pandas": PandasSource(prepare_data(load_data(csv_file_path, use_cache=False))),
+                   "sqlite": SQLiteSource(os.path.join(tmp_dir, "data.sqlite"))}
+        for name, filters in FILTER_CASES.items():
+            checks = {
+                "calculate_metrics": lambda source: source.calculate_metrics(0.075, *filters),
+                "calculate_summary_metrics": lambda source: source.calculate_summary_metrics(*filters),
+                "calculate_monthly_counts": lambda source: source.calculate_monthly_counts(*filters),
+                "calculate_shap_means": lambda source: source.calculate_shap_means(*filters),
+            }
+            for check, function in checks.items():
+                expected, actual = function(sources["pandas"]), function(sources["sqlite"])
+                if not isinstance(expected, tuple):
+                    expected, actual = (expected,), (actual,)
+                mismatches = sum(not same_metrics(a, b) for a, b in zip(expected, actual))
+                report("backends", n_samples, f"{check} {name}", mismatches=mismatches,
+                       pandas=best_of(lambda: function(sources["pandas"]), repeat),
+                       sqlite=best_of(lambda: function(sources["sqlite"]), repeat))
+
+
+BENCHMARKS = {
+    "filter": benchmark_filter_df,
+    "metrics": benchmark_monthly_metrics,
+    "load": benchmark_load_data,
+    "ingest": benchmark_streaming_ingest,
+    "figures": benchmark_figures,
+    "pipeline": benchmark_pipeline,
+    "callbacks": benchmark_callbacks,
+    "bootstrap": benchmark_bootstrap,
+    "sketch": benchmark_sketch,
+    "startup": benchmark_startup,
+    "shap": benchmark_shap,
+    "backends": benchmark_backends,
+    "warmup": benchmark_warmup,
+    "calibration": benchmark_calibration,
+    "timeseries": benchmark_timeseries,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs="*", help=f"any of {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 1_000_000, 10_000_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results file of an earlier run to compare with")
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    for name in args.benchmarks or list(BENCHMARKS):
+        for n_samples in args.sizes:
+            BENCHMARKS[name](n_samples, args.repeat)
+
+    if args.json:
+        write_results(args.json)
+    if args.compare:
+        compare_results(args.compare)
@@ -0,0 +1,90 @@
+# IMPORTS
+
+import concurrent.futures
+import functools
+
+import numpy as np
+
+from cube import auroc_from_hist, threshold_to_bin
+
+
+# BOOTSTRAP CONFIDENCE INTERVALS
+#
+# Poisson bootstrap over binned scores. Drawing every row Poisson(1) times
+# draws each (group, outcome, score bin) count from Poisson(count), so a
+# resample costs one draw per non-empty bin whatever the number of rows.
+# The resamples of a chunk are drawn as one array; AUROC, sensitivity and
+# specificity of all of them at every cutoff come from cumulative sums along
+# the score axis. Every chunk has its own seed, so the intervals are the
+# same for a given selection however the chunks are spread over processes.
+
+BOOTSTRAP_RESAMPLES = 1000
+CONFIDENCE_LEVEL = 0.95
+CHUNK_RESAMPLES = 250
+
+
+def resample_metrics(hist, cutoff_positions, n_resamples, seed):
+    # hist is (groups, outcome, bins); cutoff_positions are the number of
+    # bins below each cutoff. Results have the resamples on the first axis.
+    rng = np.random.default_rng(seed)
+    draws = rng.poisson(hist, size=(n_resamples,) + hist.shape)
+    auroc = auroc_from_hist(draws)
+
+    below = np.concatenate([np.zeros(draws.shape[:-1] + (1,), dtype=draws.dtype), np.cumsum(draws, axis=-1)], axis=-1)
+    n_neg, n_pos = below[..., 0, -1:], below[..., 1, -1:]
+    tn, fn = below[..., 0, cutoff_positions], below[..., 1, cutoff_positions]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sensitivity = (n_pos - fn) / n_pos
+        specificity = tn / n_neg
+    # Cutoffs before groups, as in the threshold summary
+    return auroc, sensitivity.swapaxes(1, 2), specificity.swapaxes(1, 2)
+
+
+def percentile_interval(samples, level=CONFIDENCE_LEVEL):
+    # Percentile interval along the first axis, skipping resamples where the
+    # metric is undefined (np.nanquantile is several times slower)
+    samples = np.sort(samples, axis=0)
+    n_valid = (~np.isnan(samples)).sum(axis=0)
+    last = np.maximum(n_valid - 1, 0)
+    bounds = []
+    for q in [(1 - level) / 2, (1 + level) / 2]:
+        position = q * last
+        below = np.floor(position).astype(np.int64)
+        low = np.take_along_axis(samples, below[None], axis=0)[0]
+        high = np.take_along_axis(samples, np.minimum(below + 1, last)[None], axis=0)[0]
+        bounds.append(np.where(n_valid > 0, low + (high - low) * (position - below), np.nan))
+    return tuple(bounds)
+
+
+@functools.lru_cache(maxsize=1)
+def process_pool(workers):
+    # Started on first use and kept for the life of the process
+    return concurrent.futures.ProcessPoolExecutor(workers)
+
+
+def bootstrap_intervals(hist, thresholds=(), n_resamples=BOOTSTRAP_RESAMPLES, level=CONFIDENCE_LEVEL, seed=0, workers=0):
+    # Intervals of the AUROC of every group, and of its sensitivity and
+    # specificity at every threshold (rows), from (groups, outcome, bins)
+    # score histograms as in the cube. Chunks of resamples run in a pool of
+    # worker processes when workers > 1.
+    n_bins = hist.shape[-1]
+    used = np.flatnonzero(hist.reshape(-1, n_bins).any(axis=0))
+    cutoff_bins = [threshold_to_bin(threshold, n_bins) for threshold in thresholds]
+    # Many cutoffs fall between the same two non-empty bins
+    positions, inverse = np.unique(np.searchsorted(used, cutoff_bins).astype(np.int64), return_inverse=True)
+    hist = hist[..., used]
+
+    sizes = [min(CHUNK_RESAMPLES, n_resamples - start) for start in range(0, n_resamples, CHUNK_RESAMPLES)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [[hist] * len(sizes), [positions] * len(sizes), sizes, seeds]
+    if workers > 1 and len(sizes) > 1:
+        chunks = list(process_pool(workers).map(resample_metrics, *tasks))
+    else:
+        chunks = list(map(resample_metrics, *tasks))
+
+    auroc, sensitivity, specificity = (np.concatenate(values) for values in zip(*chunks))
+    return {
+        "auroc": percentile_interval(auroc, level),
+        "sensitivity": tuple(bound[inverse] for bound in percentile_interval(sensitivity, level)),
+        "specificity": tuple(bound[inverse] for bound in percentile_interval(specificity, level)),
+    }
@@ -0,0 +1,234 @@
+# IMPORTS
+
+import contextlib
+import functools
+import hashlib
+import os
+import pickle
+import stat
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+# RESULT CACHE
+#
+# Filtered selections and the metrics computed from them are cached under
+# (data version, stage, normalized arguments). Both backends evict the least
+# recently used entries once their byte budget is exceeded. The disk backend
+# keeps one file per entry in a directory that every gunicorn worker on the
+# host can use; under /dev/shm it lives in shared memory.
+
+class MemoryBackend:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def set(self, key, payload):
+        evicted = 0
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= len(self.entries.pop(key))
+            self.entries[key] = payload
+            self.total_bytes += len(payload)
+            while self.total_bytes > self.max_bytes and self.entries:
+                _, old_payload = self.entries.popitem(last=False)
+                self.total_bytes -= len(old_payload)
+                evicted += 1
+        return evicted
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def invalidate(self):
+        self.clear()
+
+    def size(self):
+        return len(self.entries), self.total_bytes
+
+
+class DiskBackend:
+    def __init__(self, max_bytes, directory):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        # Entries are unpickled, so only a private directory of this user is
+        # used: anyone else able to write to it could run code in the app
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        info = os.lstat(directory)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+            raise PermissionError(f"Result cache directory {directory} must be a directory owned by "
+                                  f"this user and not accessible to others (mode 0700)")
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest() + ".pkl")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                payload = f.read()
+            os.utime(path)  # The modification time doubles as the LRU clock
+        except OSError:
+            return None
+        return payload
+
+    def set(self, key, payload):
+        # Write to a temporary file and rename it so other workers never
+        # read a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, self.path(key))
+        return self.evict()
+
+    def list_entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pkl"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue  # Evicted by another worker meanwhile
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        entries = self.list_entries()
+        total_bytes = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                evicted += 1
+            except OSError:
+                pass
+            total_bytes -= size
+        return evicted
+
+    def clear(self):
+        for _, _, path in self.list_entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def invalidate(self):
+        # Other workers may still be serving the previous version; its
+        # entries can no longer be hit and age out through LRU eviction
+        pass
+
+    def size(self):
+        entries = self.list_entries()
+        return len(entries), sum(size for _, size, _ in entries)
+
+
+class ResultCache:
+    def __init__(self, backend, version=None):
+        self.backend = backend
+        # The data version, or a function returning the version of the data
+        # the calling thread works on
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.local = threading.local()
+
+    def set_version(self, version):
+        # Called whenever the data is (re)loaded; keys include the version,
+        # so entries computed from other data can no longer be hit
+        if version != self.version:
+            self.version = version
+            self.invalidate()
+
+    def invalidate(self):
+        # Called when the data changes under a version function
+        self.backend.invalidate()
+
+    def current_version(self):
+        return self.version() if callable(self.version) else self.version
+
+    def entry_key(self, key):
+        # By value: pickle writes an object that occurs twice once and then
+        # refers back to it, so the same arguments would pickle differently
+        # depending on whether their strings are one object (literals) or
+        # several (parsed from a request)
+        return repr((self.current_version(), key)).encode()
+
+    def get(self, key):
+        return self.lookup(self.entry_key(key))
+
+    def set(self, key, value):
+        self.store(self.entry_key(key), value)
+
+    def lookup(self, entry_key):
+        payload = self.backend.get(entry_key)
+        if payload is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, pickle.loads(payload)
+
+    def store(self, entry_key, value):
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(payload) > getattr(self.local, "max_entry_bytes", self.backend.max_bytes):
+            return  # Would evict everything else
+        self.evictions += self.backend.set(entry_key, payload)
+
+    @contextlib.contextmanager
+    def entry_limit(self, max_bytes):
+        # Results larger than max_bytes computed by this thread meanwhile are
+        # not stored
+        self.local.max_entry_bytes = min(max_bytes, self.backend.max_bytes)
+        try:
+            yield
+        finally:
+            del self.local.max_entry_bytes
+
+    def memoize(self, stage):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args):
+                # Keyed on the version the computation started with: a result
+                # of the old data finished after an update is stored where
+                # only lookups of the old version find it
+                entry_key = self.entry_key((stage,) + args)
+                found, value = self.lookup(entry_key)
+                if not found:
+                    value = function(*args)
+                    self.store(entry_key, value)
+                return value
+            return wrapper
+        return decorator
+
+    def stats(self):
+        entries, total_bytes = self.backend.size()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": total_bytes,
+        }
+
+
+def create_result_cache(backend="memory", max_megabytes=256, directory=None, version=None):
+    max_bytes = int(max_megabytes * 1024 * 1024)
+    if backend == "disk":
+        if directory is None:
+            base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+            directory = os.path.join(base, f"modelmonitor-cache-{os.getuid()}")
+        return ResultCache(DiskBackend(max_bytes, directory), version)
+    return ResultCache(MemoryBackend(max_bytes), version)
@@ -0,0 +1,83 @@
+# IMPORTS
+
+import numpy as np
+import pandas as pd
+
+from drift import quantile_bins, sum_by_group
+
+
+# CALIBRATION
+#
+# Calibration of the predicted risk from the cube: the per-class score
+# histograms count the records of every (risk bin, outcome) of a cell, so
+# summing them over the selected cells, or over those of a month or
+# subgroup, gives the reliability diagram and the expected calibration
+# error (ECE) without reading the rows. The reliability diagram and the ECE
+# group the 200 fine bins into bins of about equal numbers of records, and
+# take the risk of a record as the center of its fine bin, which moves the
+# ECE by at most half a fine bin (0.0025). Observed/expected (O/E) ratios
+# and Brier scores come from exact per-cell sums of the risk, its square
+# and the risk of records with the outcome.
+
+CALIBRATION_BINS = 10
+CALIBRATION_METRICS = ["observed", "expected", "oe_ratio", "brier", "ece"]
+
+
+def reliability_bins(hist, starts):
+    # Records, observed outcomes and expected outcomes per coarse bin;
+    # hist is (..., outcome, fine bins)
+    n_bins = hist.shape[-1]
+    centers = (np.arange(n_bins) + 0.5) / n_bins
+    records = hist.sum(axis=-2)
+    return (np.add.reduceat(records, starts, axis=-1),
+            np.add.reduceat(hist[..., 1, :], starts, axis=-1),
+            np.add.reduceat(records * centers, starts, axis=-1))
+
+
+def calibration_metrics(hist, sums, starts):
+    # One row per histogram of hist (groups, outcome, bins); sums holds the
+    # matching count, outcome_sum, pred_sum, pred_sq_sum and pos_pred_sum
+    count = sums["count"]
+    records, observed, expected = reliability_bins(hist, starts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return pd.DataFrame({
+            "count": count.astype(np.int64),
+            "observed": sums["outcome_sum"] / count,
+            "expected": sums["pred_sum"] / count,
+            "oe_ratio": sums["outcome_sum"] / sums["pred_sum"],
+            # Mean of (p - y)^2 = p^2 - 2py + y, as y is 0 or 1
+            "brier": (sums["pred_sq_sum"] - 2 * sums["pos_pred_sum"] + sums["outcome_sum"]) / count,
+            "ece": np.abs(observed - expected).sum(axis=-1) / count,
+        })
+
+
+def cell_sums(cube, mask):
+    cells = cube["cells"][mask]
+    return {column: cells[column].to_numpy(dtype=float)
+            for column in ["count", "outcome_sum", "pred_sum", "pred_sq_sum", "pos_pred_sum"]}
+
+
+def cube_calibration(cube, mask, n_bins=CALIBRATION_BINS):
+    # The reliability diagram of the selection (mean predicted risk,
+    # observed rate and records per bin) and its calibration metrics
+    hist = cube["score_hist"][mask].sum(axis=0)
+    starts = quantile_bins(hist.sum(axis=0), n_bins)
+    records, observed, expected = reliability_bins(hist, starts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        curve = pd.DataFrame({"expected": expected / records, "observed": observed / records, "count": records})
+    sums = {column: values.sum(keepdims=True) for column, values in cell_sums(cube, mask).items()}
+    return curve[curve["count"] > 0].reset_index(drop=True), calibration_metrics(hist[None], sums, starts).iloc[0]
+
+
+def cube_calibration_by(cube, mask, by="month", n_bins=CALIBRATION_BINS):
+    # Calibration metrics per month or per value of a subgroup dimension,
+    # with the bins of the whole selection
+    codes, groups = pd.factorize(cube["cells"][by][mask], sort=True)
+    # Cells without a value of the dimension (code -1) are left out
+    mask = mask.copy()
+    mask[np.flatnonzero(mask)[codes < 0]] = False
+    codes = codes[codes >= 0]
+    hist = sum_by_group(codes, len(groups), cube["score_hist"][mask])
+    starts = quantile_bins(hist.sum(axis=(0, 1)), n_bins)
+    sums = {column: sum_by_group(codes, len(groups), values) for column, values in cell_sums(cube, mask).items()}
+    return calibration_metrics(hist, sums, starts).assign(group=groups.astype(str))[["group", "count"] + CALIBRATION_METRICS]
@@ -0,0 +1,156 @@
+# IMPORTS
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+# COLUMNAR CACHE
+#
+# A cache directory holds one raw file per column (an .npy file in caches of
+# earlier versions) plus a manifest with the column types and the key of the
+# source file it was built from. Loading memory-maps the files read-only, so
+# nothing is parsed and the pages are shared by every process that maps the
+# same cache.
+
+MANIFEST = "manifest.json"
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_key(path):
+    stat = os.stat(path)
+    return {"mtime": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def make_staging_directory(directory):
+    # Caches are written into a temporary sibling and published by pointing
+    # a symlink at it, so concurrent readers never see a half-written cache
+    parent = os.path.dirname(os.path.abspath(directory))
+    return tempfile.mkdtemp(prefix=f".{os.path.basename(directory)}-", dir=parent)
+
+
+def publish_directory(tmp_dir, directory):
+    # The cache path is a relative symlink to its current version. Renaming
+    # a new link over it is atomic, so a reader resolves either the old or
+    # the new version, never a missing one.
+    previous = os.path.realpath(directory) if os.path.islink(directory) else None
+    if previous is None and os.path.isdir(directory):
+        # A plain directory written by an earlier version of the cache
+        previous = tmp_dir + ".old"
+        os.rename(directory, previous)
+    link = tmp_dir + ".link"
+    os.symlink(os.path.basename(tmp_dir), link)
+    os.replace(link, directory)
+    # Readers that resolved the previous version retry with the new one
+    if previous is not None:
+        shutil.rmtree(previous, ignore_errors=True)
+
+
+def write_manifest(directory, columns, length, source=None, **extra):
+    # Replaced atomically, as appends rewrite the manifest of a published cache
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(dict({"source": source, "length": length, "columns": columns}, **extra), f)
+    os.replace(tmp_path, os.path.join(directory, MANIFEST))
+
+
+@contextlib.contextmanager
+def cache_lock(directory):
+    # Serializes appends to a cache between processes. Readers take no lock:
+    # appends only write past the rows of the manifest, until the new one is
+    # published. The lock file sits next to the cache link, so it outlives
+    # every version.
+    with open(os.path.abspath(directory) + ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def read_column(path, entry, length, mmap_mode):
+    if "dtype" not in entry:
+        return np.load(path, mmap_mode=mmap_mode, allow_pickle=False)
+
+    # Raw column file written chunk by chunk, without an .npy header
+    if mmap_mode is None or length == 0:
+        return np.fromfile(path, dtype=entry["dtype"])
+    return np.memmap(path, dtype=entry["dtype"], mode=mmap_mode, shape=(length,))
+
+
+def read_columns(directory, mmap_mode="r", attempts=3):
+    # The link is resolved once, so the manifest and the columns come from
+    # the same version; None when there is no complete cache
+    for _ in range(attempts):
+        path = os.path.realpath(directory)
+        manifest = read_manifest(path)
+        if manifest is None:
+            if os.path.realpath(directory) != path:
+                continue  # Replaced by a new version meanwhile
+            return None
+        data = {}
+        try:
+            for entry in manifest["columns"]:
+                values = read_column(os.path.join(path, entry["file"]), entry, manifest["length"], mmap_mode)
+                if "categories" in entry:
+                    values = pd.Categorical.from_codes(values, entry["categories"])
+                data[entry["name"]] = values
+        except FileNotFoundError:
+            continue  # Replaced by a new version meanwhile
+        # copy=False keeps every column backed by its memory map
+        return pd.DataFrame(data, copy=False)
+    return None
+
+
+def is_cache_valid(directory, source_path):
+    manifest = read_manifest(directory)
+    if manifest is None or manifest.get("source") is None:
+        return False
+
+    cached, current = manifest["source"], source_key(source_path)
+    if cached["size"] != current["size"]:
+        return False
+    if cached["mtime"] == current["mtime"]:
+        return True
+
+    # The file was touched; it is only stale if its content changed
+    if cached["sha1"] != file_digest(source_path):
+        return False
+    # Unchanged: the new modification time is recorded, so the next checks
+    # (several per process start) do not hash the file again
+    try:
+        with cache_lock(directory):
+            manifest = read_manifest(directory)
+            if manifest is not None and manifest.get("source") is not None:
+                extra = {key: value for key, value in manifest.items() if key not in ("source", "length", "columns")}
+                write_manifest(os.path.realpath(directory), manifest["columns"], manifest["length"],
+                               dict(manifest["source"], mtime=current["mtime"]), **extra)
+    except OSError:
+        pass  # Read-only location, checked by hashing every time
+    return True
+
+
+def cache_source(source_path):
+    return dict(source_key(source_path), sha1=file_digest(source_path))
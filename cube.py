@@ -0,0 +1,311 @@
+# IMPORTS
+
+import numpy as np
+import pandas as pd
+
+
+# FILTER CUBE
+#
+# The cube holds sufficient statistics for every combination of the filter
+# dimensions (a "cell"), so dashboard queries roll up a few hundred cells
+# instead of scanning the prediction log. Scores are kept as per-class
+# histograms; with the default resolution the bin edges coincide with the
+# 0.005 steps of the cutoff sliders. These histograms are fixed-resolution
+# score sketches: the sketch of any selection is the sum over its cells, and
+# AUROC (see auroc_error_bound), confusion counts and ROC curves come from it
+# without sorting scores. Sums of the risk, its square and the risk of
+# records with the outcome give exact calibration metrics (see
+# calibration.py). SHAP values are kept as sums and sums of absolute
+# values, for mean and mean |SHAP| rankings, and as fixed-bin histograms for
+# drift statistics: their bin edges are taken from the first data a cube is
+# built from and reused for every later batch, so cubes of different batches
+# stay mergeable.
+
+CUBE_VERSION = 4
+CUBE_DIMENSIONS = ["sex", "age_group", "model_version", "run_id", "site", "op_type", "month"]
+# Patient subgroups of the subgroup matrix
+SUBGROUP_DIMENSIONS = ["sex", "age_group", "site", "op_type"]
+SCORE_BINS = 200
+SHAP_BINS = 50
+
+
+def shap_bin_edges(df, shap_columns, n_bins=SHAP_BINS):
+    # Edges spanning the bulk of every column with a wide margin; values
+    # outside fall into the first or last bin
+    edges = []
+    for col in shap_columns:
+        values = df[col].to_numpy()
+        values = values[np.isfinite(values)]
+        low, high = np.quantile(values, [0.001, 0.999]) if len(values) else (-1.0, 1.0)
+        margin = max(high - low, 1e-3) / 2
+        edges.append(np.linspace(low - margin, high + margin, n_bins + 1))
+    return np.array(edges).reshape(len(shap_columns), n_bins + 1)
+
+
+def build_cube(df, n_bins=SCORE_BINS, shap_edges=None):
+    shap_columns = [col for col in df.columns if col.startswith("SHAP_")]
+    if shap_edges is None:
+        shap_edges = shap_bin_edges(df, shap_columns)
+
+    keys = df[CUBE_DIMENSIONS[:-1]].copy()
+    keys["month"] = pd.to_datetime(df["date"]).dt.to_period("M")
+    grouped = keys.groupby(CUBE_DIMENSIONS, observed=True, sort=True, dropna=False)
+    cell_ids = grouped.ngroup().to_numpy()
+    cells = grouped.size().rename("count").reset_index()
+    n_cells = len(cells)
+
+    outcome = df["outcome"].to_numpy()
+    cells["outcome_sum"] = np.bincount(cell_ids, weights=outcome, minlength=n_cells)
+    pred_prob = df["pred_prob"].to_numpy(dtype=float)
+    cells["pred_sum"] = np.bincount(cell_ids, weights=pred_prob, minlength=n_cells)
+    cells["pred_sq_sum"] = np.bincount(cell_ids, weights=pred_prob ** 2, minlength=n_cells)
+    cells["pos_pred_sum"] = np.bincount(cell_ids, weights=pred_prob * outcome, minlength=n_cells)
+
+    shap_sum = np.column_stack([
+        np.bincount(cell_ids, weights=df[col].to_numpy(), minlength=n_cells) for col in shap_columns
+    ]) if shap_columns else np.zeros((n_cells, 0))
+    shap_abs_sum = np.column_stack([
+        np.bincount(cell_ids, weights=np.abs(df[col].to_numpy()), minlength=n_cells) for col in shap_columns
+    ]) if shap_columns else np.zeros((n_cells, 0))
+
+    # Per-class score histograms, flattened as (cell, outcome, bin)
+    score_bins = score_to_bin(df["pred_prob"].to_numpy(), n_bins)
+    flat = (cell_ids * 2 + outcome) * n_bins + score_bins
+    score_hist = np.bincount(flat, minlength=n_cells * 2 * n_bins).reshape(n_cells, 2, n_bins)
+
+    # SHAP histograms as (cell, column, bin)
+    n_shap_bins = shap_edges.shape[1] - 1
+    shap_hist = np.zeros((n_cells, len(shap_columns), n_shap_bins), dtype=np.int32)
+    for i, col in enumerate(shap_columns):
+        shap_bins = np.clip(np.searchsorted(shap_edges[i], df[col].to_numpy(), side="right") - 1, 0, n_shap_bins - 1)
+        shap_hist[:, i, :] = np.bincount(cell_ids * n_shap_bins + shap_bins, minlength=n_cells * n_shap_bins).reshape(n_cells, n_shap_bins)
+
+    return {
+        "version": CUBE_VERSION,
+        "cells": cells,
+        "shap_columns": shap_columns,
+        "shap_sum": shap_sum,
+        "shap_abs_sum": shap_abs_sum,
+        "score_hist": score_hist,
+        "n_bins": n_bins,
+        "shap_edges": shap_edges,
+        "shap_hist": shap_hist,
+    }
+
+
+def score_to_bin(scores, n_bins):
+    # Scores outside [0, 1] fall into the first or last bin
+    return np.clip(np.floor(scores * n_bins), 0, n_bins - 1).astype(np.int64)
+
+
+def threshold_to_bin(threshold, n_bins):
+    # First bin counted as "predicted high risk"; the small tolerance keeps
+    # thresholds on a bin edge (e.g. 0.075 * 200) from rounding up
+    return int(np.clip(np.ceil(threshold * n_bins - 1e-6), 0, n_bins))
+
+
+def filter_masks(cube, sex, age, model, start_month, end_month, run_id, site, op_type):
+    # Cells matching each filter on its own, keyed by dimension
+    cells = cube["cells"]
+    masks = {}
+    for column, value in [("sex", sex), ("age_group", age), ("model_version", model),
+                          ("run_id", run_id), ("site", site), ("op_type", op_type)]:
+        masks[column] = (cells[column] == value).to_numpy() if value != "All" else np.ones(len(cells), dtype=bool)
+
+    start = pd.Period(start_month, freq="M")
+    end = pd.Period(end_month, freq="M")
+    masks["month"] = ((cells["month"] >= start) & (cells["month"] <= end)).to_numpy()
+    return masks
+
+
+def select_cells(cube, *filters):
+    return np.logical_and.reduce(list(filter_masks(cube, *filters).values()))
+
+
+def cube_filter_counts(cube, *filters):
+    # Records per value of every dimension under the other filters, as
+    # {dimension: Series}: what each dropdown would select if changed. The
+    # cells hold the records of every combination of values, so this is a
+    # few group sums instead of a scan of the rows.
+    cells = cube["cells"]
+    masks = filter_masks(cube, *filters)
+    counts = {}
+    for column in masks:
+        others = np.logical_and.reduce([mask for other, mask in masks.items() if other != column])
+        by_value = cells.loc[others].groupby(column, observed=True, sort=False)["count"].sum()
+        counts[column] = by_value[by_value > 0]
+    return counts
+
+
+def rollup_by_month(cube, mask, values):
+    months = cube["cells"]["month"][mask]
+    codes, index = pd.factorize(months, sort=True)
+    totals = np.zeros((len(index),) + values.shape[1:], dtype=values.dtype)
+    np.add.at(totals, codes, values[mask])
+    return pd.PeriodIndex(index, name="month"), totals
+
+
+# METRICS FROM HISTOGRAMS
+
+def auroc_from_hist(hist):
+    # Mann-Whitney statistic over binned scores; pairs sharing a bin count
+    # as ties. Works on a single (2, bins) histogram or a stack of them.
+    neg, pos = hist[..., 0, :].astype(float), hist[..., 1, :].astype(float)
+    n_neg, n_pos = neg.sum(axis=-1), pos.sum(axis=-1)
+    below = np.cumsum(neg, axis=-1) - neg
+    wins = (pos * below).sum(axis=-1) + 0.5 * (pos * neg).sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        auroc = wins / (n_pos * n_neg)
+    return np.where((n_pos > 0) & (n_neg > 0), auroc, np.nan)
+
+
+def auroc_error_bound(hist):
+    # Pairs of a positive and a negative in the same bin count as half a
+    # win, while their true contribution is anywhere from no win to a full
+    # one, so auroc_from_hist is within half their share of all pairs of
+    # the exact AUROC
+    neg, pos = hist[..., 0, :].astype(float), hist[..., 1, :].astype(float)
+    n_neg, n_pos = neg.sum(axis=-1), pos.sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        bound = 0.5 * (pos * neg).sum(axis=-1) / (n_pos * n_neg)
+    return np.where((n_pos > 0) & (n_neg > 0), bound, np.nan)
+
+
+def confusion_from_hist(hist, threshold):
+    # Exact for thresholds on a bin edge (every cutoff slider position);
+    # otherwise off by at most the records of the bin holding the threshold
+    k = threshold_to_bin(threshold, hist.shape[-1])
+    neg, pos = hist[..., 0, :], hist[..., 1, :]
+    tn, fp = neg[..., :k].sum(axis=-1), neg[..., k:].sum(axis=-1)
+    fn, tp = pos[..., :k].sum(axis=-1), pos[..., k:].sum(axis=-1)
+    return tn, fp, fn, tp
+
+
+def cube_summary_metrics(cube, mask):
+    cells = cube["cells"][mask]
+    records = int(cells["count"].sum())
+    avg_complications = cells["outcome_sum"].sum() / records if records else np.nan
+
+    auroc = float(auroc_from_hist(cube["score_hist"][mask].sum(axis=0)))
+    if np.isnan(auroc):
+        auroc = -1  # Placeholder value when the ROC AUC score is not defined
+
+    return records, avg_complications, auroc
+
+
+def cube_auroc_error_bound(cube, mask):
+    return float(auroc_error_bound(cube["score_hist"][mask].sum(axis=0)))
+
+
+def cube_monthly_auroc(cube, mask):
+    months, hist = rollup_by_month(cube, mask, cube["score_hist"])
+    auroc = auroc_from_hist(hist)
+    return pd.Series(np.where(np.isnan(auroc), None, auroc), index=months)
+
+
+def confusion_counts_from_hist(hist, thresholds):
+    # confusion_from_hist for many thresholds at once; the last axis of the
+    # results is the threshold
+    k = np.array([threshold_to_bin(threshold, hist.shape[-1]) for threshold in thresholds], dtype=np.int64)
+    below = np.concatenate([np.zeros(hist.shape[:-1] + (1,), dtype=hist.dtype), np.cumsum(hist, axis=-1)], axis=-1)
+    total = below[..., -1:]
+    tn, fn = below[..., 0, k], below[..., 1, k]
+    return tn, total[..., 0, :] - tn, fn, total[..., 1, :] - fn
+
+
+def cube_confusion_counts(cube, mask, thresholds):
+    return confusion_counts_from_hist(cube["score_hist"][mask].sum(axis=0), thresholds)
+
+
+def cube_monthly_confusion_counts(cube, mask, thresholds):
+    # Rows are thresholds, columns months, as in cube_monthly_auroc
+    _, hist = rollup_by_month(cube, mask, cube["score_hist"])
+    return tuple(values.T for values in confusion_counts_from_hist(hist, thresholds))
+
+
+def cube_monthly_score_hist(cube, mask):
+    # (month, outcome, bin) histograms, months as in cube_monthly_auroc
+    _, hist = rollup_by_month(cube, mask, cube["score_hist"])
+    return hist
+
+
+def cube_subgroup_metrics(cube, mask, dimensions, threshold):
+    # Count, complication rate, AUROC and sensitivity/specificity at the
+    # threshold for every combination of the dimensions among the selected
+    # cells, from one rollup of their histograms
+    cells = cube["cells"][mask]
+    grouped = cells.groupby(list(dimensions), observed=True, sort=True, dropna=False) if dimensions else None
+    codes = grouped.ngroup().to_numpy() if grouped is not None else np.zeros(len(cells), dtype=np.int64)
+    subgroups = grouped.size().index.to_frame(index=False) if grouped is not None else pd.DataFrame(index=[0])
+    n_subgroups = len(subgroups)
+
+    hist = np.zeros((n_subgroups,) + cube["score_hist"].shape[1:], dtype=cube["score_hist"].dtype)
+    np.add.at(hist, codes, cube["score_hist"][mask])
+    tn, fp, fn, tp = confusion_from_hist(hist, threshold)
+    return subgroup_table(subgroups, tn + fp, fn + tp, auroc_from_hist(hist), tn, fp, fn, tp)
+
+
+def subgroup_table(subgroups, n_neg, n_pos, auroc, tn, fp, fn, tp):
+    # Shared by the cube and the exact (grouped sweep) computation
+    count = n_neg + n_pos
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return subgroups.assign(
+            count=count,
+            complication_rate=np.where(count > 0, n_pos / count, np.nan),
+            auroc=auroc,
+            sensitivity=np.where(n_pos > 0, tp / (tp + fn), np.nan),
+            specificity=np.where(n_neg > 0, tn / (tn + fp), np.nan),
+        )
+
+
+def cube_shap_means(cube, mask):
+    # Mean and mean absolute SHAP value of every column. The mask is used as
+    # weights of a matrix product, which avoids copying the selected rows of
+    # the (cells, columns) sums when there are many columns.
+    weights = mask.astype(float)
+    records = weights @ cube["cells"]["count"].to_numpy()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return pd.DataFrame({
+            "mean": weights @ cube["shap_sum"] / records,
+            "mean_abs": weights @ cube["shap_abs_sum"] / records,
+        }, index=pd.Index(cube["shap_columns"], name="feature"))
+
+
+def merge_cubes(cube, other):
+    # Cubes are additive: cells present in both are summed, the others kept
+    if (cube["shap_columns"] != other["shap_columns"] or cube["n_bins"] != other["n_bins"]
+            or not np.array_equal(cube["shap_edges"], other["shap_edges"])):
+        raise ValueError("Cannot merge cubes with different SHAP columns or bins")
+
+    keys = pd.concat([cube["cells"][CUBE_DIMENSIONS], other["cells"][CUBE_DIMENSIONS]], ignore_index=True)
+    grouped = keys.groupby(CUBE_DIMENSIONS, observed=True, sort=True, dropna=False)
+    cell_ids = grouped.ngroup().to_numpy()
+    cells = grouped.size().reset_index()[CUBE_DIMENSIONS]
+    n_cells = len(cells)
+
+    # The cells of either cube are distinct, so each side is a plain
+    # scatter (np.add.at is unbuffered and much slower on large cubes)
+    first_ids, other_ids = cell_ids[:len(cube["cells"])], cell_ids[len(cube["cells"]):]
+
+    def merge(column):
+        merged = np.zeros((n_cells,) + column(cube).shape[1:], dtype=column(cube).dtype)
+        merged[first_ids] = column(cube)
+        merged[other_ids] += column(other)
+        return merged
+
+    cells["count"] = merge(lambda c: c["cells"]["count"].to_numpy())
+    cells["outcome_sum"] = merge(lambda c: c["cells"]["outcome_sum"].to_numpy())
+    cells["pred_sum"] = merge(lambda c: c["cells"]["pred_sum"].to_numpy())
+    cells["pred_sq_sum"] = merge(lambda c: c["cells"]["pred_sq_sum"].to_numpy())
+    cells["pos_pred_sum"] = merge(lambda c: c["cells"]["pos_pred_sum"].to_numpy())
+    return {
+        "version": CUBE_VERSION,
+        "cells": cells,
+        "shap_columns": cube["shap_columns"],
+        "shap_sum": merge(lambda c: c["shap_sum"]),
+        "shap_abs_sum": merge(lambda c: c["shap_abs_sum"]),
+        "score_hist": merge(lambda c: c["score_hist"]),
+        "n_bins": cube["n_bins"],
+        "shap_edges": cube["shap_edges"],
+        "shap_hist": merge(lambda c: c["shap_hist"]),
+    }
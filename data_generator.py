@@ -0,0 +1,93 @@
+# Synthetic prediction logs, following sample_data_generator.ipynb.
+#
+# Usage: python data_generator.py output.csv [--rows 1000000] [--seed 42]
+#            [--sites 4] [--models 3] [--runs 5] [--shap-features 6]
+
+# IMPORTS
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+
+# SYNTHETIC DATA
+
+SITES = ["NSEC", "WANS", "NHTC", "HEXH"]
+
+# Mean and standard deviation of the SHAP values of each feature
+SHAP_FEATURES = {
+    "ASA_Grade": (0.2, 0.15),
+    "Creatinine": (0.18, 0.12),
+    "Haemoglobin": (0.17, 0.12),
+    "Hypertension": (0.045, 0.07),
+    "COPD": (0.045, 0.07),
+    "Age": (0.1, 0.07),
+}
+
+START_DATE = "2022-07-01"
+END_DATE = "2023-04-30"
+
+
+def numbered(names, count, template):
+    # The known names first, then numbered ones
+    return (list(names) + [template.format(i) for i in range(len(names) + 1, count + 1)])[:count]
+
+
+def generate_data(n_samples, seed=42, n_sites=4, n_models=3, n_runs=5, n_shap_features=6,
+                  start_date=START_DATE, end_date=END_DATE):
+    # seed may be an integer or a np.random.SeedSequence
+    rng = np.random.default_rng(seed)
+
+    outcome = rng.binomial(1, 0.075, n_samples)
+    pred_prob = np.clip(rng.normal(0.075, 0.05, n_samples), 0, 1)
+    pred_prob[outcome == 1] += rng.normal(0, 0.01, int(outcome.sum()))  # Noise based on the outcome
+
+    start_date = pd.Timestamp(start_date)
+    date_range = (pd.Timestamp(end_date) - start_date).days
+
+    data = pd.DataFrame({
+        "model_version": rng.choice(numbered([], n_models, "v{}"), n_samples),
+        "outcome": outcome,
+        "pred_prob": pred_prob,
+        "sex": rng.choice(["Male", "Female"], n_samples),
+        "age": np.clip(rng.normal(65, 10, n_samples).astype(int), 40, 90),
+        "date": start_date + pd.to_timedelta(rng.integers(0, date_range, n_samples), unit="D"),
+        "run_id": rng.choice(numbered([], n_runs, "Run {}"), n_samples),
+        "site": rng.choice(numbered(SITES, n_sites, "SITE{}"), n_samples),
+        "op_type": rng.choice(["knee", "hip"], n_samples),
+    })
+
+    # Added at once; inserting hundreds of columns one by one fragments the frame
+    shap_values = {}
+    for feature in numbered(SHAP_FEATURES, n_shap_features, "Feature_{}"):
+        mean, std_dev = SHAP_FEATURES.get(feature, (0.05, 0.05))
+        shap_values["SHAP_" + feature] = rng.normal(mean, std_dev, n_samples)
+    return pd.concat([data, pd.DataFrame(shap_values, index=data.index)], axis=1)
+
+
+def write_data(csv_file_path, n_samples, seed=42, chunksize=1_000_000, **options):
+    # Generated and written chunk by chunk, so memory does not grow with
+    # n_samples; every chunk gets its own stream derived from the seed
+    n_chunks = max(1, -(-n_samples // chunksize))
+    seeds = np.random.SeedSequence(seed).spawn(n_chunks)
+    for i, chunk_seed in enumerate(seeds):
+        n_rows = min(chunksize, n_samples - i * chunksize)
+        chunk = generate_data(n_rows, seed=chunk_seed, **options)
+        chunk.to_csv(csv_file_path, mode="w" if i == 0 else "a", header=i == 0, index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output")
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--sites", type=int, default=4)
+    parser.add_argument("--models", type=int, default=3)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--shap-features", type=int, default=6)
+    parser.add_argument("--chunksize", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    write_data(args.output, args.rows, seed=args.seed, chunksize=args.chunksize, n_sites=args.sites,
+               n_models=args.models, n_runs=args.runs, n_shap_features=args.shap_features)
@@ -0,0 +1,255 @@
+# Data sources of the prediction log.
+#
+# Usage: python data_source.py <log.csv> <log.sqlite>
+#
+# Imports a CSV prediction log into a SQLite database (appending to it if
+# it exists) with the indexes the queries below use.
+
+# IMPORTS
+
+import argparse
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+from helpers import (
+    AGE_BINS,
+    AGE_GROUPS,
+    log_dtypes,
+    prepare_data,
+    filter_df,
+    calculate_summary_metrics,
+    calculate_metrics,
+    calculate_threshold_sweep,
+    calculate_monthly_sweep,
+    calculate_grouped_sweep,
+    calculate_grouped_auroc,
+    calculate_grouped_sensitivity_specificity
+)
+from filter_index import build_filter_index, query_filter_index
+
+
+# DATA SOURCES
+#
+# Both sources take the sidebar filters and return what the helpers of the
+# same name return for the filtered frame; select returns the positions of
+# the selected rows in the frame. The app runs its row-level stages
+# (selection, summary metrics, threshold and monthly sweeps) on them.
+# PandasSource works on the frame in memory (or memory-mapped) with the
+# filter index, and takes only the columns a stage needs. SQLiteSource keeps
+# the log in an on-disk SQLite database that other jobs append to: filters,
+# month grouping, record counts, outcome sums and SHAP means run as indexed
+# queries, and only the outcome and score columns of the selected rows are
+# fetched, for the AUROC and the sensitivity and specificity sweeps.
+
+SQLITE_TABLE = "predictions"
+SQLITE_SUFFIXES = (".sqlite", ".sqlite3", ".db")
+# Indexes of the filter columns; the date index also holds the outcome and
+# the score, so fetching the scores of a range of months reads only the index
+SQLITE_INDEXES = {
+    "date": ["date", "outcome", "pred_prob"],
+    "sex": ["sex"],
+    "age": ["age"],
+    "model_version": ["model_version"],
+    "run_id": ["run_id"],
+    "site": ["site"],
+    "op_type": ["op_type"],
+}
+
+
+def is_sqlite_path(path):
+    return path.lower().endswith(SQLITE_SUFFIXES)
+
+
+def shap_columns(columns):
+    return [col for col in columns if col.startswith("SHAP_")]
+
+
+def months_of(scores):
+    # Parsing the few distinct months is much cheaper than every row's
+    codes, unique_months = pd.factorize(scores["month"])
+    return pd.Series(pd.PeriodIndex(unique_months, freq="M").take(codes), name="month")
+
+
+class PandasSource:
+    def __init__(self, df, index=None, selection=None):
+        self.df = df
+        self.index = index if index is not None else build_filter_index(df)
+        # Optional function of the filters returning the selected positions,
+        # e.g. the app's cached selection, which the stages then share
+        self.selection = selection
+
+    def select(self, *filters):
+        if self.selection is not None:
+            return self.selection(*filters)
+        return query_filter_index(self.index, *filters)
+
+    def rows(self, columns, *filters):
+        return self.df[columns].take(self.select(*filters))
+
+    def filter_df(self, *filters):
+        if self.selection is None:
+            return filter_df(self.df, *filters, index=self.index)
+        return self.df.take(self.select(*filters))
+
+    def calculate_summary_metrics(self, *filters):
+        return calculate_summary_metrics(self.rows(["outcome", "pred_prob"], *filters))
+
+    def calculate_threshold_sweep(self, *filters):
+        return calculate_threshold_sweep(self.rows(["outcome", "pred_prob"], *filters))
+
+    def calculate_monthly_sweep(self, *filters):
+        return calculate_monthly_sweep(self.rows(["date", "outcome", "pred_prob"], *filters))
+
+    def calculate_metrics(self, cutoff_threshold, *filters):
+        return calculate_metrics(self.filter_df(*filters), cutoff_threshold)
+
+    def calculate_monthly_counts(self, *filters):
+        filtered_df = self.filter_df(*filters)
+        months = filtered_df["date"].dt.to_period("M").rename("month")
+        return filtered_df.groupby(months)["outcome"].agg(records="size", complications="sum")
+
+    def calculate_shap_means(self, *filters):
+        filtered_df = self.filter_df(*filters)
+        return filtered_df[shap_columns(filtered_df.columns)].astype(float).mean()
+
+
+class SQLiteSource:
+    def __init__(self, path, table=SQLITE_TABLE):
+        self.path = path
+        self.table = table
+        self.local = threading.local()
+        # Rowids of the rows read by read_rows, in order: the frame they were
+        # read into. Once rows have been read, queries only see those.
+        self.rowids = np.empty(0, dtype=np.int64)
+
+    def connection(self):
+        # SQLite connections are not shared between threads; every thread
+        # running callbacks opens its own
+        if not hasattr(self.local, "connection"):
+            self.local.connection = sqlite3.connect(self.path)
+        return self.local.connection
+
+    def query(self, sql, params=()):
+        return pd.read_sql_query(sql, self.connection(), params=params)
+
+    def columns(self):
+        return [row[1] for row in self.connection().execute(f'PRAGMA table_info("{self.table}")')]
+
+    def where(self, sex, age, model, start_month, end_month, run_id, site, op_type):
+        # Dates are stored as YYYY-MM-DD text, so the months are a range of
+        # the date index; age groups are ranges of ages
+        start = pd.Period(start_month, freq="M").start_time.strftime("%Y-%m-%d")
+        end = (pd.Period(end_month, freq="M") + 1).start_time.strftime("%Y-%m-%d")
+        clauses, params = ["date >= ?", "date < ?"], [start, end]
+        for column, value in [("sex", sex), ("model_version", model), ("run_id", run_id), ("site", site), ("op_type", op_type)]:
+            if value != "All":
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if age != "All":
+            i = AGE_GROUPS.index(age)
+            clauses.append("age >= ? AND age < ?")
+            params += [AGE_BINS[i], AGE_BINS[i + 1]]
+        if len(self.rowids):
+            clauses.append("rowid <= ?")
+            params.append(int(self.rowids[-1]))
+        return " AND ".join(clauses), params
+
+    def read_rows(self, after=0):
+        # Rows inserted after the given rowid and the last rowid read, so
+        # rows appended by other jobs can be picked up incrementally
+        frame = self.query(f'SELECT rowid AS row_id, * FROM "{self.table}" WHERE rowid > ? ORDER BY rowid', [after])
+        last = int(frame["row_id"].iloc[-1]) if len(frame) else after
+        rowids = frame.pop("row_id").to_numpy(dtype=np.int64)
+        self.rowids = rowids if after == 0 else np.concatenate([self.rowids, rowids])
+        return frame.astype(log_dtypes(frame.columns)), last
+
+    def select(self, *filters, rows=None):
+        # Positions among the first rows rows read (all by default), so a
+        # selection never holds rows not appended to the frame yet
+        rowids = self.rowids if rows is None else self.rowids[:rows]
+        if not len(rowids):
+            return np.empty(0, dtype=np.int64)
+        where, params = self.where(*filters)
+        selected = self.connection().execute(
+            f'SELECT rowid FROM "{self.table}" WHERE {where} AND rowid <= ? ORDER BY rowid', params + [int(rowids[-1])])
+        return np.searchsorted(rowids, np.fromiter((row[0] for row in selected), dtype=np.int64))
+
+    def filter_df(self, *filters):
+        where, params = self.where(*filters)
+        frame = self.query(f'SELECT * FROM "{self.table}" WHERE {where}', params)
+        return prepare_data(frame.astype(log_dtypes(frame.columns)))
+
+    def fetch_scores(self, *filters):
+        where, params = self.where(*filters)
+        return self.query(f'SELECT substr(date, 1, 7) AS month, outcome, pred_prob FROM "{self.table}" WHERE {where}', params)
+
+    def calculate_summary_metrics(self, *filters):
+        where, params = self.where(*filters)
+        records, complications = self.connection().execute(
+            f'SELECT COUNT(*), SUM(outcome) FROM "{self.table}" WHERE {where}', params).fetchone()
+        if not records or complications in (0, records):
+            auroc = -1  # Placeholder value when the ROC AUC score is not defined
+            return records, complications / records if records else np.nan, auroc
+        return calculate_summary_metrics(self.fetch_scores(*filters))
+
+    def calculate_threshold_sweep(self, *filters):
+        return calculate_threshold_sweep(self.fetch_scores(*filters))
+
+    def calculate_monthly_sweep(self, *filters):
+        scores = self.fetch_scores(*filters)
+        return calculate_grouped_sweep(scores, months_of(scores))
+
+    def calculate_metrics(self, cutoff_threshold, *filters):
+        scores = self.fetch_scores(*filters)
+        _, avg_complications, auroc = calculate_summary_metrics(scores)
+        monthly_sweep = calculate_grouped_sweep(scores, months_of(scores))
+        monthly_auroc = calculate_grouped_auroc(monthly_sweep)
+        monthly_sensitivity_specificity = calculate_grouped_sensitivity_specificity(monthly_sweep, cutoff_threshold)
+        return avg_complications, auroc, monthly_auroc, monthly_sensitivity_specificity
+
+    def calculate_monthly_counts(self, *filters):
+        where, params = self.where(*filters)
+        counts = self.query(f'SELECT substr(date, 1, 7) AS month, COUNT(*) AS records, SUM(outcome) AS complications '
+                            f'FROM "{self.table}" WHERE {where} GROUP BY month ORDER BY month', params)
+        counts.index = pd.PeriodIndex(counts.pop("month"), freq="M", name="month")
+        return counts
+
+    def calculate_shap_means(self, *filters):
+        where, params = self.where(*filters)
+        columns = shap_columns(self.columns())
+        averages = ", ".join(f'AVG("{col}")' for col in columns)
+        row = self.connection().execute(f'SELECT {averages} FROM "{self.table}" WHERE {where}', params).fetchone()
+        return pd.Series([np.nan if value is None else value for value in row], index=columns, dtype=float)
+
+
+def write_sqlite(df, path, table=SQLITE_TABLE):
+    # Appends rows of the prediction log, creating the table and its
+    # indexes on first use
+    rows = df.drop(columns=["age_group"], errors="ignore")
+    rows = rows.assign(date=pd.to_datetime(rows["date"]).dt.strftime("%Y-%m-%d"))
+    with sqlite3.connect(path) as connection:
+        rows.to_sql(table, connection, if_exists="append", index=False)
+        for name, columns in SQLITE_INDEXES.items():
+            connection.execute(f'CREATE INDEX IF NOT EXISTS "{table}_{name}" ON "{table}" ({", ".join(columns)})')
+    connection.close()
+
+
+def import_csv(csv_file_path, path, table=SQLITE_TABLE, chunksize=1_000_000):
+    for chunk in pd.read_csv(csv_file_path, chunksize=chunksize):
+        write_sqlite(chunk, path, table)
+    # Index statistics let SQLite pick the most selective index of a query
+    with sqlite3.connect(path) as connection:
+        connection.execute("ANALYZE")
+    connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import a CSV prediction log into SQLite")
+    parser.add_argument("csv_file_path")
+    parser.add_argument("path")
+    parser.add_argument("--table", default=SQLITE_TABLE)
+    args = parser.parse_args()
+    import_csv(args.csv_file_path, args.path, args.table)
@@ -0,0 +1,234 @@
+# IMPORTS
+
+import collections
+import contextvars
+import functools
+import glob
+import logging
+import os
+import threading
+import time
+
+from helpers import (
+    prepare_data,
+    create_filter_options,
+    merge_filter_options,
+    concat_frames,
+    read_batch
+)
+from columnar import cache_lock, read_columns, read_manifest
+from streaming import append_batches, read_cube
+from filter_index import build_filter_index, append_to_filter_index, filter_index_length
+from cube import build_cube, merge_cubes
+
+logger = logging.getLogger(__name__)
+
+
+# DATA STORE
+#
+# Holds the prediction log together with everything derived from it (filter
+# index, cube, filter options). New prediction batches are appended in
+# place: only the batch is indexed and aggregated, then merged into the
+# existing structures, and published as a new snapshot in one assignment.
+# Readers work on one snapshot from start to end (see read), so positions
+# from its index and cells from its cube always match its rows. A log
+# mapped from a streamed columnar cache takes new batches into the cache:
+# the first process to see a batch appends it to the column files and the
+# cube under the cache lock, and every process then maps the longer
+# columns.
+
+# Suffix of drop directory files that could not be ingested; they are left
+# for inspection instead of being retried
+FAILED_SUFFIX = ".failed"
+
+
+def quarantine(path):
+    try:
+        os.replace(path, path + FAILED_SUFFIX)
+    except OSError:
+        pass  # Moved aside by another process
+
+
+def batch_paths(directory, ingested):
+    # The CSV files in the drop directory that have not been ingested yet, in
+    # file name order. Writers must move complete files into place.
+    return [path for path in sorted(glob.glob(os.path.join(directory, "*.csv")))
+            if os.path.basename(path) not in ingested]
+
+
+def read_batches(paths, columns):
+    batches = []
+    for path in paths:
+        try:
+            batches.append((os.path.basename(path), read_batch(path, columns)))
+        except Exception:
+            logger.exception("Could not ingest %s, moving it to %s%s", path, path, FAILED_SUFFIX)
+            quarantine(path)
+    return batches
+
+
+def append_directory(cache_dir, directory):
+    # Appends the batches in the drop directory that the cache does not hold
+    # yet and returns their row count; callers hold the cache lock.
+    # The gunicorn master calls it before forking, so batches that arrived
+    # while the app was down are not indexed by every worker on its own.
+    manifest = read_manifest(cache_dir)
+    columns = [entry["name"] for entry in manifest["columns"]]
+    batches = read_batches(batch_paths(directory, set(manifest.get("batches", []))), columns)
+    if not batches:
+        return 0
+    return append_batches(cache_dir, batches) - manifest["length"]
+
+
+class DataSnapshot(collections.namedtuple("DataSnapshot", [
+        "df", "filter_index", "cube", "filter_options", "version", "ingested_files", "source_position"])):
+    # The log and everything derived from it at one version; never changed
+    # once published. Compared and hashed by identity, so caches can be keyed
+    # by the snapshot their entries were computed from.
+    __slots__ = ()
+    __hash__ = object.__hash__
+    __eq__ = object.__eq__
+    __ne__ = object.__ne__
+
+
+class DataStore:
+    def __init__(self, df, with_cube=True, cube=None, filter_index=None, cache_dir=None, source_position=0):
+        self.ingest_lock = threading.Lock()
+        self.listeners = []
+        self.ingested_files = set()
+        # Streamed cache that df is mapped from and batches are appended to
+        self.cache_dir = cache_dir
+        # The snapshot pinned by the running reader (see read)
+        self.pinned = contextvars.ContextVar("snapshot", default=None)
+
+        filter_index = filter_index if filter_index is not None else build_filter_index(df)
+        indexed = filter_index_length(filter_index)
+        if indexed < len(df):
+            # A saved index covers the rows before the batches appended to the cache
+            filter_index = append_to_filter_index(filter_index, df.iloc[indexed:], indexed)
+        if with_cube and cube is None:
+            cube = build_cube(df)
+        if cache_dir is not None:
+            self.ingested_files.update(read_manifest(cache_dir).get("batches", []))
+        # source_position is the last row read from a SQL prediction log (see
+        # ingest_source)
+        self.snapshot = DataSnapshot(df, filter_index, cube if with_cube else None, create_filter_options(df), 0,
+                                     frozenset(self.ingested_files), source_position)
+
+    def on_update(self, listener):
+        self.listeners.append(listener)
+        return listener
+
+    def current(self):
+        # The snapshot of the running reader, or else the latest one
+        snapshot = self.pinned.get()
+        return snapshot if snapshot is not None else self.snapshot
+
+    def read(self, function):
+        # Decorates a reader, which then works on the snapshot published when
+        # it started, and so does everything it calls on its thread (or in a
+        # copy of its context)
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if self.pinned.get() is not None:
+                return function(*args, **kwargs)
+            token = self.pinned.set(self.snapshot)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.pinned.reset(token)
+        return wrapper
+
+    def extend(self, df, cube, source_position=None):
+        # Publishes df, whose rows past the current ones are new, with the
+        # cube that counts them; only the new rows are indexed. Writers hold
+        # the ingest lock.
+        current = self.snapshot
+        offset = len(current.df)
+        rows = df.iloc[offset:]
+        filter_index = append_to_filter_index(current.filter_index, rows, offset)
+        filter_options = merge_filter_options(current.filter_options, create_filter_options(rows))
+        self.snapshot = DataSnapshot(
+            df, filter_index, cube, filter_options, current.version + 1, frozenset(self.ingested_files),
+            source_position if source_position is not None else current.source_position)
+
+        for listener in self.listeners:
+            listener(self)
+        return len(rows)
+
+    def append(self, batches, source_position=None):
+        # Prepared batches, joined to the log with a single copy
+        batches = [batch for batch in batches if len(batch)]
+        if not batches:
+            return 0
+        current = self.snapshot
+        batch = concat_frames(batches) if len(batches) > 1 else batches[0]
+        cube = (merge_cubes(current.cube, build_cube(batch, shap_edges=current.cube["shap_edges"]))
+                if current.cube is not None else None)
+        return self.extend(concat_frames([current.df, batch]), cube, source_position)
+
+    def remap(self):
+        # Maps the rows appended to the cache since the last call, by this
+        # process or another one; callers hold the cache lock
+        current = self.snapshot
+        manifest = read_manifest(self.cache_dir)
+        self.ingested_files.update(manifest.get("batches", []))
+        if manifest["length"] == len(current.df):
+            return 0
+        df = read_columns(self.cache_dir)
+        cube = None
+        if current.cube is not None:
+            cube = read_cube(self.cache_dir, len(df))
+            if cube is None:
+                # The cache holds a stale cube
+                rows = df.iloc[len(current.df):]
+                cube = merge_cubes(current.cube, build_cube(rows, shap_edges=current.cube["shap_edges"]))
+        return self.extend(df, cube)
+
+    def ingest_directory(self, directory):
+        # Ingest every new CSV file in the drop directory (see batch_paths)
+        with self.ingest_lock:
+            if self.cache_dir is not None:
+                with cache_lock(self.cache_dir):
+                    append_directory(self.cache_dir, directory)
+                    return self.remap()
+
+            batches = read_batches(batch_paths(directory, self.ingested_files), list(self.snapshot.df.columns))
+            self.ingested_files.update(name for name, _ in batches)
+            return self.append([batch for _, batch in batches])
+
+    def ingest_source(self, source):
+        # Append the rows other jobs inserted into a SQL prediction log since
+        # the last call
+        with self.ingest_lock:
+            batch, position = source.read_rows(after=self.snapshot.source_position)
+            if not len(batch):
+                return 0
+            # Published with the rows, so rows that fail are read again
+            return self.append([prepare_data(batch)], source_position=position)
+
+    def watch_source(self, source, interval=30):
+        def watch():
+            while True:
+                try:
+                    self.ingest_source(source)
+                except Exception:
+                    logger.exception("Could not read new rows from %s", source.path)
+                time.sleep(interval)
+
+        thread = threading.Thread(target=watch, name="source-watcher", daemon=True)
+        thread.start()
+        return thread
+
+    def watch_directory(self, directory, interval=30):
+        def watch():
+            while True:
+                try:
+                    self.ingest_directory(directory)
+                except Exception:
+                    logger.exception("Could not ingest the batches in %s", directory)
+                time.sleep(interval)
+
+        thread = threading.Thread(target=watch, name="ingest-watcher", daemon=True)
+        thread.start()
+        return thread
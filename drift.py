@@ -0,0 +1,118 @@
+# IMPORTS
+
+import numpy as np
+import pandas as pd
+
+from cube import SCORE_BINS
+
+
+# DRIFT STATISTICS
+#
+# Drift of the predicted risk and of every SHAP column against a reference
+# period, from the fixed-bin histograms of the cube: the population
+# stability index (PSI), the Kolmogorov-Smirnov distance between the binned
+# distributions, and the shift of the mean in reference standard deviations.
+# Nothing is read from the rows, so the statistics follow new batches as
+# soon as they are merged into the cube.
+
+PSI_BINS = 10
+PSI_FLOOR = 1e-4
+
+
+def feature_histograms(cube):
+    # (name, per-cell histograms, per-cell sums, bin centers) of every
+    # monitored column
+    score_edges = np.linspace(0, 1, SCORE_BINS + 1)
+    yield ("pred_prob", cube["score_hist"].sum(axis=1), cube["cells"]["pred_sum"].to_numpy(),
+           (score_edges[1:] + score_edges[:-1]) / 2)
+    for i, col in enumerate(cube["shap_columns"]):
+        edges = cube["shap_edges"][i]
+        yield col, cube["shap_hist"][:, i, :], cube["shap_sum"][:, i], (edges[1:] + edges[:-1]) / 2
+
+
+def quantile_bins(reference, n_bins=PSI_BINS):
+    # Start of every coarse bin so that each holds about 1 / n_bins of the
+    # reference; PSI over hundreds of sparse fine bins is mostly noise
+    cumulative = np.cumsum(reference) / max(reference.sum(), 1)
+    coarse = np.minimum((np.concatenate([[0], cumulative[:-1]]) * n_bins).astype(np.int64), n_bins - 1)
+    return np.flatnonzero(np.diff(coarse, prepend=-1))
+
+
+def population_stability_index(reference, current, starts):
+    reference = np.add.reduceat(reference, starts, axis=-1).astype(float)
+    current = np.add.reduceat(current, starts, axis=-1).astype(float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = np.maximum(reference / reference.sum(axis=-1, keepdims=True), PSI_FLOOR)
+        q = np.maximum(current / current.sum(axis=-1, keepdims=True), PSI_FLOOR)
+    return ((q - p) * np.log(q / p)).sum(axis=-1)
+
+
+def ks_distance(reference, current):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        reference_cdf = np.cumsum(reference, axis=-1) / reference.sum(axis=-1, keepdims=True)
+        current_cdf = np.cumsum(current, axis=-1) / current.sum(axis=-1, keepdims=True)
+    return np.abs(reference_cdf - current_cdf).max(axis=-1)
+
+
+def standard_deviation(hist, centers):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = (hist * centers).sum(axis=-1) / hist.sum(axis=-1)
+        return np.sqrt((hist * (centers - mean[..., None]) ** 2).sum(axis=-1) / hist.sum(axis=-1))
+
+
+def sum_by_group(codes, n_groups, values):
+    totals = np.zeros((n_groups,) + values.shape[1:], dtype=values.dtype)
+    np.add.at(totals, codes, values)
+    return totals
+
+
+def cube_drift(cube, current_mask, reference_mask, by="month"):
+    # One row per group of the current cells and monitored column. Months
+    # are compared with the whole reference period, subgroups (by is a cube
+    # dimension) with the same subgroup in the reference period.
+    cells = cube["cells"]
+    current_codes, groups = pd.factorize(cells[by][current_mask], sort=True)
+    if by == "month":
+        reference_codes, reference_index = np.zeros(reference_mask.sum(), dtype=np.int64), np.zeros(len(groups), dtype=np.int64)
+        n_reference = 1
+    else:
+        reference_codes, reference_groups = pd.factorize(cells[by][reference_mask], sort=True)
+        reference_index, n_reference = reference_groups.get_indexer(groups), len(reference_groups)
+    counts = sum_by_group(current_codes, len(groups), cells["count"].to_numpy()[current_mask])
+    reference_counts = sum_by_group(reference_codes, n_reference, cells["count"].to_numpy()[reference_mask])
+
+    frames = []
+    for name, hist, sums, centers in feature_histograms(cube):
+        current = sum_by_group(current_codes, len(groups), hist[current_mask])
+        reference = sum_by_group(reference_codes, n_reference, hist[reference_mask])
+        current_sum = sum_by_group(current_codes, len(groups), sums[current_mask])
+        reference_sum = sum_by_group(reference_codes, n_reference, sums[reference_mask])
+
+        # Groups missing from the reference period get an empty reference
+        missing = reference_index < 0
+        matched = reference[np.where(missing, 0, reference_index)] * ~missing[:, None]
+        matched_sum = reference_sum[np.where(missing, 0, reference_index)] * ~missing
+        matched_count = reference_counts[np.where(missing, 0, reference_index)] * ~missing
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean_shift = (current_sum / counts - matched_sum / matched_count) / standard_deviation(matched, centers)
+        frames.append(pd.DataFrame({
+            "group": groups.astype(str),
+            "feature": name,
+            "count": counts,
+            "reference_count": matched_count,
+            "psi": population_stability_index(matched, current, quantile_bins(reference.sum(axis=0))),
+            "ks": ks_distance(matched, current),
+            "mean_shift": mean_shift,
+        }))
+    drift = pd.concat(frames, ignore_index=True)
+    undefined = (drift["count"] == 0) | (drift["reference_count"] == 0)
+    drift.loc[undefined, ["psi", "ks", "mean_shift"]] = np.nan
+    return drift
+
+
+def drift_alerts(drift, psi_limit, ks_limit, mean_shift_limit, min_count=0):
+    # Rows over any limit, with enough records on both sides, worst PSI first
+    enough = (drift["count"] >= min_count) & (drift["reference_count"] >= min_count)
+    over = (drift["psi"] >= psi_limit) | (drift["ks"] >= ks_limit) | (drift["mean_shift"].abs() >= mean_shift_limit)
+    return drift[enough & over].sort_values(["psi", "ks"], ascending=False, kind="stable").reset_index(drop=True)
@@ -0,0 +1,80 @@
+# IMPORTS
+
+import numpy as np
+import pandas as pd
+
+from cube import cube_shap_means
+
+
+# SHAP EXPLAINABILITY
+#
+# Rankings come from the per-cell SHAP sums of the cube, so ranking any
+# selection is one weighted sum per column and a partial selection of the
+# top k, whatever the number of rows. Distributions come from a bounded
+# random sample of the selected rows, read for the top k columns only, so
+# their cost does not grow with the selection or the number of columns.
+
+SHAP_TOP_K = 5
+SHAP_SAMPLE_SIZE = 5000
+SHAP_POINTS = 200
+SHAP_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+SHAP_RANKINGS = {"mean": "Average SHAP value", "mean_abs": "Average |SHAP value|"}
+
+
+def top_k(values, k):
+    # Positions of the k largest values, largest first; argpartition is
+    # linear in the number of values, only the k selected ones are sorted
+    values = np.where(np.isnan(values), -np.inf, values)
+    if k < len(values):
+        selected = np.argpartition(-values, k - 1)[:k]
+    else:
+        selected = np.arange(len(values))
+    return selected[np.argsort(-values[selected], kind="stable")]
+
+
+def shap_ranking(cube, mask, by="mean", k=SHAP_TOP_K):
+    # Mean and mean absolute SHAP value of the k columns ranking highest by
+    # either of them
+    means = cube_shap_means(cube, mask)
+    return means.iloc[top_k(means[by].to_numpy(), k)]
+
+
+def sample_positions(positions, size=SHAP_SAMPLE_SIZE, seed=0):
+    # Uniform sample without replacement, in row order; the same selection
+    # always gives the same sample
+    if len(positions) <= size:
+        return positions
+    rng = np.random.default_rng(seed)
+    return np.sort(positions[rng.choice(len(positions), size, replace=False)])
+
+
+def shap_distributions(df, positions, columns, n_points=SHAP_POINTS, quantiles=SHAP_QUANTILES):
+    # Quantiles of the given SHAP columns over the sampled rows, and about
+    # n_points of those rows, evenly spread over the sample, with their
+    # predicted risk for a beeswarm plot
+    sample = df[list(columns) + ["pred_prob"]].take(positions)
+    values = sample[list(columns)].to_numpy(dtype=float)
+    if len(sample):
+        summary = np.nanquantile(values, quantiles, axis=0).T
+    else:
+        summary = np.full((len(columns), len(quantiles)), np.nan)
+    return (pd.DataFrame(summary, index=pd.Index(columns, name="feature"), columns=list(quantiles)),
+            sample.iloc[::max(len(sample) // n_points, 1)].head(n_points).reset_index(drop=True))
+
+
+def subgroup_shap_means(cube, mask, dimension, columns, by="mean"):
+    # Mean (or mean absolute) SHAP value of the given columns per value of a
+    # cube dimension, as a (groups, columns) frame
+    cells = cube["cells"]
+    codes, groups = pd.factorize(cells[dimension][mask], sort=True)
+    positions = [cube["shap_columns"].index(col) for col in columns]
+    sums = cube["shap_sum" if by == "mean" else "shap_abs_sum"][np.ix_(mask, positions)]
+
+    # Cells without a value of the dimension (code -1) are left out
+    known = codes >= 0
+    totals = np.zeros((len(groups), len(positions)))
+    counts = np.zeros(len(groups))
+    np.add.at(totals, codes[known], sums[known])
+    np.add.at(counts, codes[known], cells["count"].to_numpy()[mask][known])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return pd.DataFrame(totals / counts[:, None], index=pd.Index(groups.astype(str), name=dimension), columns=columns)
@@ -0,0 +1,146 @@
+# IMPORTS
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from columnar import make_staging_directory, publish_directory
+
+
+# FILTER INDEX
+#
+# Built once at load: rows are ordered by date so a month range is a binary
+# search, and every value of a filter dimension has a packed bitmap over
+# that order. A query ANDs only the bytes inside the month range and returns
+# row positions, without copying any column of the frame. Appended batches
+# get segments of their own over the rows that follow, so history is never
+# re-sorted or re-encoded; segments of similar size are merged, which keeps
+# their number logarithmic in the number of appended rows.
+
+INDEX_DIMENSIONS = ["sex", "age_group", "model_version", "run_id", "site", "op_type"]
+INDEX_FILE = "index.json"
+
+
+def build_filter_index(df):
+    dates = pd.to_datetime(df["date"]).to_numpy()
+    order = np.argsort(dates, kind="stable")
+
+    bitmaps = {}
+    for column in INDEX_DIMENSIONS:
+        codes, values = pd.factorize(df[column].to_numpy()[order])
+        bitmaps[column] = {value: np.packbits(codes == code) for code, value in enumerate(values)}
+
+    return {"order": order, "dates": dates[order], "bitmaps": bitmaps}
+
+
+def month_range_bounds(index, start_month, end_month):
+    # The end month is inclusive, so search for the start of the following month
+    start_date = np.datetime64(pd.to_datetime(start_month))
+    end_date = np.datetime64(pd.to_datetime(end_month) + pd.offsets.MonthBegin(1))
+    lo = np.searchsorted(index["dates"], start_date, side="left")
+    hi = np.searchsorted(index["dates"], end_date, side="left")
+    return lo, max(lo, hi)
+
+
+def query_segment(index, sex, age, model, start_month, end_month, run_id, site, op_type):
+    lo, hi = month_range_bounds(index, start_month, end_month)
+    byte_lo, byte_hi = lo // 8, -(-hi // 8)
+
+    selected = None
+    for column, value in zip(INDEX_DIMENSIONS, [sex, age, model, run_id, site, op_type]):
+        if value == "All":
+            continue
+        bitmap = index["bitmaps"][column].get(value)
+        if bitmap is None:
+            return np.empty(0, dtype=np.int64)
+        selected = bitmap[byte_lo:byte_hi] if selected is None else selected & bitmap[byte_lo:byte_hi]
+
+    candidates = index["order"][lo:hi]
+    if selected is not None:
+        bits = np.unpackbits(selected)[lo - byte_lo * 8:hi - byte_lo * 8]
+        candidates = candidates[bits.view(bool)]
+
+    # Return positions in the original row order
+    return np.sort(candidates)
+
+
+def query_filter_index(index, *filters):
+    # Every segment covers the rows after those of the one before, so their
+    # sorted positions concatenate in row order
+    segments = [index] + index.get("segments", [])
+    return np.concatenate([query_segment(segment, *filters).astype(np.int64, copy=False) for segment in segments])
+
+
+def merge_segments(first, second):
+    # One segment over the rows of two consecutive ones
+    dates = np.concatenate([first["dates"], second["dates"]])
+    order = np.argsort(dates, kind="stable")
+    n_first, n_second = len(first["dates"]), len(second["dates"])
+
+    bitmaps = {}
+    for column in INDEX_DIMENSIONS:
+        bitmaps[column] = {}
+        for value in list(first["bitmaps"][column]) + [value for value in second["bitmaps"][column]
+                                                       if value not in first["bitmaps"][column]]:
+            bits = [np.unpackbits(segment["bitmaps"][column][value], count=n) if value in segment["bitmaps"][column]
+                    else np.zeros(n, dtype=np.uint8) for segment, n in [(first, n_first), (second, n_second)]]
+            bitmaps[column][value] = np.packbits(np.concatenate(bits)[order])
+
+    return {"order": np.concatenate([first["order"], second["order"]])[order], "dates": dates[order], "bitmaps": bitmaps}
+
+
+def append_to_filter_index(index, batch, offset):
+    # Index a batch whose rows start at position offset as a new segment
+    segment = build_filter_index(batch)
+    segment["order"] = segment["order"] + offset
+    segments = index.get("segments", []) + [segment]
+    while len(segments) > 1 and len(segments[-2]["order"]) <= len(segments[-1]["order"]):
+        segments[-2:] = [merge_segments(*segments[-2:])]
+    return dict(index, segments=segments)
+
+
+def filter_index_length(index):
+    return sum(len(segment["order"]) for segment in [index] + index.get("segments", []))
+
+
+def write_filter_index(index, directory):
+    # One file for the order, one for the dates and one 2-D array of packed
+    # bitmaps per dimension, so the index can be memory-mapped like the columns
+    tmp_dir = make_staging_directory(directory)
+    np.save(os.path.join(tmp_dir, "order.npy"), index["order"], allow_pickle=False)
+    np.save(os.path.join(tmp_dir, "dates.npy"), index["dates"], allow_pickle=False)
+
+    values = {}
+    for column in INDEX_DIMENSIONS:
+        bitmaps = index["bitmaps"][column]
+        values[column] = [value.item() if isinstance(value, np.generic) else value for value in bitmaps]
+        matrix = np.stack(list(bitmaps.values())) if bitmaps else np.empty((0, 0), dtype=np.uint8)
+        np.save(os.path.join(tmp_dir, f"{column}.npy"), matrix, allow_pickle=False)
+
+    with open(os.path.join(tmp_dir, INDEX_FILE), "w") as f:
+        json.dump({"values": values}, f)
+    publish_directory(tmp_dir, directory)
+
+
+def read_filter_index(directory, mmap_mode="r"):
+    # Resolved once, like read_columns, so every file comes from one version
+    directory = os.path.realpath(directory)
+    try:
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            values = json.load(f)["values"]
+    except (OSError, ValueError):
+        return None
+
+    def load(name):
+        return np.load(os.path.join(directory, name), mmap_mode=mmap_mode, allow_pickle=False)
+
+    bitmaps = {}
+    try:
+        for column in INDEX_DIMENSIONS:
+            matrix = load(f"{column}.npy")
+            bitmaps[column] = {value: matrix[i] for i, value in enumerate(values[column])}
+        return {"order": load("order.npy"), "dates": load("dates.npy"), "bitmaps": bitmaps}
+    except OSError:
+        return None  # Replaced by a new version meanwhile; rebuilt by the caller
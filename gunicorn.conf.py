@@ -0,0 +1,36 @@
+# IMPORTS
+
+import os
+
+from helpers import publish_dataset, appendable_cache
+from columnar import cache_lock
+from data_store import append_directory
+from data_source import is_sqlite_path
+
+
+# GUNICORN SETTINGS
+#
+# Gunicorn reads this file from the working directory. The master process
+# publishes the columnar cache and the filter index once before forking;
+# every worker then memory-maps the same files read-only, so the pages of
+# the dataset are shared and worker memory stays flat as workers are added.
+# Batches that arrived in the drop directory while the app was down are
+# appended to the cache and indexed here too, instead of in every worker.
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+csv_file_path = os.environ.get("DATA_FILE", os.path.join(BASE_DIR, "sample_data_0504.csv"))
+ingest_dir = os.environ.get("INGEST_DIR", os.path.join(BASE_DIR, "incoming"))
+
+wsgi_app = "app:server"
+
+
+def on_starting(server):
+    # A SQLite log is read by every worker, there is no cache to publish
+    if not is_sqlite_path(csv_file_path):
+        publish_dataset(csv_file_path)
+        cache_dir = appendable_cache(csv_file_path)
+        if cache_dir is not None and os.path.isdir(ingest_dir):
+            with cache_lock(cache_dir):
+                appended = append_directory(cache_dir, ingest_dir)
+            if appended:
+                publish_dataset(csv_file_path)
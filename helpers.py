@@ -1,11 +1,22 @@
 # IMPORTS
 
+import os
+
+import numpy as np
 import pandas as pd
-from sklearn.metrics import roc_auc_score
-from sklearn.metrics import confusion_matrix
-import plotly.figure_factory as ff
+from pandas.api.types import union_categoricals
 import dash
 import plotly.graph_objs as go
+from plotly.colors import sequential
+
+from columnar import is_cache_valid, read_columns, cache_source
+from streaming import stream_ingest, is_appendable, read_cube, write_cube
+from filter_index import build_filter_index, query_filter_index, write_filter_index, read_filter_index, filter_index_length
+from instrumentation import instrument_server
+from metrics import roc_auc_score, build_threshold_sweep, confusion_counts, build_grouped_sweep, grouped_confusion_counts
+from cube import SCORE_BINS, build_cube, subgroup_table
+from bootstrap import BOOTSTRAP_RESAMPLES, CONFIDENCE_LEVEL, bootstrap_intervals
+from explainability import SHAP_RANKINGS, SHAP_QUANTILES
 
 
 # HELPER FUNCTIONS
@@ -13,74 +24,177 @@ import plotly.graph_objs as go
 def create_dash_app():
     app = dash.Dash()
     server = app.server  # just for deployment, not needed locally
+    instrument_server(server)  # Request timings and the /metrics endpoint
     return app, server
 
-def load_data(csv_file_path):
-    df = pd.read_csv(csv_file_path)
-    return df
+# Compact dtypes for the prediction log; SHAP columns are read as float32
+CSV_DTYPES = {
+    "model_version": "category",
+    "outcome": "int8",
+    "pred_prob": "float64",
+    "sex": "category",
+    "age": "int16",
+    "run_id": "category",
+    "site": "category",
+    "op_type": "category",
+}
+
+def log_dtypes(columns):
+    dtypes = {col: "float32" for col in columns if col.startswith("SHAP_")}
+    dtypes.update({col: dtype for col, dtype in CSV_DTYPES.items() if col in columns})
+    return dtypes
+
+def csv_dtypes(csv_file_path):
+    return log_dtypes(pd.read_csv(csv_file_path, nrows=0).columns)
+
+def load_data(csv_file_path, use_cache=True):
+    # Memory-map the columnar sidecar cache if it matches the CSV, otherwise
+    # parse the CSV once and write the cache for the next start
+    cache_dir = csv_file_path + ".columns"
+    if use_cache and is_cache_valid(cache_dir, csv_file_path):
+        df = read_columns(cache_dir)
+        if df is not None:
+            return df
+
+    if use_cache:
+        # Stream the CSV into the cache in bounded chunks, then map it; a
+        # cache whose manifest went missing is rebuilt the same way
+        try:
+            stream_ingest(csv_file_path, cache_dir, dtype=csv_dtypes(csv_file_path),
+                          prepare=prepare_data, source=cache_source(csv_file_path))
+            df = read_columns(cache_dir)
+            if df is not None:
+                return df
+        except OSError:
+            pass  # Read-only location, parse the CSV in memory instead
+
+    return pd.read_csv(csv_file_path, dtype=csv_dtypes(csv_file_path), parse_dates=["date"])
+
+def load_cube(csv_file_path, df=None):
+    # The filter cube accumulated while streaming the CSV into its cache; a
+    # stale cube (see read_cube) is rebuilt from df and saved in its place
+    cache_dir = csv_file_path + ".columns"
+    if not is_cache_valid(cache_dir, csv_file_path):
+        return None
+
+    cube = read_cube(cache_dir, len(df) if df is not None else None)
+    if cube is None and df is not None:
+        cube = build_cube(df)
+        try:
+            write_cube(cache_dir, cube)
+        except OSError:
+            pass
+    return cube
+
+def load_filter_index(csv_file_path, df, complete=False):
+    # The filter index is built by the first process and saved inside the
+    # cache, after which every process maps it instead of building its own.
+    # It may miss the batches appended to the cache since, which DataStore
+    # indexes on their own; with complete it is rebuilt over them.
+    cache_dir = csv_file_path + ".columns"
+    if not is_cache_valid(cache_dir, csv_file_path):
+        return None
+
+    index_dir = os.path.join(cache_dir, "index")
+    index = read_filter_index(index_dir)
+    if index is None or (complete and filter_index_length(index) < len(df)):
+        index = build_filter_index(df)
+        try:
+            write_filter_index(index, index_dir)
+        except OSError:
+            return index
+        index = read_filter_index(index_dir)
+    return index
+
+def appendable_cache(csv_file_path):
+    # The streamed cache the log is mapped from, which ingested batches are
+    # appended to; None when the log is parsed in memory
+    cache_dir = csv_file_path + ".columns"
+    return cache_dir if is_cache_valid(cache_dir, csv_file_path) and is_appendable(cache_dir) else None
+
+def publish_dataset(csv_file_path):
+    # Parse the CSV and build the filter index once, e.g. in the gunicorn
+    # master before the workers fork, so workers only attach to the cache
+    df = prepare_data(load_data(csv_file_path))
+    load_filter_index(csv_file_path, df, complete=True)
+    load_cube(csv_file_path, df)
+
+# Age groups of prepare_data: AGE_GROUPS[i] holds ages from AGE_BINS[i] up to,
+# but not including, AGE_BINS[i + 1]
+AGE_BINS = [0, 18, 30, 40, 50, 60, 70, 80, 90, 100]
+AGE_GROUPS = ["0-18", "19-30", "31-40", "41-50", "51-60", "61-70", "71-80", "81-90", "91-100"]
 
 def prepare_data(df):
-    # Based on the column "age", create a new column "ageGroup" with the following bins
-    bins = [0, 18, 30, 40, 50, 60, 70, 80, 90, 100]
-    labels = ["0-18", "19-30", "31-40", "41-50", "51-60", "61-70", "71-80", "81-90", "91-100"]
-    df["age_group"] = pd.cut(df["age"], bins=bins, labels=labels, right=False)
+    # Based on the column "age", create a new column "ageGroup" with the bins above.
+    # Cached columns are already prepared and are left as they are, so they
+    # stay memory-mapped instead of being recomputed into private memory
+    if "age_group" not in df:
+        df["age_group"] = pd.cut(df["age"], bins=AGE_BINS, labels=AGE_GROUPS, right=False)
+
+    # Parse the dates once here rather than on every filter change
+    if not pd.api.types.is_datetime64_any_dtype(df["date"]):
+        df["date"] = pd.to_datetime(df["date"])
     return df
 
 def create_filter_options(df):
-    sex_options = ["All"] + list(df["sex"].unique())
-    age_options = ["All"] + list(df["age_group"].unique())
-    model_options = ["All"] + list(df["model_version"].unique())
-    month_options = pd.date_range('2022-07', '2023-02', freq='MS').strftime("%B %Y")
-    run_id_options = ["All"] + list(df["run_id"].unique())
-    site_options = ["All"] + list(df["site"].unique())
-    op_type_options = ["All"] + list(df["op_type"].unique())
+    sex_options = ["All"] + list(df["sex"].dropna().unique())
+    age_options = ["All"] + list(df["age_group"].dropna().unique())
+    model_options = ["All"] + list(df["model_version"].dropna().unique())
+    month_options = create_month_options(df["date"].min(), df["date"].max())
+    run_id_options = ["All"] + list(df["run_id"].dropna().unique())
+    site_options = ["All"] + list(df["site"].dropna().unique())
+    op_type_options = ["All"] + list(df["op_type"].dropna().unique())
 
     return sex_options, age_options, model_options, month_options, run_id_options, site_options, op_type_options
 
-def calculate_average_shap_values(df):
-    shap_columns = [col for col in df.columns if col.startswith("SHAP_")]
-    avg_shap_values = df[shap_columns].mean()
-    sorted_shap_values = avg_shap_values.sort_values(ascending=False)[:5]
-    return sorted_shap_values
-
-def filter_df(df, sex, age, model, start_month, end_month, run_id, site, op_type):
-    filtered_df = df.copy()
-    if sex != "All":
-        filtered_df = filtered_df[filtered_df["sex"] == sex]
-    if age != "All":
-        filtered_df = filtered_df[filtered_df["age_group"] == age]
-    if model != "All":
-        filtered_df = filtered_df[filtered_df["model_version"] == model]
-    if run_id != "All":
-        filtered_df = filtered_df[filtered_df["run_id"] == run_id]
-    if site != "All":
-        filtered_df = filtered_df[filtered_df["site"] == site]
-    if op_type != "All":
-        filtered_df = filtered_df[filtered_df["op_type"] == op_type]
-
-    filtered_df["date"] = pd.to_datetime(filtered_df["date"])
-
-    filtered_df = filtered_df[(filtered_df["date"] >= start_month) & (filtered_df["date"] <= end_month)]
-
-    return filtered_df
-
-def auroc_if_possible(x):
-        if len(x['outcome'].unique()) < 2:
-            return None  # Placeholder value when the ROC AUC score is not defined
-        else:
-            return roc_auc_score(x['outcome'], x['pred_prob'])
-
-def sensitivity_specificity_if_possible(x, threshold=0.075):
-    if len(x['outcome'].unique()) < 2:
-        return pd.Series({"sensitivity": None, "specificity": None})
-    else:
-        tn, fp, fn, tp = confusion_matrix(x['outcome'], x['pred_prob'] > threshold).ravel()
-        sensitivity = tp / (tp + fn)
-        specificity = tn / (tn + fp)
-        return pd.Series({"sensitivity": sensitivity, "specificity": specificity})
+def create_month_options(first_date, last_date):
+    return list(pd.period_range(first_date, last_date, freq='M').strftime("%B %Y"))
 
+def merge_filter_options(filter_options, new_filter_options):
+    # Add the values seen in a new batch without rescanning the existing data
+    merged = []
+    for i, (options, new_options) in enumerate(zip(filter_options, new_filter_options)):
+        if i == 3:
+            months = [pd.to_datetime(month) for month in [options[0], options[-1], new_options[0], new_options[-1]]]
+            merged.append(create_month_options(min(months), max(months)))
+        else:
+            merged.append(list(options) + [option for option in new_options if option not in options])
+    return tuple(merged)
+
+def concat_frames(frames):
+    # Categorical columns are concatenated on the union of their categories,
+    # so they stay categorical (pd.concat falls back to strings when the
+    # categories differ)
+    columns = frames[0].columns
+    categorical = [col for col in columns if isinstance(frames[0][col].dtype, pd.CategoricalDtype)]
+    df = pd.concat([frame.drop(columns=categorical) for frame in frames], ignore_index=True)
+    for col in categorical:
+        df[col] = union_categoricals([pd.Categorical(frame[col]) for frame in frames])
+    return df[columns]
+
+def read_batch(source, columns):
+    # A batch of new predictions parsed with the dtypes of the log and
+    # prepared like it; ValueError if a column of the log is missing or a
+    # value does not parse (e.g. an age that is not a number)
+    batch = pd.read_csv(source, dtype=log_dtypes(columns))
+    missing = [col for col in columns if col != "age_group" and col not in batch]
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(missing)}")
+    if not batch["outcome"].isin([0, 1]).all():
+        raise ValueError("Outcomes must be 0 or 1")
+    batch["date"] = pd.to_datetime(batch["date"])
+    return prepare_data(batch[[col for col in columns if col != "age_group"]])
+
+def filter_df(df, sex, age, model, start_month, end_month, run_id, site, op_type, index=None):
+    # Look the selection up in the filter index and take only the matching rows
+    if index is None:
+        index = build_filter_index(df)
+    positions = query_filter_index(index, sex, age, model, start_month, end_month, run_id, site, op_type)
+    return df.take(positions)
+
+def calculate_summary_metrics(filtered_df):
+    records = len(filtered_df)
 
-def calculate_metrics(filtered_df, cutoff_threshold):
     # Calculate average fraction of complications
     avg_complications = filtered_df["outcome"].mean()
 
@@ -91,21 +205,168 @@ def calculate_metrics(filtered_df, cutoff_threshold):
         # Calculate AUROC
         auroc = roc_auc_score(filtered_df["outcome"], filtered_df["pred_prob"])
 
-    # Calculate monthly AUROC values
-    filtered_df['month'] = filtered_df['date'].dt.to_period('M')
-    monthly_auroc = filtered_df.groupby('month').apply(auroc_if_possible)
+    return records, avg_complications, auroc
+
+def calculate_threshold_sweep(filtered_df):
+    return build_threshold_sweep(filtered_df["outcome"].to_numpy(), filtered_df["pred_prob"].to_numpy())
 
-    monthly_sensitivity_specificity = filtered_df.groupby('month').apply(sensitivity_specificity_if_possible, threshold=cutoff_threshold)
+def calculate_grouped_sweep(filtered_df, keys):
+    # keys is a column name or a Series aligned with filtered_df (e.g. months)
+    if isinstance(keys, str):
+        keys = filtered_df[keys]
+    codes, groups = pd.factorize(keys, sort=True)
+    sweep = build_grouped_sweep(codes, filtered_df["outcome"].to_numpy(), filtered_df["pred_prob"].to_numpy(), len(groups))
+    sweep["groups"] = groups.rename(keys.name)
+    return sweep
+
+def calculate_monthly_sweep(filtered_df):
+    return calculate_grouped_sweep(filtered_df, filtered_df['date'].dt.to_period('M').rename('month'))
+
+def calculate_grouped_auroc(grouped_sweep):
+    # None where the AUROC is not defined, as for a group with a single class
+    auroc = grouped_sweep["auroc"]
+    return pd.Series(np.where(np.isnan(auroc), None, auroc), index=grouped_sweep["groups"])
+
+def calculate_grouped_sensitivity_specificity(grouped_sweep, cutoff_threshold):
+    tn, fp, fn, tp = grouped_confusion_counts(grouped_sweep, cutoff_threshold, inclusive=False)
+    defined = ~np.isnan(grouped_sweep["auroc"])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sensitivity = np.where(defined, tp / (tp + fn), None)
+        specificity = np.where(defined, tn / (tn + fp), None)
+    return pd.DataFrame({"sensitivity": sensitivity, "specificity": specificity}, index=grouped_sweep["groups"])
+
+def calculate_metrics(filtered_df, cutoff_threshold):
+    _, avg_complications, auroc = calculate_summary_metrics(filtered_df)
+
+    # Calculate monthly AUROC, sensitivity and specificity values
+    monthly_sweep = calculate_monthly_sweep(filtered_df)
+    monthly_auroc = calculate_grouped_auroc(monthly_sweep)
+    monthly_sensitivity_specificity = calculate_grouped_sensitivity_specificity(monthly_sweep, cutoff_threshold)
 
     return avg_complications, auroc, monthly_auroc, monthly_sensitivity_specificity
 
-def create_records_figure(filtered_df):
+def calculate_grouped_score_hist(grouped_sweep, n_bins=SCORE_BINS):
+    # Per-group score histograms (group, outcome, bin) with the bins of the
+    # cube, read off the sorted scores of the grouped sweep
+    counts = [grouped_confusion_counts(grouped_sweep, edge, inclusive=True) for edge in np.arange(1, n_bins) / n_bins]
+    hist = np.zeros((grouped_sweep["n_groups"], 2, n_bins), dtype=np.int64)
+    for outcome, below, total in [(0, 0, grouped_sweep["n_neg"]), (1, 2, grouped_sweep["n_pos"])]:
+        cumulative = np.column_stack([np.zeros_like(total)] + [c[below] for c in counts] + [total])
+        hist[:, outcome, :] = np.diff(cumulative, axis=1)
+    return hist
+
+def calculate_metric_intervals(filtered_df, cutoff_threshold, n_resamples=BOOTSTRAP_RESAMPLES, workers=0):
+    # Bootstrap confidence intervals of the AUROC and of the monthly values
+    # returned by calculate_metrics
+    monthly_sweep = calculate_monthly_sweep(filtered_df)
+    monthly_hist = calculate_grouped_score_hist(monthly_sweep)
+    overall = bootstrap_intervals(monthly_hist.sum(axis=0, keepdims=True), n_resamples=n_resamples, workers=workers)
+    monthly = bootstrap_intervals(monthly_hist, [cutoff_threshold], n_resamples=n_resamples, workers=workers)
+
+    auroc_interval = tuple(float(bound[0]) for bound in overall["auroc"])
+    monthly_auroc_interval = pd.DataFrame(dict(zip(["low", "high"], monthly["auroc"])), index=monthly_sweep["groups"])
+    monthly_sensitivity_specificity_interval = pd.DataFrame({
+        "sensitivity_low": monthly["sensitivity"][0][0],
+        "sensitivity_high": monthly["sensitivity"][1][0],
+        "specificity_low": monthly["specificity"][0][0],
+        "specificity_high": monthly["specificity"][1][0],
+    }, index=monthly_sweep["groups"])
+    return auroc_interval, monthly_auroc_interval, monthly_sensitivity_specificity_interval
+
+def calculate_subgroup_metrics(filtered_df, dimensions, threshold):
+    # cube_subgroup_metrics from the rows: one grouped sweep over every
+    # combination of the dimensions
+    if dimensions:
+        grouped = filtered_df.groupby(list(dimensions), observed=True, sort=True, dropna=False)
+        codes, subgroups = grouped.ngroup().to_numpy(), grouped.size().index.to_frame(index=False)
+    else:
+        codes, subgroups = np.zeros(len(filtered_df), dtype=np.int64), pd.DataFrame(index=[0])
+    sweep = build_grouped_sweep(codes, filtered_df["outcome"].to_numpy(), filtered_df["pred_prob"].to_numpy(), len(subgroups))
+    tn, fp, fn, tp = grouped_confusion_counts(sweep, threshold, inclusive=True)
+    return subgroup_table(subgroups, sweep["n_neg"], sweep["n_pos"], sweep["auroc"], tn, fp, fn, tp)
+
+SUBGROUP_METRICS = ["complication_rate", "auroc", "sensitivity", "specificity"]
+
+def suppress_small_cells(subgroups, min_count, counts=("count",), metrics=SUBGROUP_METRICS):
+    # Rows with fewer records than min_count in any of the count columns
+    # keep their labels only
+    suppressed = (subgroups[list(counts)] < min_count).any(axis=1)
+    subgroups = subgroups.astype({column: "Int64" for column in counts}).astype({column: float for column in metrics})
+    subgroups.loc[suppressed, list(counts) + list(metrics)] = np.nan
+    return subgroups.assign(suppressed=suppressed)
+
+def sort_subgroups(subgroups, by="auroc", ascending=True):
+    # Worst performing subgroups first by default; suppressed and undefined
+    # values last
+    return subgroups.sort_values(by, ascending=ascending, na_position="last", kind="stable").reset_index(drop=True)
+
+def calculate_confusion_matrix(sweep, cutoff_threshold):
+    tn, fp, fn, tp = confusion_counts(sweep, cutoff_threshold, inclusive=True)
+    return np.array([[tn, fp], [fn, tp]])
+
+def calculate_confusion_counts(sweep, thresholds):
+    # Confusion counts at every threshold, as calculate_confusion_matrix
+    return confusion_counts(sweep, np.asarray(thresholds, dtype=float), inclusive=True)
+
+def calculate_grouped_confusion_counts(grouped_sweep, thresholds):
+    # Per-group counts at every threshold (rows) as used for the monthly
+    # sensitivity and specificity
+    counts = [grouped_confusion_counts(grouped_sweep, threshold, inclusive=False) for threshold in thresholds]
+    return tuple(np.array(values).reshape(len(thresholds), grouped_sweep["n_groups"]) for values in zip(*counts))
+
+def json_values(values, decimals=4):
+    # Rounded to keep the payload small; NaN becomes null
+    values = np.round(np.asarray(values, dtype=float), decimals)
+    return np.where(np.isnan(values), None, values).tolist()
+
+def create_threshold_summary(thresholds, counts, period_auroc, period_counts, period_intervals=None):
+    # Everything the browser needs to redraw the confusion matrix and the
+    # timeline for any cutoff in thresholds without asking the server; the
+    # periods of the timeline are indexed by month or by date, and
+    # period_intervals adds their bootstrap confidence bands
+    tn, fp, fn, tp = counts
+    period_tn, period_fp, period_fn, period_tp = period_counts
+    periods = period_auroc.index
+    if isinstance(periods, pd.PeriodIndex):
+        periods = periods.to_timestamp()
+    bands = {}
+    if period_intervals is not None:
+        for metric in ["auroc", "sensitivity", "specificity"]:
+            low, high = period_intervals[metric]
+            bands[f"period_{metric}_low"] = json_values(low)
+            bands[f"period_{metric}_high"] = json_values(high)
+    return {
+        "thresholds": list(thresholds),
+        "tn": tn.tolist(),
+        "fn": fn.tolist(),
+        "n_neg": int(tn[0] + fp[0]) if len(thresholds) else 0,
+        "n_pos": int(fn[0] + tp[0]) if len(thresholds) else 0,
+        "periods": list(periods.strftime("%Y-%m-%d")),
+        "period_auroc": [None if pd.isna(value) else float(value) for value in period_auroc],
+        "period_tn": period_tn.tolist(),
+        "period_fn": period_fn.tolist(),
+        "period_n_neg": (period_tn[0] + period_fp[0]).tolist() if len(thresholds) else [],
+        "period_n_pos": (period_fn[0] + period_tp[0]).tolist() if len(thresholds) else [],
+        **bands,
+    }
+
+# FIGURES
+#
+# Each figure is built and validated once with its full layout (see
+# create_static_figures) and sent with the page. Callbacks answer with a
+# dash.Patch that only carries what changed: indicator values, trace
+# arrays, heatmap cells and annotations.
+
+CONFUSION_MATRIX_X = ['Predicted low risk', 'Predicted high risk']
+CONFUSION_MATRIX_Y = ['Successful surgery', 'Complication']
+
+def create_records_figure(records=0):
     fontsize_title = 20
     fontsize_label = 40
 
     records_figure = go.Figure(go.Indicator(
         mode="number",
-        value=len(filtered_df),
+        value=records,
         number={"valueformat": ",.0f", "font": {"size": fontsize_label}},
         domain={"x": [0, 1], "y": [0, 1]},
         title={"text": "Records", "font": {"size": fontsize_title}},
@@ -118,7 +379,7 @@ def create_records_figure(filtered_df):
     return records_figure
 
 
-def create_complications_figure(avg_complications):
+def create_complications_figure(avg_complications=0):
     fontsize_title = 20
     fontsize_label = 40
 
@@ -137,7 +398,7 @@ def create_complications_figure(avg_complications):
     return complications_figure
 
 
-def create_auroc_figure(auroc):
+def create_auroc_figure(auroc=0, interval=None, error_bound=None):
     fontsize_title = 20
     fontsize_label = 40
 
@@ -151,45 +412,61 @@ def create_auroc_figure(auroc):
     auroc_figure.update_layout(
         height=200,
         plot_bgcolor='rgba(0,0,0,0)',
-        paper_bgcolor='rgba(0,0,0,0)'
+        paper_bgcolor='rgba(0,0,0,0)',
+        annotations=auroc_annotations(auroc, interval, error_bound)
     )
-
-    if pd.isna(auroc):
-        auroc_figure.add_annotation(
-            text="N/A",
-            xref="paper", yref="paper",
-            x=0.5, y=0.5, showarrow=False,
-            font=dict(size=fontsize_label)
-        )
     return auroc_figure
 
 
-def create_timeline_figure(monthly_auroc, monthly_sensitivity_specificity, selected_metrics):
-    timeline_figure = go.Figure()
-
+def auroc_annotations(auroc, interval=None, error_bound=None):
+    if pd.isna(auroc):
+        return [{"text": "N/A", "xref": "paper", "yref": "paper", "x": 0.5, "y": 0.5,
+                 "showarrow": False, "font": {"size": 40}}]
+    # Bootstrap confidence interval, and the error bound of an approximate
+    # value, below the value
+    notes = []
+    if interval is not None and not np.isnan(interval).any():
+        notes.append(f"{CONFIDENCE_LEVEL:.0%} CI {interval[0]:.2f}\u2013{interval[1]:.2f}")
+    if error_bound is not None and not np.isnan(error_bound):
+        notes.append(f"approx. \u00b1{error_bound:.3f}")
+    if not notes:
+        return []
+    return [{"text": " \u00b7 ".join(notes), "xref": "paper", "yref": "paper", "x": 0.5, "y": 0.0,
+             "showarrow": False, "font": {"size": 14}}]
+
+
+def timeline_traces(monthly_auroc, monthly_sensitivity_specificity, selected_metrics):
+    traces = []
     if "auroc" in selected_metrics:
-        timeline_figure.add_trace(go.Scatter(
-            x=monthly_auroc.index.to_timestamp(),
-            y=monthly_auroc.values,
-            mode='lines+markers',
-            name="AUROC",
-        ))
-
+        traces.append({
+            "x": monthly_auroc.index.to_timestamp().strftime("%Y-%m-%d"),
+            "y": monthly_auroc.values,
+            "mode": 'lines+markers',
+            "name": "AUROC",
+        })
+
+    months = monthly_sensitivity_specificity.index.to_timestamp().strftime("%Y-%m-%d")
     if "sensitivity" in selected_metrics:
-        timeline_figure.add_trace(go.Scatter(
-            x=monthly_sensitivity_specificity.index.to_timestamp(),
-            y=monthly_sensitivity_specificity['sensitivity'].values,
-            mode='lines+markers',
-            name="Sensitivity",
-        ))
+        traces.append({
+            "x": months,
+            "y": monthly_sensitivity_specificity['sensitivity'].values,
+            "mode": 'lines+markers',
+            "name": "Sensitivity",
+        })
 
     if "specificity" in selected_metrics:
-        timeline_figure.add_trace(go.Scatter(
-            x=monthly_sensitivity_specificity.index.to_timestamp(),
-            y=monthly_sensitivity_specificity['specificity'].values,
-            mode='lines+markers',
-            name="Specificity",
-        ))
+        traces.append({
+            "x": months,
+            "y": monthly_sensitivity_specificity['specificity'].values,
+            "mode": 'lines+markers',
+            "name": "Specificity",
+        })
+    return traces
+
+
+def create_timeline_figure(monthly_auroc, monthly_sensitivity_specificity, selected_metrics):
+    traces = timeline_traces(monthly_auroc, monthly_sensitivity_specificity, selected_metrics)
+    timeline_figure = go.Figure([go.Scatter(**trace) for trace in traces])
 
     timeline_figure.update_layout(
         xaxis={"title": "Date", 'fixedrange': True},
@@ -201,45 +478,234 @@ def create_timeline_figure(monthly_auroc, monthly_sensitivity_specificity, selec
     return timeline_figure
 
 
-def create_shap_barplot(filtered_df):
-    # Calculate average SHAP values for each feature
-    shap_columns = [col for col in filtered_df.columns if col.startswith("SHAP_")]
-    shap_values = filtered_df[shap_columns].mean().sort_values(ascending=False)
-    top_shap_values = shap_values.head(5)
+def feature_labels(columns):
+    return [col.replace("SHAP_", "", 1) for col in columns]
+
 
-    # Create SHAP bar plot
+def create_shap_barplot(ranking, by="mean"):
+    # Create SHAP bar plot of the top ranked features
     shap_barplot = go.Figure(go.Bar(
-        x=top_shap_values.index.str.replace("SHAP_", ""),
-        y=top_shap_values.values
+        x=feature_labels(ranking.index),
+        y=ranking[by].to_numpy()
     ))
 
     shap_barplot.update_layout(
         xaxis={"title": "Feature"},
-        yaxis={"title": "Average SHAP value"},
+        yaxis={"title": SHAP_RANKINGS[by]},
         showlegend=False,
         paper_bgcolor='rgba(0,0,0,0)'  
     )
 
     return shap_barplot
 
-def create_confusion_matrix(filtered_df, cutoff_threshold):
-    y_true = filtered_df['outcome']
-    y_pred = (filtered_df['pred_prob'] >= cutoff_threshold).astype(int)
 
-    cm = confusion_matrix(y_true, y_pred)
-    cm_plot = ff.create_annotated_heatmap(
+def shap_distribution_traces(quantiles, points):
+    # A box per feature from the sample quantiles, with whiskers at the
+    # outer ones, and the sampled points jittered around it and colored by
+    # predicted risk; features are numbered from the top down
+    traces = []
+    for i, (col, q) in enumerate(quantiles.iterrows()):
+        traces.append({
+            "type": "box",
+            "orientation": "h",
+            "y": [i],
+            "lowerfence": json_values([q.iloc[0]]),
+            "q1": json_values([q.iloc[1]]),
+            "median": json_values([q.iloc[2]]),
+            "q3": json_values([q.iloc[3]]),
+            "upperfence": json_values([q.iloc[4]]),
+            "name": feature_labels([col])[0],
+            "marker": {"color": "#005EB8"},
+            "fillcolor": "rgba(0,0,0,0)",
+            "showlegend": False,
+        })
+
+    if len(points):
+        jitter = np.random.default_rng(0).uniform(-0.3, 0.3, (len(quantiles), len(points)))
+        traces.append({
+            "type": "scattergl",
+            "mode": "markers",
+            "x": json_values(points[list(quantiles.index)].to_numpy().T.ravel()),
+            "y": json_values((np.arange(len(quantiles))[:, None] + jitter).ravel(), 3),
+            "marker": {"color": json_values(np.tile(points["pred_prob"].to_numpy(), len(quantiles)), 3),
+                       "colorscale": "Bluered", "cmin": 0, "cmax": 1, "size": 4, "opacity": 0.5,
+                       "colorbar": {"title": "Predicted risk"}},
+            "hoverinfo": "x",
+            "showlegend": False,
+        })
+    return traces
+
+
+def shap_distribution_axis(quantiles):
+    labels = feature_labels(quantiles.index)
+    return {"title": "Feature", "tickvals": list(range(len(labels))), "ticktext": labels, "autorange": "reversed"}
+
+
+def create_shap_distribution_figure(quantiles, points):
+    figure = go.Figure(shap_distribution_traces(quantiles, points))
+    figure.update_layout(
+        xaxis={"title": "SHAP value", "zeroline": True},
+        yaxis=shap_distribution_axis(quantiles),
+        paper_bgcolor='rgba(0,0,0,0)'
+    )
+    return figure
+
+
+def shap_subgroup_traces(subgroup_means):
+    labels = feature_labels(subgroup_means.columns)
+    return [{"type": "bar", "name": group, "x": labels, "y": json_values(row)}
+            for group, row in zip(subgroup_means.index, subgroup_means.to_numpy())]
+
+
+def create_shap_subgroup_figure(subgroup_means, by="mean"):
+    figure = go.Figure(shap_subgroup_traces(subgroup_means))
+    figure.update_layout(
+        barmode="group",
+        xaxis={"title": "Feature"},
+        yaxis={"title": SHAP_RANKINGS[by]},
+        legend={"orientation": "h", "y": 1.15},
+        paper_bgcolor='rgba(0,0,0,0)'
+    )
+    return figure
+
+def calibration_traces(curve):
+    # The reliability diagram against the diagonal of perfect calibration,
+    # drawn up to the largest risk or rate shown
+    top = float(np.nan_to_num(curve[["expected", "observed"]].to_numpy()).max(initial=0)) * 1.05 or 1
+    return [
+        {"type": "scatter", "x": [0, top], "y": [0, top], "mode": "lines", "name": "Perfect calibration",
+         "line": {"dash": "dash", "color": "#999999"}, "hoverinfo": "skip"},
+        {"type": "scatter", "x": json_values(curve["expected"]), "y": json_values(curve["observed"]),
+         "customdata": curve["count"].tolist(), "mode": "lines+markers", "name": "Selection",
+         "marker": {"color": "#005EB8"},
+         "hovertemplate": "Predicted %{x:.3f}<br>Observed %{y:.3f}<br>%{customdata:,} records<extra></extra>"},
+    ]
+
+
+def create_calibration_figure(curve):
+    figure = go.Figure(calibration_traces(curve))
+    figure.update_layout(
+        xaxis={"title": "Mean predicted risk", "rangemode": "tozero"},
+        yaxis={"title": "Observed complication rate", "rangemode": "tozero"},
+        legend={"orientation": "h", "y": 1.15},
+        paper_bgcolor='rgba(0,0,0,0)'
+    )
+    return figure
+
+def create_confusion_matrix(cm, cutoff_threshold):
+    # The annotated heatmap of plotly.figure_factory, built directly; the
+    # figure factory imports scipy, which costs a second at startup
+    cm_plot = go.Figure(go.Heatmap(
         z=cm,
-        x=['Predicted low risk', 'Predicted high risk'],
-        y=['Successful surgery', 'Complication'],
-        colorscale='Blues',
+        x=CONFUSION_MATRIX_X,
+        y=CONFUSION_MATRIX_Y,
+        colorscale=[[i / (len(sequential.Blues) - 1), color] for i, color in enumerate(sequential.Blues)],
+        reversescale=False,
         showscale=True,
-    )
+    ))
 
     cm_plot.update_layout(
-        title=f'Confusion Matrix (Threshold: {cutoff_threshold:.3f})',
-        xaxis={"title": "Predicted Value"},
-        yaxis={"title": "Actual Value", "autorange": "reversed"},
+        title=confusion_matrix_title(cutoff_threshold),
+        annotations=confusion_matrix_annotations(np.asarray(cm)),
+        xaxis={"title": "Predicted Value", "dtick": 1, "gridcolor": "rgb(0, 0, 0)", "side": "top", "ticks": ""},
+        yaxis={"title": "Actual Value", "autorange": "reversed", "dtick": 1, "ticks": "", "ticksuffix": "  "},
         paper_bgcolor='rgba(0,0,0,0)' 
     )
 
-    return cm_plot
\ No newline at end of file
+    return cm_plot
+
+def confusion_matrix_title(cutoff_threshold):
+    return f'Confusion Matrix (Threshold: {cutoff_threshold:.3f})'
+
+def confusion_matrix_annotations(cm):
+    # Same text and colors as plotly's annotated heatmap with the Blues scale
+    zmid = (cm.max() + cm.min()) / 2
+    return [
+        {"text": str(value), "x": CONFUSION_MATRIX_X[j], "y": CONFUSION_MATRIX_Y[i], "xref": "x", "yref": "y",
+         "font": {"color": "#000000" if value < zmid else "#FFFFFF"}, "showarrow": False}
+        for i, row in enumerate(cm.tolist()) for j, value in enumerate(row)
+    ]
+
+
+def create_static_figures():
+    # Empty figures with the complete layout, built once per process
+    months = pd.PeriodIndex([], freq="M")
+    empty_monthly = pd.DataFrame({"sensitivity": [], "specificity": []}, index=months)
+    empty_shap = pd.DataFrame({"mean": [], "mean_abs": []}, index=pd.Index([], dtype=object))
+    empty_quantiles = pd.DataFrame(columns=list(SHAP_QUANTILES), index=pd.Index([], dtype=object), dtype=float)
+    empty_points = pd.DataFrame({"pred_prob": []})
+    empty_curve = pd.DataFrame({"expected": [], "observed": [], "count": []})
+    figures = {
+        "indicator-records": create_records_figure(),
+        "indicator-complications": create_complications_figure(),
+        "indicator-auroc": create_auroc_figure(),
+        "timeline": create_timeline_figure(pd.Series([], index=months, dtype=float), empty_monthly, []),
+        "shap-barplot": create_shap_barplot(empty_shap),
+        "shap-distribution": create_shap_distribution_figure(empty_quantiles, empty_points),
+        "shap-subgroups": create_shap_subgroup_figure(pd.DataFrame()),
+        "confusion-matrix": create_confusion_matrix(np.zeros((2, 2), dtype=int), 0.5),
+        "calibration-curve": create_calibration_figure(empty_curve),
+    }
+    return {graph_id: figure.to_plotly_json() for graph_id, figure in figures.items()}
+
+
+def patch_indicator_figure(value):
+    patch = dash.Patch()
+    patch["data"][0]["value"] = value
+    return patch
+
+
+def patch_records_figure(records):
+    return patch_indicator_figure(records)
+
+
+def patch_complications_figure(avg_complications):
+    return patch_indicator_figure(avg_complications * 100)
+
+
+def patch_auroc_figure(auroc, interval=None, error_bound=None):
+    patch = patch_indicator_figure(auroc)
+    patch["layout"]["annotations"] = auroc_annotations(auroc, interval, error_bound)
+    return patch
+
+
+def patch_timeline_figure(monthly_auroc, monthly_sensitivity_specificity, selected_metrics):
+    patch = dash.Patch()
+    patch["data"] = timeline_traces(monthly_auroc, monthly_sensitivity_specificity, selected_metrics)
+    return patch
+
+
+def patch_shap_barplot(ranking, by="mean"):
+    patch = dash.Patch()
+    patch["data"][0]["x"] = feature_labels(ranking.index)
+    patch["data"][0]["y"] = json_values(ranking[by])
+    patch["layout"]["yaxis"]["title"]["text"] = SHAP_RANKINGS[by]
+    return patch
+
+
+def patch_shap_distribution_figure(quantiles, points):
+    patch = dash.Patch()
+    patch["data"] = shap_distribution_traces(quantiles, points)
+    patch["layout"]["yaxis"] = shap_distribution_axis(quantiles)
+    return patch
+
+
+def patch_shap_subgroup_figure(subgroup_means, by="mean"):
+    patch = dash.Patch()
+    patch["data"] = shap_subgroup_traces(subgroup_means)
+    patch["layout"]["yaxis"]["title"]["text"] = SHAP_RANKINGS[by]
+    return patch
+
+
+def patch_calibration_figure(curve):
+    patch = dash.Patch()
+    patch["data"] = calibration_traces(curve)
+    return patch
+
+
+def patch_confusion_matrix(cm, cutoff_threshold):
+    patch = dash.Patch()
+    patch["data"][0]["z"] = cm
+    patch["layout"]["annotations"] = confusion_matrix_annotations(cm)
+    patch["layout"]["title"]["text"] = confusion_matrix_title(cutoff_threshold)
+    return patch
@@ -0,0 +1,242 @@
+# IMPORTS
+
+import bisect
+import collections
+import contextlib
+import functools
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+import flask
+
+logger = logging.getLogger(__name__)
+
+
+# METRICS
+#
+# Latency histograms and counters for the pipeline stages, kept per process
+# and rendered in the Prometheus text format on /metrics. Stage latencies
+# are measured where the work is done, so a stage that calls another one
+# (e.g. the summary metrics and the selection) includes its time.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+METRIC_HELP = {
+    "modelmonitor_stage_seconds": ("histogram", "Latency of pipeline stages (loading, selection, metrics, figures)"),
+    "modelmonitor_callback_seconds": ("histogram", "Latency of Dash callbacks"),
+    "modelmonitor_request_seconds": ("histogram", "Latency of HTTP requests, including serialization"),
+    "modelmonitor_response_bytes": ("histogram", "Size of HTTP responses"),
+    "modelmonitor_rows_processed_total": ("counter", "Rows processed by pipeline stages"),
+}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = collections.defaultdict(float)
+        self.collectors = []
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    def increment(self, name, labels, value=1):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def add_collector(self, collector):
+        # collector() returns (name, type, help, labels, value) tuples that are
+        # read at scrape time, e.g. cache statistics or memory usage
+        self.collectors.append(collector)
+        return collector
+
+    def render(self):
+        samples = collections.defaultdict(list)
+        described = dict(METRIC_HELP)
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    samples[name].append((name + "_bucket", labels + (("le", str(bound)),), cumulative))
+                samples[name].append((name + "_sum", labels, histogram.sum))
+                samples[name].append((name + "_count", labels, cumulative))
+            for (name, labels), value in sorted(self.counters.items()):
+                samples[name].append((name, labels, value))
+        for collector in self.collectors:
+            for name, kind, help_text, labels, value in collector():
+                described.setdefault(name, (kind, help_text))
+                samples[name].append((name, tuple(sorted(labels.items())), value))
+
+        lines = []
+        for name, name_samples in samples.items():
+            kind, help_text = described.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in name_samples:
+                label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+                lines.append(f"{sample_name}{{{label_text}}} {value}" if labels else f"{sample_name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+@contextlib.contextmanager
+def stage_timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.observe("modelmonitor_stage_seconds", {"stage": stage}, time.perf_counter() - start)
+
+
+def timed(stage):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_rows(stage, rows):
+    REGISTRY.increment("modelmonitor_rows_processed_total", {"stage": stage}, rows)
+
+
+def resident_memory_bytes():
+    # Current RSS from /proc where available, the peak RSS otherwise
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+@REGISTRY.add_collector
+def collect_process_metrics():
+    return [("process_resident_memory_bytes", "gauge", "Resident memory of this process", {}, resident_memory_bytes())]
+
+
+def instrument_server(server):
+    # Request latency and response size of every request, and /metrics
+    @server.before_request
+    def start_timer():
+        flask.g.request_start = time.perf_counter()
+
+    @server.after_request
+    def record_request(response):
+        start = getattr(flask.g, "request_start", None)
+        if start is not None and flask.request.endpoint != "metrics":
+            # Labelled by route, not URL, so probes of random paths do not
+            # add a series each
+            rule = flask.request.url_rule
+            labels = {"path": rule.rule if rule is not None else "unmatched"}
+            REGISTRY.observe("modelmonitor_request_seconds", labels, time.perf_counter() - start)
+            if not response.direct_passthrough:
+                REGISTRY.observe("modelmonitor_response_bytes", labels, len(response.get_data()), BYTES_BUCKETS)
+        return response
+
+    @server.route("/metrics")
+    def metrics():
+        return flask.Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
+# SAMPLING PROFILER
+#
+# Opt-in: while a callback runs, a thread samples the stack of the thread
+# running it every few milliseconds. When the callback takes longer than the
+# latency budget, the samples are written as folded stacks (one
+# "frame;frame;... count" line per stack, the input of flamegraph tools).
+
+class SamplingProfiler:
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, name="sampling-profiler", daemon=True)
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+class CallbackProfiler:
+    def __init__(self, budget_ms, directory=None, interval_ms=5):
+        self.budget = budget_ms / 1000
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "modelmonitor-profiles")
+        self.interval = interval_ms / 1000
+        os.makedirs(self.directory, exist_ok=True)
+
+    def run(self, name, function, *args, **kwargs):
+        start = time.perf_counter()
+        with SamplingProfiler(threading.get_ident(), self.interval) as profiler:
+            result = function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        if elapsed > self.budget:
+            timestamp = time.strftime("%Y%m%dT%H%M%S") + f"{time.time() % 1:.3f}"[1:]
+            path = os.path.join(self.directory, f"{name}-{timestamp}-{elapsed * 1000:.0f}ms.folded")
+            with open(path, "w") as f:
+                f.write(profiler.folded())
+            logger.warning("%s took %.0f ms (budget %.0f ms), profile written to %s",
+                           name, elapsed * 1000, self.budget * 1000, path)
+        return result
+
+
+def instrument_callback(profiler=None):
+    # Records the latency of a Dash callback and profiles it if enabled
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                if profiler is not None:
+                    return profiler.run(function.__name__, function, *args, **kwargs)
+                return function(*args, **kwargs)
+            finally:
+                REGISTRY.observe("modelmonitor_callback_seconds", {"callback": function.__name__},
+                                 time.perf_counter() - start)
+        return wrapper
+    return decorator
@@ -1,5 +1,63 @@
 from dash import dcc
 from dash import html
+from dash import dash_table
+from dash.dash_table.Format import Format, Scheme
+
+# Step of the cutoff sliders; the threshold summary has an entry per step
+CUTOFF_STEP = 0.005
+
+SHAP_TOP_K_OPTIONS = [5, 10, 20, 50]
+
+# Initial values of the tab controls; the cache warm-up computes the views
+# they select
+DEFAULT_CUTOFF = 0.075
+DEFAULT_SHAP_RANKING = "mean"
+DEFAULT_SHAP_DIMENSION = "sex"
+
+# Periods and rolling windows (in days) of the timeline; "month" without
+# a window is the default
+TIMELINE_GRANULARITIES = {"day": "Day", "week": "Week", "month": "Month"}
+ROLLING_WINDOWS = {0: "None", 7: "7 days", 30: "30 days", 90: "90 days"}
+DEFAULT_GRANULARITY = "month"
+DEFAULT_WINDOW = 0
+
+# Polling interval of callbacks whose results are computed in the background
+BACKGROUND_POLL_MS = 500
+
+SUBGROUP_LABELS = {"sex": "Sex", "age_group": "Age Group", "site": "Site", "op_type": "Operation Type"}
+
+def dropdown_options(values):
+    return [{"label": value, "value": value} for value in values]
+
+def counted_dropdown_options(values, counts, selected):
+    # Values with records under the other filters, labelled with their
+    # number of records ("All" with the total); the selected value is kept
+    # so the dropdown does not lose it
+    total = sum(counts.values())
+    options = []
+    for value in values:
+        count = total if value == "All" else counts.get(value, 0)
+        if count or value == selected:
+            options.append({"label": f"{value} ({count:,})", "value": value})
+    return options
+
+def default_reference_months(month_options):
+    # The first three months of the log
+    return month_options[0], month_options[min(2, len(month_options) - 1)]
+
+def background_status(name):
+    # Polls a callback computing in the background while it is enabled; the
+    # callback writes its progress next to it
+    return html.Div(
+        [
+            dcc.Interval(id=f"{name}-poll", interval=BACKGROUND_POLL_MS, disabled=True),
+            html.Div(id=f"{name}-progress", style={"color": "#999999", "fontStyle": "italic"}),
+        ],
+        style={"width": "100%", "padding": "10px 20px 0px 20px"},
+    )
+
+def background_progress(elapsed):
+    return f"Computing\u2026 {elapsed:.0f} s"
 
 def create_header():
     return html.H1(
@@ -20,30 +78,44 @@ def create_sidebar(month_options, sex_options, age_options, site_options, op_typ
             dcc.Dropdown(
                 id="start-month-dropdown",
                 clearable=False,
-                options=[{"label": month, "value": month} for month in month_options],
+                options=dropdown_options(month_options),
                 value=month_options[0],
             ),
             html.Label("End Month"),
             dcc.Dropdown(
                 id="end-month-dropdown",
                 clearable=False,
-                options=[{"label": month, "value": month} for month in month_options],
+                options=dropdown_options(month_options),
                 value=month_options[-1],
             ),
+            html.Label("Timeline Granularity"),
+            dcc.Dropdown(
+                id="granularity-dropdown",
+                clearable=False,
+                options=[{"label": label, "value": value} for value, label in TIMELINE_GRANULARITIES.items()],
+                value=DEFAULT_GRANULARITY,
+            ),
+            html.Label("Rolling Window"),
+            dcc.Dropdown(
+                id="window-dropdown",
+                clearable=False,
+                options=[{"label": label, "value": value} for value, label in ROLLING_WINDOWS.items()],
+                value=DEFAULT_WINDOW,
+            ),
             html.Div(style={"height": "20px"}),
             html.H4("Filters", style={"padding-bottom": "10px"}),
             html.Label("Sex"),
             dcc.Dropdown(
                 id="sex-dropdown",
                 clearable=False,
-                options=[{"label": sex, "value": sex} for sex in sex_options],
+                options=dropdown_options(sex_options),
                 value="All",
             ),
             html.Label("Age Group"),
             dcc.Dropdown(
                 id="age-dropdown",
                 clearable=False,
-                options=[{"label": age, "value": age} for age in age_options],
+                options=dropdown_options(age_options),
                 value="All",
             ),
             html.Div(style={"height": "40px"}),
@@ -51,14 +123,14 @@ def create_sidebar(month_options, sex_options, age_options, site_options, op_typ
             dcc.Dropdown(
                 id="site-dropdown",
                 clearable=False,
-                options=[{"label": site, "value": site} for site in site_options],
+                options=dropdown_options(site_options),
                 value="All",
             ),
             html.Label("Operation Type"),
             dcc.Dropdown(
                 id="op-type-dropdown",
                 clearable=False,
-                options=[{"label": op_type, "value": op_type} for op_type in op_type_options],
+                options=dropdown_options(op_type_options),
                 value="All",
             ),
             html.Div(style={"height": "40px"}),
@@ -66,14 +138,14 @@ def create_sidebar(month_options, sex_options, age_options, site_options, op_typ
             dcc.Dropdown(
                 id="model-dropdown",
                 clearable=False,
-                options=[{"label": model, "value": model} for model in model_options],
+                options=dropdown_options(model_options),
                 value="All",
             ),
             html.Label("Run ID"),
             dcc.Dropdown(
                 id="run-id-dropdown",
                 clearable=False,
-                options=[{"label": run_id, "value": run_id} for run_id in run_id_options],
+                options=dropdown_options(run_id_options),
                 value="All",
             ),
         ],
@@ -87,7 +159,7 @@ def create_sidebar(month_options, sex_options, age_options, site_options, op_typ
     )
 
 
-def create_overview_tab():
+def create_overview_tab(figures):
     return dcc.Tab(
         label="Overview",
         children=[
@@ -95,6 +167,7 @@ def create_overview_tab():
                 [
                     dcc.Graph(
                         id="indicator-records",
+                        figure=figures["indicator-records"],
                         config={"displayModeBar": False},
                     ),
                 ],
@@ -109,6 +182,7 @@ def create_overview_tab():
                 [
                     dcc.Graph(
                         id="indicator-complications",
+                        figure=figures["indicator-complications"],
                         config={"displayModeBar": False},
                     ),
                 ],
@@ -123,6 +197,7 @@ def create_overview_tab():
                 [
                     dcc.Graph(
                         id="indicator-auroc",
+                        figure=figures["indicator-auroc"],
                         config={"displayModeBar": False},
                     ),
                 ],
@@ -224,7 +299,7 @@ def create_overview_tab():
 #         ],
 #     )
 
-def create_performance_tab():
+def create_performance_tab(figures):
     return dcc.Tab(
         label="Performance",
         children=[
@@ -235,8 +310,8 @@ def create_performance_tab():
                         id="cutoff-slider-2",
                         min=0,
                         max=1,
-                        step=0.005,
-                        value=0.075,
+                        step=CUTOFF_STEP,
+                        value=DEFAULT_CUTOFF,
                         marks={i / 10: f"{i / 10:.1f}" for i in range(0, 11)},
                     ),
                 ],
@@ -250,6 +325,7 @@ def create_performance_tab():
                             {'label': 'AUROC', 'value': 'auroc'},
                             {'label': 'Sensitivity', 'value': 'sensitivity'},
                             {'label': 'Specificity', 'value': 'specificity'},
+                            {'label': 'Complication rate', 'value': 'complication_rate'},
                         ],
                         value=['auroc', 'sensitivity', 'specificity'],
                         inline=True,
@@ -263,10 +339,12 @@ def create_performance_tab():
                     "justify-content": "center",
                 },
             ),
+            background_status("threshold-summary"),
             html.Div(
                 [
                     dcc.Graph(
                         id="timeline",
+                        figure=figures["timeline"],
                         config={"displayModeBar": False},
                     ),
                 ],
@@ -283,14 +361,43 @@ def create_performance_tab():
 
 
 
-def create_explainability_tab():
+def create_explainability_tab(figures):
     return dcc.Tab(
         label="Explainability",
         children=[
+            html.Div(
+                [
+                    html.Label("Rank features by: "),
+                    dcc.RadioItems(
+                        id="shap-ranking",
+                        options=[{"label": "Average SHAP value", "value": "mean"},
+                                 {"label": "Average |SHAP value|", "value": "mean_abs"}],
+                        value=DEFAULT_SHAP_RANKING,
+                        inline=True,
+                        labelStyle={"display": "inline-block", "margin-left": "25px"},
+                    ),
+                    html.Label("Top features: ", style={"margin-left": "50px"}),
+                    dcc.Dropdown(
+                        id="shap-top-k",
+                        options=[{"label": str(k), "value": k} for k in SHAP_TOP_K_OPTIONS],
+                        value=SHAP_TOP_K_OPTIONS[0],
+                        clearable=False,
+                        style={"width": "80px"},
+                    ),
+                ],
+                style={
+                    "width": "100%",
+                    "padding": "20px 20px 0px 20px",
+                    "display": "flex",
+                    "justify-content": "center",
+                    "align-items": "center",
+                },
+            ),
             html.Div(
                 [
                     dcc.Graph(
                         id="shap-barplot",
+                        figure=figures["shap-barplot"],
                         config={"displayModeBar": False},
                     ),
                 ],
@@ -302,10 +409,61 @@ def create_explainability_tab():
                     "margin-bottom": "10px",
                 },
             ),
+            html.Div(
+                [
+                    # Quantiles and points of a random sample of the
+                    # selected records
+                    dcc.Graph(
+                        id="shap-distribution",
+                        figure=figures["shap-distribution"],
+                        config={"displayModeBar": False},
+                    ),
+                ],
+                style={
+                    "width": "100%",
+                    "display": "inline-block",
+                    "vertical-align": "top",
+                    "margin-bottom": "10px",
+                },
+            ),
+            html.Div(
+                [
+                    html.Label("Compare subgroups by: "),
+                    dcc.Dropdown(
+                        id="shap-subgroup-dimension",
+                        options=[{"label": label, "value": dimension} for dimension, label in SUBGROUP_LABELS.items()],
+                        value=DEFAULT_SHAP_DIMENSION,
+                        clearable=False,
+                        style={"width": "200px", "margin-left": "10px"},
+                    ),
+                ],
+                style={
+                    "width": "100%",
+                    "padding": "0px 20px",
+                    "display": "flex",
+                    "justify-content": "center",
+                    "align-items": "center",
+                },
+            ),
+            html.Div(
+                [
+                    dcc.Graph(
+                        id="shap-subgroups",
+                        figure=figures["shap-subgroups"],
+                        config={"displayModeBar": False},
+                    ),
+                ],
+                style={
+                    "width": "100%",
+                    "display": "inline-block",
+                    "vertical-align": "top",
+                    "margin-bottom": "10px",
+                },
+            ),
         ],
     )
 
-def create_confusion_matrix_tab():
+def create_confusion_matrix_tab(figures):
     return dcc.Tab(
         label="Confusion Matrix",
         children=[
@@ -316,7 +474,7 @@ def create_confusion_matrix_tab():
                         id="cutoff-slider",
                         min=0,
                         max=1,
-                        step=0.005,
+                        step=CUTOFF_STEP,
                         value=0.5,
                         marks={i / 10: f"{i / 10:.1f}" for i in range(0, 11)},
                     ),
@@ -327,6 +485,7 @@ def create_confusion_matrix_tab():
                 [
                     dcc.Graph(
                         id="confusion-matrix",
+                        figure=figures["confusion-matrix"],
                         config={"displayModeBar": False},
                     ),
                 ],
@@ -341,15 +500,267 @@ def create_confusion_matrix_tab():
         ],
     )
 
-def create_main_content():
+def subgroup_table_columns(dimensions):
+    percentage = Format(precision=1, scheme=Scheme.percentage)
+    metric = Format(precision=3, scheme=Scheme.fixed)
+    return [{"name": SUBGROUP_LABELS[dimension], "id": dimension} for dimension in dimensions] + [
+        {"name": "Records", "id": "count", "type": "numeric"},
+        {"name": "Complication Rate", "id": "complication_rate", "type": "numeric", "format": percentage},
+        {"name": "AUROC", "id": "auroc", "type": "numeric", "format": metric},
+        {"name": "Sensitivity", "id": "sensitivity", "type": "numeric", "format": metric},
+        {"name": "Specificity", "id": "specificity", "type": "numeric", "format": metric},
+    ]
+
+def create_subgroups_tab(min_count):
+    return dcc.Tab(
+        label="Subgroups",
+        children=[
+            html.Div(
+                [
+                    html.Label("Cutoff Threshold: "),
+                    dcc.Slider(
+                        id="subgroup-cutoff-slider",
+                        min=0,
+                        max=1,
+                        step=CUTOFF_STEP,
+                        value=DEFAULT_CUTOFF,
+                        marks={i / 10: f"{i / 10:.1f}" for i in range(0, 11)},
+                    ),
+                ],
+                style={"width": "100%", "padding": "20px 20px 0px 20px"},
+            ),
+            html.Div(
+                [
+                    html.Label("Subgroups by: "),
+                    dcc.Checklist(
+                        id="subgroup-dimensions",
+                        options=[{"label": label, "value": dimension} for dimension, label in SUBGROUP_LABELS.items()],
+                        value=list(SUBGROUP_LABELS),
+                        inline=True,
+                        labelStyle={"display": "inline-block", "margin-left": "25px"},
+                    ),
+                    html.Label("Minimum records: ", style={"margin-left": "50px"}),
+                    dcc.Input(
+                        id="subgroup-min-count",
+                        type="number",
+                        min=min_count,
+                        step=1,
+                        value=min_count,
+                        debounce=True,
+                        style={"width": "80px"},
+                    ),
+                ],
+                style={
+                    "width": "100%",
+                    "padding": "20px 20px 0px 20px",
+                    "display": "flex",
+                    "justify-content": "center",
+                },
+            ),
+            background_status("subgroup-table"),
+            html.Div(
+                [
+                    # Sorted by AUROC, worst first; suppressed subgroups only
+                    # show their labels
+                    dash_table.DataTable(
+                        id="subgroup-table",
+                        columns=subgroup_table_columns(list(SUBGROUP_LABELS)),
+                        sort_action="native",
+                        sort_by=[{"column_id": "auroc", "direction": "asc"}],
+                        page_size=20,
+                        style_cell={"fontFamily": "sans-serif", "padding": "5px"},
+                        style_header={"fontWeight": "bold"},
+                        style_data_conditional=[
+                            {"if": {"filter_query": "{count} is blank"}, "color": "#999999", "fontStyle": "italic"},
+                        ],
+                    ),
+                ],
+                style={"width": "100%", "padding": "20px"},
+            ),
+        ],
+    )
+
+DRIFT_GROUPS = dict({"month": "Month"}, **SUBGROUP_LABELS)
+DRIFT_COLUMNS = [
+    {"name": "Records", "id": "count", "type": "numeric"},
+    {"name": "Reference Records", "id": "reference_count", "type": "numeric"},
+    {"name": "PSI", "id": "psi", "type": "numeric", "format": Format(precision=3, scheme=Scheme.fixed)},
+    {"name": "KS", "id": "ks", "type": "numeric", "format": Format(precision=3, scheme=Scheme.fixed)},
+    {"name": "Mean Shift (SD)", "id": "mean_shift", "type": "numeric", "format": Format(precision=2, scheme=Scheme.fixed)},
+]
+
+def drift_table_columns(by):
+    return [{"name": DRIFT_GROUPS[by], "id": "group"}, {"name": "Feature", "id": "feature"}] + DRIFT_COLUMNS
+
+def drift_table_styles(psi_limit, ks_limit, mean_shift_limit):
+    # Values over their alert limit in red
+    highlight = {"backgroundColor": "#F8D7DA", "color": "#8A1C24"}
+    return [
+        dict({"if": {"filter_query": f"{{psi}} >= {psi_limit}", "column_id": "psi"}}, **highlight),
+        dict({"if": {"filter_query": f"{{ks}} >= {ks_limit}", "column_id": "ks"}}, **highlight),
+        dict({"if": {"filter_query": f"{{mean_shift}} >= {mean_shift_limit} || {{mean_shift}} <= {-mean_shift_limit}",
+                     "column_id": "mean_shift"}}, **highlight),
+        {"if": {"filter_query": "{count} is blank"}, "color": "#999999", "fontStyle": "italic"},
+    ]
+
+def drift_alert_list(alerts, max_alerts=20):
+    if not len(alerts):
+        return html.P("No drift above the alert limits.")
+    items = [
+        html.Li(f"{alert['group']} \u2013 {alert['feature']}: PSI {alert['psi']:.3f}, KS {alert['ks']:.3f}, "
+                f"mean shift {alert['mean_shift']:+.2f} SD")
+        for alert in alerts[:max_alerts]
+    ]
+    more = [html.P(f"and {len(alerts) - max_alerts} more")] if len(alerts) > max_alerts else []
+    return [html.P(f"{len(alerts)} drift alert{'s' if len(alerts) > 1 else ''}:", style={"fontWeight": "bold"}),
+            html.Ul(items)] + more
+
+def create_drift_tab(month_options):
+    return dcc.Tab(
+        label="Drift",
+        children=[
+            html.Div(
+                [
+                    html.Label("Reference from: "),
+                    dcc.Dropdown(
+                        id="drift-reference-start",
+                        clearable=False,
+                        options=dropdown_options(month_options),
+                        value=default_reference_months(month_options)[0],
+                        style={"width": "180px", "margin-left": "10px"},
+                    ),
+                    html.Label("to: ", style={"margin-left": "10px"}),
+                    dcc.Dropdown(
+                        id="drift-reference-end",
+                        clearable=False,
+                        options=dropdown_options(month_options),
+                        value=default_reference_months(month_options)[1],
+                        style={"width": "180px", "margin-left": "10px"},
+                    ),
+                    html.Label("Compare by: ", style={"margin-left": "50px"}),
+                    dcc.RadioItems(
+                        id="drift-group-by",
+                        options=[{"label": label, "value": group} for group, label in DRIFT_GROUPS.items()],
+                        value="month",
+                        inline=True,
+                        labelStyle={"display": "inline-block", "margin-left": "15px"},
+                    ),
+                ],
+                style={
+                    "width": "100%",
+                    "padding": "20px 20px 0px 20px",
+                    "display": "flex",
+                    "align-items": "center",
+                },
+            ),
+            background_status("drift"),
+            html.Div(id="drift-alerts", style={"width": "100%", "padding": "20px 20px 0px 20px"}),
+            html.Div(
+                [
+                    # The months of the sidebar timeframe (or its subgroups)
+                    # against the reference period, for the predicted risk
+                    # and every SHAP column
+                    dash_table.DataTable(
+                        id="drift-table",
+                        columns=drift_table_columns("month"),
+                        sort_action="native",
+                        filter_action="native",
+                        page_size=20,
+                        style_cell={"fontFamily": "sans-serif", "padding": "5px"},
+                        style_header={"fontWeight": "bold"},
+                    ),
+                ],
+                style={"width": "100%", "padding": "20px"},
+            ),
+        ],
+    )
+
+CALIBRATION_COLUMNS = [
+    {"name": "Records", "id": "count", "type": "numeric"},
+    {"name": "Observed Rate", "id": "observed", "type": "numeric", "format": Format(precision=4, scheme=Scheme.fixed)},
+    {"name": "Mean Predicted Risk", "id": "expected", "type": "numeric", "format": Format(precision=4, scheme=Scheme.fixed)},
+    {"name": "O/E Ratio", "id": "oe_ratio", "type": "numeric", "format": Format(precision=2, scheme=Scheme.fixed)},
+    {"name": "Brier Score", "id": "brier", "type": "numeric", "format": Format(precision=4, scheme=Scheme.fixed)},
+    {"name": "ECE", "id": "ece", "type": "numeric", "format": Format(precision=4, scheme=Scheme.fixed)},
+]
+
+def calibration_table_columns(by):
+    return [{"name": DRIFT_GROUPS[by], "id": "group"}] + CALIBRATION_COLUMNS
+
+def calibration_summary(metrics):
+    if not metrics["count"]:
+        return html.P("No records in the selection.")
+    return html.P(
+        f"Brier score {metrics['brier']:.4f} \u00b7 ECE {metrics['ece']:.4f} \u00b7 "
+        f"O/E ratio {metrics['oe_ratio']:.2f} (observed {metrics['observed']:.2%}, expected {metrics['expected']:.2%})",
+        style={"fontWeight": "bold"},
+    )
+
+def create_calibration_tab(figures):
+    return dcc.Tab(
+        label="Calibration",
+        children=[
+            html.Div(id="calibration-summary", style={"width": "100%", "padding": "20px 20px 0px 20px"}),
+            html.Div(
+                [
+                    # Bins of about equal numbers of records of the selection
+                    dcc.Graph(
+                        id="calibration-curve",
+                        figure=figures["calibration-curve"],
+                        config={"displayModeBar": False},
+                    ),
+                ],
+                style={"width": "100%", "display": "inline-block", "vertical-align": "top"},
+            ),
+            html.Div(
+                [
+                    html.Label("Calibration by: "),
+                    dcc.RadioItems(
+                        id="calibration-group-by",
+                        options=[{"label": label, "value": group} for group, label in DRIFT_GROUPS.items()],
+                        value="month",
+                        inline=True,
+                        labelStyle={"display": "inline-block", "margin-left": "15px"},
+                    ),
+                ],
+                style={
+                    "width": "100%",
+                    "padding": "20px 20px 0px 20px",
+                    "display": "flex",
+                    "align-items": "center",
+                },
+            ),
+            html.Div(
+                [
+                    dash_table.DataTable(
+                        id="calibration-table",
+                        columns=calibration_table_columns("month"),
+                        sort_action="native",
+                        page_size=20,
+                        style_cell={"fontFamily": "sans-serif", "padding": "5px"},
+                        style_header={"fontWeight": "bold"},
+                        style_data_conditional=[
+                            {"if": {"filter_query": "{count} is blank"}, "color": "#999999", "fontStyle": "italic"},
+                        ],
+                    ),
+                ],
+                style={"width": "100%", "padding": "20px"},
+            ),
+        ],
+    )
+
+def create_main_content(figures, subgroup_min_count, month_options):
     return html.Div(
         [
             dcc.Tabs(
                 [
-                    create_overview_tab(),
-                    create_performance_tab(),
-                    create_explainability_tab(),
-                    create_confusion_matrix_tab(),
+                    create_overview_tab(figures),
+                    create_performance_tab(figures),
+                    create_explainability_tab(figures),
+                    create_confusion_matrix_tab(figures),
+                    create_subgroups_tab(subgroup_min_count),
+                    create_drift_tab(month_options),
+                    create_calibration_tab(figures),
                 ]
             )
         ]
@@ -357,15 +768,17 @@ def create_main_content():
 
         
 
-def create_layout(month_options, sex_options, age_options, site_options, op_type_options, model_options, run_id_options):
+def create_layout(month_options, sex_options, age_options, site_options, op_type_options, model_options, run_id_options, figures,
+                  subgroup_min_count):
     layout = html.Div(
         [
             create_header(),
+            dcc.Store(id="threshold-summary"),
             html.Div(
                 [
                     create_sidebar(month_options, sex_options, age_options, site_options, op_type_options, model_options, run_id_options),
                     html.Div(
-                        create_main_content(),
+                        create_main_content(figures, subgroup_min_count, month_options),
                         style={
                             "width": "75%",
                             "display": "inline-block",
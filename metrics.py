@@ -0,0 +1,141 @@
+# IMPORTS
+
+import numpy as np
+
+
+# THRESHOLD SWEEP
+#
+# Scores are sorted once per selection and reduced to their unique values
+# with the cumulative number of negatives and positives at or below each of
+# them. Confusion counts for any cutoff are then a binary search, and the
+# ROC curve and AUROC fall out of the same arrays.
+
+def build_threshold_sweep(y_true, scores):
+    y_true = np.asarray(y_true)
+    scores = np.asarray(scores, dtype=float)
+    order = np.argsort(scores, kind="mergesort")
+    sorted_scores, is_positive = scores[order], y_true[order] == 1
+
+    # Last position of every unique score in the sorted order
+    last = np.flatnonzero(np.append(sorted_scores[1:] != sorted_scores[:-1], True)) if len(scores) else np.empty(0, dtype=int)
+    cum_pos = np.cumsum(is_positive)[last]
+    cum_neg = (last + 1) - cum_pos
+
+    return {
+        "thresholds": sorted_scores[last],
+        # Leading zero so that index j counts the scores below thresholds[j]
+        "cum_pos": np.concatenate([[0], cum_pos]),
+        "cum_neg": np.concatenate([[0], cum_neg]),
+        "n_pos": int(cum_pos[-1]) if len(last) else 0,
+        "n_neg": int(cum_neg[-1]) if len(last) else 0,
+    }
+
+
+def confusion_counts(sweep, threshold, inclusive=True):
+    # Counts for predicting high risk when score >= threshold (inclusive) or
+    # score > threshold; threshold may be a scalar or an array
+    side = "left" if inclusive else "right"
+    j = np.searchsorted(sweep["thresholds"], threshold, side=side)
+    tn, fn = sweep["cum_neg"][j], sweep["cum_pos"][j]
+    fp, tp = sweep["n_neg"] - tn, sweep["n_pos"] - fn
+    return tn, fp, fn, tp
+
+
+def roc_curve(sweep):
+    # Points for every unique threshold, from the highest one down
+    fps = sweep["n_neg"] - sweep["cum_neg"][::-1]
+    tps = sweep["n_pos"] - sweep["cum_pos"][::-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fpr = fps / sweep["n_neg"]
+        tpr = tps / sweep["n_pos"]
+    thresholds = np.concatenate([[np.inf], sweep["thresholds"][::-1]])
+    return fpr, tpr, thresholds
+
+
+def auroc(sweep):
+    # Trapezoidal area under the ROC curve; None when only one class is present
+    if sweep["n_pos"] == 0 or sweep["n_neg"] == 0:
+        return None
+    fpr, tpr, _ = roc_curve(sweep)
+    return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+
+def roc_auc_score(y_true, scores):
+    # Same value as sklearn.metrics.roc_auc_score for binary outcomes,
+    # without its input validation; None when only one class is present
+    return auroc(build_threshold_sweep(y_true, scores))
+
+
+# GROUPED THRESHOLD SWEEP
+#
+# The same sweep for many groups (months, sites, model versions, ...) from
+# a single sort by (group, score). Rows sharing a group and score form a
+# tie run; AUROC per group is the Mann-Whitney rank-sum statistic summed
+# over those runs, and confusion counts at a cutoff are one vectorized
+# binary search for all groups.
+
+def build_grouped_sweep(group_codes, y_true, scores, n_groups):
+    group_codes = np.asarray(group_codes, dtype=np.int64)
+    keep = group_codes >= 0
+    group_codes = group_codes[keep]
+    y_true = np.asarray(y_true)[keep]
+    scores = np.asarray(scores, dtype=float)[keep]
+
+    # Dense rank of every score, then a stable sort by group (a radix sort
+    # for small group counts) gives the (group, score) order
+    score_order = np.argsort(scores, kind="stable")
+    sorted_scores = scores[score_order]
+    new_value = np.append(True, sorted_scores[1:] != sorted_scores[:-1]) if len(scores) else np.empty(0, dtype=bool)
+    unique_scores = sorted_scores[new_value]
+    ranks = np.empty(len(scores), dtype=np.int64)
+    ranks[score_order] = np.cumsum(new_value) - 1
+
+    code_dtype = np.int16 if n_groups < 2 ** 15 else np.int64
+    order = score_order[np.argsort(group_codes[score_order].astype(code_dtype), kind="stable")]
+    groups, is_positive = group_codes[order], y_true[order] == 1
+
+    # Runs are keyed by (group, rank of score) so one searchsorted locates a
+    # cutoff in every group at once
+    keys = groups * (len(unique_scores) + 1) + ranks[order]
+    last = np.flatnonzero(np.append(keys[1:] != keys[:-1], True)) if len(keys) else np.empty(0, dtype=int)
+    run_keys, run_groups = keys[last], groups[last]
+    cum_pos = np.concatenate([[0], np.cumsum(is_positive)[last]])
+    cum_all = np.concatenate([[0], last + 1])
+    cum_neg = cum_all - cum_pos
+
+    n_pos = np.bincount(groups, weights=is_positive, minlength=n_groups).astype(np.int64)
+    n_neg = np.bincount(groups, minlength=n_groups) - n_pos
+    pos_before, neg_before = np.cumsum(n_pos) - n_pos, np.cumsum(n_neg) - n_neg
+
+    # Mann-Whitney U: each positive beats the negatives below it in its
+    # group and ties with the negatives in its own run
+    run_pos, run_neg = np.diff(cum_pos), np.diff(cum_neg)
+    neg_below = cum_neg[:-1] - neg_before[run_groups]
+    wins = np.bincount(run_groups, weights=run_pos * (neg_below + 0.5 * run_neg), minlength=n_groups)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        auroc = wins / (n_pos * n_neg)
+
+    return {
+        "n_groups": n_groups,
+        "unique_scores": unique_scores,
+        "run_keys": run_keys,
+        "cum_pos": cum_pos,
+        "cum_neg": cum_neg,
+        "pos_before": pos_before,
+        "neg_before": neg_before,
+        "n_pos": n_pos,
+        "n_neg": n_neg,
+        "auroc": np.where((n_pos > 0) & (n_neg > 0), auroc, np.nan),
+    }
+
+
+def grouped_confusion_counts(sweep, threshold, inclusive=True):
+    # Per-group counts for predicting high risk when score >= threshold
+    # (inclusive) or score > threshold
+    side = "left" if inclusive else "right"
+    rank = np.searchsorted(sweep["unique_scores"], threshold, side=side)
+    targets = np.arange(sweep["n_groups"]) * (len(sweep["unique_scores"]) + 1) + rank
+    j = np.searchsorted(sweep["run_keys"], targets, side="left")
+    tn = sweep["cum_neg"][j] - sweep["neg_before"]
+    fn = sweep["cum_pos"][j] - sweep["pos_before"]
+    return tn, sweep["n_neg"] - tn, fn, sweep["n_pos"] - fn
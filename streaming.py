@@ -0,0 +1,224 @@
+# IMPORTS
+
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from columnar import make_staging_directory, publish_directory, read_manifest, write_manifest
+from cube import build_cube, merge_cubes, CUBE_VERSION
+
+
+# STREAMING INGEST
+#
+# Reads a prediction log in bounded chunks and appends every column to a raw
+# column file, so peak memory depends on the chunk size and not on the file
+# size. Categorical values get global codes in order of first appearance;
+# codes never change, so chunks written early stay valid as new categories
+# show up. The filter cube is accumulated chunk by chunk alongside, and the
+# row range and dates of every chunk are kept in the manifest as partitions.
+# New batches are appended to a published cache the same way: the column
+# files grow past the rows of the manifest, which readers never map, and
+# the new manifest publishes them.
+
+STREAM_CHUNKSIZE = 200_000
+# Categories are only known once the whole file has been read, so codes are
+# written wide enough for any column and then narrowed to code_dtype
+CODE_DTYPE = "int32"
+CUBE_FILE = "cube.pkl"
+
+
+def code_dtype(n_categories):
+    # The code type pandas gives a categorical with this many categories;
+    # codes stored in it are mapped as they are, other types are copied
+    for dtype in ["int8", "int16", "int32"]:
+        if n_categories < np.iinfo(dtype).max:
+            return dtype
+    return "int64"
+
+
+def as_categorical(values):
+    return values if isinstance(values.dtype, pd.CategoricalDtype) else values.astype("category")
+
+
+def add_categories(values, categories, lookup):
+    for value in as_categorical(values).cat.categories:
+        if value not in lookup:
+            lookup[value] = len(categories)
+            categories.append(value)
+
+
+def encode_categories(values, categories, lookup, dtype=CODE_DTYPE):
+    values = as_categorical(values)
+    add_categories(values, categories, lookup)
+    if len(categories) > np.iinfo(dtype).max:
+        raise ValueError(f"{values.name} has more categories than {np.dtype(dtype)} codes can hold")
+    # The trailing -1 maps missing values (local code -1) to -1
+    mapping = np.array([lookup[value] for value in values.cat.categories] + [-1], dtype=dtype)
+    return mapping[values.cat.codes.to_numpy()]
+
+
+def convert_codes(directory, entry, length, dtype):
+    # Rewrites the first length codes of a column with another code type,
+    # chunk by chunk, into a new file; processes mapping the previous
+    # manifest keep reading the old one. Returns the old file name.
+    old_file, new_file = entry["file"], f"{entry['file'].split('.')[0]}.{dtype}.bin"
+    with open(os.path.join(directory, old_file), "rb") as source, \
+            open(os.path.join(directory, new_file), "wb") as target:
+        for start in range(0, length, STREAM_CHUNKSIZE):
+            count = min(STREAM_CHUNKSIZE, length - start)
+            np.fromfile(source, dtype=entry["dtype"], count=count).astype(dtype).tofile(target)
+    entry.update(file=new_file, dtype=dtype)
+    return old_file
+
+
+def stream_ingest(csv_file_path, directory, dtype=None, prepare=None, source=None, chunksize=STREAM_CHUNKSIZE):
+    tmp_dir = make_staging_directory(directory)
+    columns, files, lookups = [], [], []
+    cube, partitions, length = None, [], 0
+
+    try:
+        for chunk in pd.read_csv(csv_file_path, dtype=dtype, parse_dates=["date"], chunksize=chunksize):
+            if prepare is not None:
+                chunk = prepare(chunk)
+
+            if not columns:
+                for i, name in enumerate(chunk.columns):
+                    entry = {"name": name, "file": f"{i}.bin"}
+                    column_dtype = chunk[name].dtype
+                    if (isinstance(column_dtype, pd.CategoricalDtype) or pd.api.types.is_object_dtype(column_dtype)
+                            or pd.api.types.is_string_dtype(column_dtype)):
+                        entry.update(dtype=CODE_DTYPE, categories=[])
+                    else:
+                        entry["dtype"] = str(chunk[name].dtype)
+                    columns.append(entry)
+                    files.append(open(os.path.join(tmp_dir, entry["file"]), "wb"))
+                    lookups.append({})
+
+            cube = write_chunk(chunk, columns, files, lookups, cube, partitions, length)
+            length += len(chunk)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    finally:
+        for f in files:
+            f.close()
+
+    if not columns:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise ValueError(f"{csv_file_path} contains no records")
+
+    for entry in columns:
+        if "categories" in entry and code_dtype(len(entry["categories"])) != entry["dtype"]:
+            os.remove(os.path.join(tmp_dir, convert_codes(tmp_dir, entry, length, code_dtype(len(entry["categories"])))))
+    write_manifest(tmp_dir, columns, length, source, partitions=partitions)
+    write_cube(tmp_dir, cube)
+    publish_directory(tmp_dir, directory)
+    return cube
+
+
+def write_chunk(chunk, columns, files, lookups, cube, partitions, length):
+    # Appends the rows of a chunk starting at row length to the column files
+    # and partitions, and returns the cube with them
+    for entry, f, lookup in zip(columns, files, lookups):
+        if "categories" in entry:
+            values = encode_categories(chunk[entry["name"]], entry["categories"], lookup, entry["dtype"])
+        else:
+            values = chunk[entry["name"]].to_numpy().astype(entry["dtype"], copy=False)
+        values.tofile(f)
+
+    # Later chunks are binned with the SHAP edges of the first one
+    chunk_cube = build_cube(chunk, shap_edges=cube["shap_edges"] if cube is not None else None)
+    partitions.append({
+        "start": length,
+        "stop": length + len(chunk),
+        "min_date": str(chunk["date"].min()),
+        "max_date": str(chunk["date"].max()),
+    })
+    return chunk_cube if cube is None else merge_cubes(cube, chunk_cube)
+
+
+def is_appendable(directory):
+    # Streamed caches only: their columns are raw files that can grow
+    manifest = read_manifest(directory)
+    return manifest is not None and all("dtype" in entry for entry in manifest["columns"])
+
+
+def append_batches(directory, batches):
+    # Appends (name, prepared batch) pairs to a published streamed cache in
+    # place and publishes them with a new manifest and cube; the names are
+    # kept in the manifest, so every process can tell which batches the
+    # cache holds. Callers hold the cache_lock.
+    directory = os.path.realpath(directory)
+    manifest = read_manifest(directory)
+    columns, length = manifest["columns"], manifest["length"]
+    lookups = [{value: code for code, value in enumerate(entry.get("categories", []))} for entry in columns]
+    partitions, names = manifest.get("partitions", []), manifest.get("batches", [])
+    cube = read_cube(directory, length)
+    # A stale cube is rebuilt by load_cube, not extended
+    stale_cube = cube is None
+
+    # Written as one chunk, so the cube is built and merged once per call
+    chunk = pd.concat([batch for _, batch in batches], ignore_index=True)
+    # Code files whose type cannot hold the new categories are widened; the
+    # old files are removed once the new manifest is published
+    replaced = []
+    for entry, lookup in zip(columns, lookups):
+        if "categories" in entry:
+            add_categories(chunk[entry["name"]], entry["categories"], lookup)
+            dtype = code_dtype(len(entry["categories"]))
+            if np.dtype(dtype).itemsize > np.dtype(entry["dtype"]).itemsize:
+                replaced.append(convert_codes(directory, entry, length, dtype))
+
+    files = [open(os.path.join(directory, entry["file"]), "r+b") for entry in columns]
+    try:
+        for f, entry in zip(files, columns):
+            # Rows past the manifest are left over from an interrupted append
+            f.truncate(length * np.dtype(entry["dtype"]).itemsize)
+            f.seek(0, os.SEEK_END)
+        if len(chunk):
+            cube = write_chunk(chunk, columns, files, lookups, cube, partitions, length)
+            length += len(chunk)
+        names.extend(name for name, _ in batches)
+    finally:
+        for f in files:
+            f.close()
+
+    extra = {key: value for key, value in manifest.items() if key not in ("source", "length", "columns")}
+    write_manifest(directory, columns, length, manifest["source"], **dict(extra, partitions=partitions, batches=names))
+    # After the manifest: if the process dies in between, the cube counts
+    # fewer rows than the manifest and is rebuilt
+    if not stale_cube:
+        write_cube(directory, cube)
+    for name in replaced:
+        os.remove(os.path.join(directory, name))
+    return length
+
+
+def write_cube(directory, cube):
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        pickle.dump(cube, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, os.path.join(directory, CUBE_FILE))
+
+
+def read_cube(directory, length=None):
+    # None when the cube is stale, to be rebuilt: missing, unreadable
+    # (truncated, or pickled by other versions of pandas or numpy), of an
+    # older version of the cube, or not counting the length rows of the
+    # cache (by default those of its manifest)
+    directory = os.path.realpath(directory)
+    if length is None:
+        manifest = read_manifest(directory)
+        length = manifest["length"] if manifest is not None else None
+    try:
+        with open(os.path.join(directory, CUBE_FILE), "rb") as f:
+            cube = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, IndexError, TypeError, ValueError):
+        return None
+    if not isinstance(cube, dict) or cube.get("version") != CUBE_VERSION:
+        return None
+    return cube if length is None or int(cube["cells"]["count"].sum()) == length else None
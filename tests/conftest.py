@@ -0,0 +1,30 @@
+# IMPORTS
+
+import importlib
+import os
+
+import pytest
+
+from data_generator import write_data
+
+
+# FIXTURES
+#
+# The app loads its data at import, so it is imported once per test session
+# on a small generated log, with the cache warm-up off and callbacks waiting
+# for their background tasks.
+
+INGEST_TOKEN = "test-token"
+
+@pytest.fixture(scope="session")
+def log_file(tmp_path_factory):
+    csv_file_path = str(tmp_path_factory.mktemp("log") / "data.csv")
+    write_data(csv_file_path, 20_000)
+    return csv_file_path
+
+
+@pytest.fixture(scope="session")
+def dashboard(log_file, tmp_path_factory):
+    os.environ.update(DATA_FILE=log_file, WARMUP="0", BACKGROUND_WAIT="600", INGEST_TOKEN=INGEST_TOKEN,
+                      INGEST_DIR=str(tmp_path_factory.mktemp("incoming")))
+    return importlib.import_module("app")
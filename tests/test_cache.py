@@ -0,0 +1,56 @@
+# IMPORTS
+
+import os
+import stat
+
+import pytest
+
+from cache import create_result_cache
+
+
+# RESULT CACHE
+
+def test_result_is_stored_under_the_version_it_was_computed_for():
+    cache = create_result_cache(version="old")
+
+    @cache.memoize("stage")
+    def compute(x):
+        # New data arrives while the old data is being computed on
+        cache.set_version("new")
+        return ("old", x)
+
+    assert compute(1) == ("old", 1)
+    assert cache.get(("stage", 1)) == (False, None)
+
+    @cache.memoize("stage")
+    def recompute(x):
+        return ("new", x)
+
+    assert recompute(1) == ("new", 1)
+    assert cache.get(("stage", 1)) == (True, ("new", 1))
+
+
+def test_entries_are_evicted_past_the_byte_budget():
+    cache = create_result_cache(max_megabytes=0.01)
+    for i in range(10):
+        cache.set(("stage", i), bytes(2000))
+    stats = cache.stats()
+    assert stats["bytes"] <= 0.01 * 1024 * 1024 and stats["evictions"] > 0
+    assert cache.get(("stage", 9))[0]
+
+
+def test_disk_cache_directory_is_private(tmp_path):
+    directory = tmp_path / "cache"
+    cache = create_result_cache(backend="disk", directory=str(directory), version=1)
+    assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+    cache.set(("stage", 1), "value")
+    assert cache.get(("stage", 1)) == (True, "value")
+
+
+def test_disk_cache_refuses_a_directory_others_can_write(tmp_path):
+    # e.g. created first by another user to plant pickles
+    directory = tmp_path / "shared"
+    directory.mkdir()
+    os.chmod(directory, 0o777)
+    with pytest.raises(PermissionError):
+        create_result_cache(backend="disk", directory=str(directory))
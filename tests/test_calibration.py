@@ -0,0 +1,63 @@
+# IMPORTS
+
+import numpy as np
+import pytest
+
+from calibration import CALIBRATION_BINS, cube_calibration, cube_calibration_by
+from cube import build_cube, score_to_bin, select_cells
+from data_generator import generate_data
+from drift import quantile_bins
+from filter_index import build_filter_index, query_filter_index
+from helpers import log_dtypes, prepare_data
+
+
+# CALIBRATION
+#
+# Calibration from the cube against the rows: the Brier score and the O/E
+# ratio are exact, and the ECE is within half a fine score bin.
+
+SELECTIONS = [
+    ("All", "All", "All", "2022-07", "2023-04", "All", "All", "All"),
+    ("Male", "61-70", "All", "2022-09", "2023-01", "All", "NSEC", "All"),
+    ("All", "All", "v2", "2023-02", "2023-04", "Run 3", "All", "knee"),
+]
+
+
+@pytest.fixture(scope="module")
+def log():
+    df = generate_data(30_000, seed=13)
+    df = prepare_data(df.astype(log_dtypes(df.columns)))
+    return df, build_filter_index(df), build_cube(df)
+
+
+def row_calibration(rows, starts, n_bins):
+    # Brier score, O/E ratio and ECE of the rows, the ECE over the coarse
+    # bins of the cube
+    p = rows["pred_prob"].to_numpy(dtype=float)
+    y = rows["outcome"].to_numpy()
+    coarse = np.searchsorted(starts, score_to_bin(p, n_bins), side="right") - 1
+    return np.mean((p - y) ** 2), y.sum() / p.sum(), np.abs(np.bincount(coarse, weights=y - p)).sum() / len(p)
+
+
+@pytest.mark.parametrize("filters", SELECTIONS)
+def test_cube_calibration_matches_the_rows(log, filters):
+    df, index, cube = log
+    rows = df.take(query_filter_index(index, *filters))
+    mask = select_cells(cube, *filters)
+    curve, metrics = cube_calibration(cube, mask)
+    assert curve["count"].sum() == metrics["count"] == len(rows)
+
+    starts = quantile_bins(cube["score_hist"][mask].sum(axis=(0, 1)), CALIBRATION_BINS)
+    brier, oe_ratio, ece = row_calibration(rows, starts, cube["n_bins"])
+    assert metrics["brier"] == pytest.approx(brier, rel=1e-9)
+    assert metrics["oe_ratio"] == pytest.approx(oe_ratio, rel=1e-9)
+    assert abs(metrics["ece"] - ece) <= 0.5 / cube["n_bins"]
+
+    by_month = cube_calibration_by(cube, mask, "month")
+    months = rows["date"].dt.to_period("M").astype(str)
+    assert len(by_month) == months.nunique()
+    for _, month_metrics in by_month.iterrows():
+        month_rows = rows[months == month_metrics["group"]]
+        p, y = month_rows["pred_prob"].to_numpy(dtype=float), month_rows["outcome"].to_numpy()
+        assert month_metrics["count"] == len(month_rows)
+        assert month_metrics["brier"] == pytest.approx(np.mean((p - y) ** 2), rel=1e-9)
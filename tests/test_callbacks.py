@@ -0,0 +1,47 @@
+# IMPORTS
+
+from instrumentation import REGISTRY
+
+
+# CALLBACK STAGES
+#
+# Every output recomputes only the stages behind its own inputs: the filters
+# share one selection across callbacks, the cutoff sliders and metric
+# checkboxes never reach the server, and the server-side subgroup cutoff
+# reuses the cached selection and summary.
+
+FILTERS = ("Female", "All", "All", "September 2022", "December 2022", "All", "All", "All")
+BROWSER_INPUTS = {"cutoff-slider", "cutoff-slider-2", "metrics-checkboxes"}
+STAGES = ["selection", "summary", "threshold_summary", "monthly_auroc"]
+
+
+def stage_runs(stage):
+    histogram = REGISTRY.histograms.get(("modelmonitor_stage_seconds", (("stage", stage),)))
+    return sum(histogram.counts) if histogram is not None else 0
+
+
+def test_sliders_are_handled_in_the_browser(dashboard):
+    # Clientside callbacks have no server function
+    for output, callback in dashboard.app.callback_map.items():
+        if "callback" not in callback:
+            continue
+        inputs = {item["id"] for item in callback["inputs"]}
+        assert not inputs & BROWSER_INPUTS, output
+
+
+def test_callbacks_share_the_selection(dashboard):
+    before = [stage_runs(stage) for stage in STAGES]
+    dashboard.update_indicators(*FILTERS)
+    dashboard.update_threshold_summary(*FILTERS, "month", 0, None)
+    # Once each, the monthly AUROC for the threshold summary
+    assert [stage_runs(stage) for stage in STAGES] == [runs + 1 for runs in before]
+
+
+def test_subgroup_cutoff_reuses_the_selection(dashboard):
+    dashboard.update_indicators(*FILTERS)
+    dashboard.update_subgroup_table(*FILTERS, dashboard.SUBGROUP_DIMENSIONS, 0.075, 10, None)
+    before = stage_runs("selection"), stage_runs("summary"), stage_runs("subgroups")
+    for cutoff in [0.1, 0.15, 0.2]:
+        dashboard.update_subgroup_table(*FILTERS, dashboard.SUBGROUP_DIMENSIONS, cutoff, 10, None)
+    assert (stage_runs("selection"), stage_runs("summary")) == before[:2]
+    assert stage_runs("subgroups") == before[2] + 3
@@ -0,0 +1,66 @@
+# IMPORTS
+
+import os
+import threading
+
+import columnar
+from columnar import MANIFEST, file_digest as real_digest, read_columns, read_manifest
+from data_generator import write_data
+from helpers import load_data, prepare_data
+from streaming import stream_ingest
+
+
+# COLUMNAR CACHE
+
+def test_readers_always_see_a_cache_while_it_is_replaced(tmp_path):
+    csv_file_path = str(tmp_path / "data.csv")
+    write_data(csv_file_path, 1000)
+    directory = str(tmp_path / "data.csv.columns")
+    stream_ingest(csv_file_path, directory, prepare=prepare_data)
+
+    failures, done = [], threading.Event()
+
+    def read():
+        while not done.is_set():
+            try:
+                df = read_columns(directory)
+                if df is None or len(df) != 1000:
+                    failures.append(df)
+            except Exception as error:
+                failures.append(error)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    for _ in range(50):
+        stream_ingest(csv_file_path, directory, prepare=prepare_data)
+    done.set()
+    reader.join()
+    assert not failures
+    # Only the current version is left next to the link
+    assert len([name for name in os.listdir(tmp_path) if name.startswith(".data.csv.columns-")]) == 1
+
+
+def test_cache_without_manifest_is_rebuilt(tmp_path):
+    log_file = str(tmp_path / "data.csv")
+    write_data(log_file, 1000)
+    expected = load_data(log_file)
+    os.remove(os.path.join(log_file + ".columns", MANIFEST))
+    df = load_data(log_file)
+    assert df is not None and len(df) == len(expected)
+    assert os.path.exists(os.path.join(log_file + ".columns", MANIFEST))
+
+
+def test_a_touched_log_is_hashed_once(tmp_path, monkeypatch):
+    csv_file_path = str(tmp_path / "data.csv")
+    write_data(csv_file_path, 1000)
+    load_data(csv_file_path)
+    directory = csv_file_path + ".columns"
+    stat = os.stat(csv_file_path)
+    os.utime(csv_file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    hashed = []
+    monkeypatch.setattr(columnar, "file_digest", lambda path: hashed.append(path) or real_digest(path))
+    for _ in range(4):
+        assert columnar.is_cache_valid(directory, csv_file_path)
+    assert len(hashed) == 1
+    assert read_manifest(directory)["source"]["mtime"] == os.stat(csv_file_path).st_mtime_ns
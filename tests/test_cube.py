@@ -0,0 +1,79 @@
+# IMPORTS
+
+import pandas as pd
+import pytest
+from sklearn.metrics import roc_auc_score
+
+from cube import (auroc_error_bound, auroc_from_hist, build_cube, cube_auroc_error_bound, cube_filter_counts,
+                  cube_summary_metrics, rollup_by_month, select_cells)
+from data_generator import generate_data
+from filter_index import build_filter_index, query_filter_index
+from helpers import log_dtypes, prepare_data
+
+
+# FILTER CUBE
+#
+# The AUROC of the score sketches is within auroc_error_bound of the AUROC
+# of the rows, overall and per month, at any number of score bins. The
+# record counts of the filter options are those of the rows.
+
+SELECTIONS = [
+    ("All", "All", "All", "2022-07", "2023-04", "All", "All", "All"),
+    ("Male", "61-70", "All", "2022-09", "2023-01", "All", "NSEC", "All"),
+    ("All", "All", "v2", "2023-02", "2023-04", "Run 3", "All", "knee"),
+    ("Female", "All", "All", "2022-10", "2022-12", "All", "All", "hip"),
+]
+
+
+@pytest.fixture(scope="module")
+def log():
+    df = generate_data(50_000, seed=3)
+    df = prepare_data(df.astype(log_dtypes(df.columns)))
+    return df, build_filter_index(df)
+
+
+@pytest.mark.parametrize("n_bins", [10, 200])
+@pytest.mark.parametrize("filters", SELECTIONS)
+def test_sketch_auroc_is_within_its_error_bound(log, n_bins, filters):
+    df, index = log
+    cube = build_cube(df, n_bins=n_bins)
+    mask = select_cells(cube, *filters)
+    rows = df.take(query_filter_index(index, *filters))
+    assert rows["outcome"].nunique() == 2
+
+    exact = roc_auc_score(rows["outcome"], rows["pred_prob"])
+    _, _, sketch = cube_summary_metrics(cube, mask)
+    bound = cube_auroc_error_bound(cube, mask)
+    assert abs(sketch - exact) <= bound + 1e-12
+
+    months, hist = rollup_by_month(cube, mask, cube["score_hist"])
+    row_months = rows["date"].dt.to_period("M")
+    for month, month_hist, month_bound in zip(months, hist, auroc_error_bound(hist)):
+        month_rows = rows[row_months == month]
+        if month_rows["outcome"].nunique() < 2:
+            continue
+        sketch = auroc_from_hist(month_hist)
+        exact = roc_auc_score(month_rows["outcome"], month_rows["pred_prob"])
+        assert abs(sketch - exact) <= month_bound + 1e-12, month
+
+
+@pytest.mark.parametrize("filters", SELECTIONS)
+def test_filter_counts_are_the_records_under_the_other_filters(log, filters):
+    df, _ = log
+    sex, age, model, start_month, end_month, run_id, site, op_type = filters
+    months = df["date"].dt.to_period("M")
+    masks = {column: df[column] == value for column, value in [("sex", sex), ("age_group", age), ("model_version", model),
+                                                               ("run_id", run_id), ("site", site), ("op_type", op_type)]
+             if value != "All"}
+    masks["month"] = (months >= pd.Period(start_month, freq="M")) & (months <= pd.Period(end_month, freq="M"))
+
+    counts = cube_filter_counts(build_cube(df), *filters)
+    for column in ["sex", "age_group", "model_version", "month", "run_id", "site", "op_type"]:
+        others = pd.Series(True, index=df.index)
+        for other, mask in masks.items():
+            if other != column:
+                others &= mask
+        values = months if column == "month" else df[column]
+        expected = values[others].value_counts()
+        expected = expected[expected > 0]
+        assert counts[column].sort_index().to_dict() == expected.sort_index().to_dict(), column
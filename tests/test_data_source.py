@@ -0,0 +1,86 @@
+# IMPORTS
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_generator import generate_data
+from data_store import DataStore
+from data_source import PandasSource, SQLiteSource, write_sqlite
+from helpers import prepare_data
+
+
+# DATA SOURCES
+#
+# The SQLite log gives the app's stages the same results as the frame it
+# was read into.
+
+SELECTIONS = [
+    ("All", "All", "All", "2022-07", "2023-04", "All", "All", "All"),
+    ("Male", "61-70", "All", "2022-09", "2023-01", "All", "NSEC", "All"),
+    ("All", "All", "v2", "2023-02", "2023-04", "Run 3", "All", "knee"),
+    ("Female", "0-18", "All", "2022-08", "2022-08", "All", "All", "All"),
+]
+
+
+@pytest.fixture(scope="module")
+def sources(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("sqlite") / "log.sqlite")
+    write_sqlite(generate_data(20_000, seed=7), path)
+    sql_source = SQLiteSource(path)
+    df, _ = sql_source.read_rows()
+    return PandasSource(prepare_data(df)), sql_source
+
+
+def assert_sweeps_equal(left, right):
+    assert left.keys() == right.keys()
+    for key in left:
+        if isinstance(left[key], pd.Index):
+            assert list(left[key]) == list(right[key]), key
+        else:
+            np.testing.assert_allclose(left[key], right[key], err_msg=key)
+
+
+@pytest.mark.parametrize("filters", SELECTIONS)
+def test_sources_agree(sources, filters):
+    pandas_source, sql_source = sources
+    np.testing.assert_array_equal(pandas_source.select(*filters), sql_source.select(*filters))
+    np.testing.assert_allclose(pandas_source.calculate_summary_metrics(*filters),
+                               sql_source.calculate_summary_metrics(*filters))
+    assert_sweeps_equal(pandas_source.calculate_threshold_sweep(*filters), sql_source.calculate_threshold_sweep(*filters))
+    assert_sweeps_equal(pandas_source.calculate_monthly_sweep(*filters), sql_source.calculate_monthly_sweep(*filters))
+    pd.testing.assert_frame_equal(pandas_source.calculate_monthly_counts(*filters),
+                                  sql_source.calculate_monthly_counts(*filters), check_dtype=False)
+    pd.testing.assert_series_equal(pandas_source.calculate_shap_means(*filters), sql_source.calculate_shap_means(*filters))
+
+
+def test_selections_stop_at_the_rows_read(sources, tmp_path):
+    path = str(tmp_path / "log.sqlite")
+    write_sqlite(generate_data(1000, seed=1), path)
+    source = SQLiteSource(path)
+    df, position = source.read_rows()
+    write_sqlite(generate_data(500, seed=2), path)
+    filters = SELECTIONS[0]
+    assert len(source.select(*filters)) == len(df)
+    assert source.calculate_summary_metrics(*filters)[0] == len(df)
+
+    batch, _ = source.read_rows(after=position)
+    assert len(source.select(*filters)) == len(df) + len(batch) == 1500
+    assert len(source.select(*filters, rows=len(df))) == len(df)
+
+
+def test_rows_that_fail_to_append_are_read_again(tmp_path, monkeypatch):
+    path = str(tmp_path / "log.sqlite")
+    write_sqlite(generate_data(1000, seed=1), path)
+    source = SQLiteSource(path)
+    df, position = source.read_rows()
+    store = DataStore(prepare_data(df), source_position=position)
+    write_sqlite(generate_data(500, seed=2), path)
+
+    append = store.append
+    monkeypatch.setattr(store, "append", lambda *args, **kwargs: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        store.ingest_source(source)
+    monkeypatch.setattr(store, "append", append)
+    assert store.ingest_source(source) == 500
+    assert len(store.snapshot.df) == 1500
@@ -0,0 +1,49 @@
+# IMPORTS
+
+import pandas as pd
+import pytest
+
+from data_generator import generate_data
+from filter_index import build_filter_index, query_filter_index
+from helpers import filter_df, log_dtypes, prepare_data
+
+
+# FILTER INDEX
+#
+# Selections looked up in the filter index take the same rows, in the same
+# order, as masking the whole frame with every filter.
+
+SELECTIONS = [
+    ("All", "All", "All", "2022-07", "2023-04", "All", "All", "All"),
+    ("Male", "61-70", "All", "2022-09", "2023-01", "All", "NSEC", "All"),
+    ("All", "All", "v2", "2023-02", "2023-04", "Run 3", "All", "knee"),
+    ("Female", "71-80", "All", "2022-08", "2022-08", "All", "All", "hip"),
+    ("All", "All", "All", "2023-03", "2022-11", "All", "All", "All"),
+    ("All", "All", "All", "2022-07", "2023-04", "All", "No such site", "All"),
+]
+
+
+def mask_filter_df(df, sex, age, model, start_month, end_month, run_id, site, op_type):
+    # The filter the index replaced: a mask per filter over the whole frame
+    start, end = pd.Timestamp(start_month), pd.Timestamp(end_month) + pd.offsets.MonthBegin(1)
+    mask = (df["date"] >= start) & (df["date"] < end)
+    for column, value in [("sex", sex), ("age_group", age), ("model_version", model), ("run_id", run_id),
+                          ("site", site), ("op_type", op_type)]:
+        if value != "All":
+            mask &= df[column] == value
+    return df[mask]
+
+
+@pytest.fixture(scope="module")
+def log():
+    df = generate_data(20_000, seed=11)
+    df = prepare_data(df.astype(log_dtypes(df.columns)))
+    return df, build_filter_index(df)
+
+
+@pytest.mark.parametrize("filters", SELECTIONS)
+def test_index_selects_the_rows_of_the_masks(log, filters):
+    df, index = log
+    expected = mask_filter_df(df, *filters)
+    pd.testing.assert_frame_equal(filter_df(df, *filters, index=index), expected)
+    assert list(query_filter_index(index, *filters)) == list(df.index.get_indexer(expected.index))
@@ -0,0 +1,219 @@
+# IMPORTS
+
+import mmap
+import os
+import runpy
+
+import numpy as np
+import pandas as pd
+
+from conftest import INGEST_TOKEN
+from data_generator import generate_data, write_data
+from data_store import DataStore, FAILED_SUFFIX
+from columnar import read_manifest
+from filter_index import build_filter_index, query_filter_index, filter_index_length
+from helpers import load_data, load_cube, load_filter_index, log_dtypes, prepare_data, appendable_cache
+from streaming import CUBE_FILE, read_cube, write_cube
+
+
+# INGESTION
+
+SELECTIONS = [
+    ("All", "All", "All", "2022-07", "2023-04", "All", "All", "All"),
+    ("Male", "61-70", "All", "2022-09", "2023-01", "All", "NSEC", "All"),
+    ("All", "All", "v2", "2023-02", "2023-04", "Run 3", "All", "knee"),
+]
+
+
+def generated_log(n_samples, seed=42):
+    # As load_data reads it
+    df = generate_data(n_samples, seed=seed)
+    return prepare_data(df.astype(log_dtypes(df.columns)))
+
+
+def is_mapped(values):
+    while values is not None:
+        if isinstance(values, (np.memmap, mmap.mmap)):
+            return True
+        values = getattr(values, "base", None)
+    return False
+
+
+def write_batch(path, n_samples, seed, **options):
+    generate_data(n_samples, seed=seed, **options).to_csv(path, index=False)
+    return str(path)
+
+
+def assert_mapped(df):
+    # Categorical columns are mapped through their codes
+    for column in df.columns:
+        values = df[column].array
+        assert is_mapped(values.codes if isinstance(values, pd.Categorical) else values.to_numpy()), column
+
+
+def assert_matches_rebuild(store):
+    # The appended segments answer every selection like an index of the
+    # whole log built at once
+    data = store.snapshot
+    index = build_filter_index(data.df)
+    for filters in SELECTIONS:
+        np.testing.assert_array_equal(query_filter_index(data.filter_index, *filters), query_filter_index(index, *filters))
+    for column in ["sex", "age_group", "site", "op_type", "model_version", "run_id"]:
+        assert isinstance(data.df[column].dtype, pd.CategoricalDtype), column
+    assert int(data.cube["cells"]["count"].sum()) == len(data.df)
+
+
+def test_batches_are_indexed_on_their_own(tmp_path):
+    store = DataStore(generated_log(5000))
+    for seed in range(1, 8):
+        store.append([generated_log(500, seed=seed)])
+    assert len(store.snapshot.df) == 5000 + 7 * 500
+    # Segments of similar size are merged
+    assert len(store.snapshot.filter_index["segments"]) <= 3
+    assert_matches_rebuild(store)
+
+
+def test_readers_keep_their_snapshot_while_batches_are_appended():
+    store = DataStore(generated_log(2000))
+
+    @store.read
+    def reader():
+        data = store.current()
+        store.append([generated_log(500, seed=1)])
+        # The reader's stages still see the rows its positions index
+        assert store.current() is data and len(store.snapshot.df) == 2500
+        return len(query_filter_index(store.current().filter_index, *SELECTIONS[0])), len(store.current().df)
+
+    assert reader() == (2000, 2000)
+    assert store.current() is store.snapshot
+    assert_matches_rebuild(store)
+
+
+def test_unreadable_files_are_moved_aside(tmp_path):
+    store = DataStore(generated_log(2000))
+    bad = generate_data(10, seed=1).astype({"age": object})
+    bad.loc[3, "age"] = "x"
+    bad.to_csv(tmp_path / "a.csv", index=False)
+    write_batch(tmp_path / "b.csv", 300, seed=2)
+
+    assert store.ingest_directory(str(tmp_path)) == 300
+    assert sorted(os.listdir(tmp_path)) == ["a.csv" + FAILED_SUFFIX, "b.csv"]
+    assert store.ingest_directory(str(tmp_path)) == 0
+    assert_matches_rebuild(store)
+
+
+def test_batches_are_appended_to_the_cache(tmp_path):
+    csv_file_path = str(tmp_path / "log.csv")
+    write_data(csv_file_path, 5000)
+    incoming = tmp_path / "incoming"
+    incoming.mkdir()
+
+    def open_store():
+        df = load_data(csv_file_path)
+        return DataStore(df, cache_dir=appendable_cache(csv_file_path))
+
+    # Two workers on the same cache: the batch is written once, and both map it
+    first, second = open_store(), open_store()
+    for seed in range(1, 4):
+        write_batch(incoming / f"batch-{seed}.csv", 400, seed)
+    assert first.ingest_directory(str(incoming)) == 1200
+    assert second.ingest_directory(str(incoming)) == 1200
+    for store in [first, second]:
+        assert len(store.snapshot.df) == 6200
+        assert_mapped(store.snapshot.df)
+        assert_matches_rebuild(store)
+
+    # A restart maps the appended rows and does not ingest the batches again
+    restarted = open_store()
+    assert len(restarted.snapshot.df) == 6200
+    assert restarted.ingest_directory(str(incoming)) == 0
+    assert_matches_rebuild(restarted)
+
+
+def test_codes_are_widened_for_new_categories(tmp_path):
+    csv_file_path = str(tmp_path / "log.csv")
+    write_data(csv_file_path, 2000)
+    store = DataStore(load_data(csv_file_path), cache_dir=appendable_cache(csv_file_path))
+    incoming = tmp_path / "incoming"
+    incoming.mkdir()
+    write_batch(incoming / "batch.csv", 1000, seed=1, n_sites=300)
+
+    def site_entry():
+        return next(entry for entry in read_manifest(store.cache_dir)["columns"] if entry["name"] == "site")
+
+    before = site_entry()
+    assert before["dtype"] == "int8"
+    assert store.ingest_directory(str(incoming)) == 1000
+    assert site_entry()["dtype"] == "int16"
+    assert not os.path.exists(os.path.join(store.cache_dir, before["file"]))
+    assert_mapped(store.snapshot.df)
+    assert_matches_rebuild(store)
+
+
+def test_stale_cubes_are_rebuilt(tmp_path):
+    csv_file_path = str(tmp_path / "log.csv")
+    write_data(csv_file_path, 2000)
+    df = load_data(csv_file_path)
+    cache_dir = appendable_cache(csv_file_path)
+    cube_file = os.path.join(cache_dir, CUBE_FILE)
+    cube = read_cube(cache_dir)
+    assert int(cube["cells"]["count"].sum()) == 2000
+
+    # Truncated, and not pickled at all
+    for content in [open(cube_file, "rb").read()[:100], b"not a pickle"]:
+        with open(cube_file, "wb") as f:
+            f.write(content)
+        assert read_cube(cache_dir) is None
+        assert int(load_cube(csv_file_path, df)["cells"]["count"].sum()) == 2000
+        assert read_cube(cache_dir) is not None
+
+    # An append that died after publishing its manifest left the old cube
+    store = DataStore(df, cube=cube, cache_dir=cache_dir)
+    incoming = tmp_path / "incoming"
+    incoming.mkdir()
+    write_batch(incoming / "batch.csv", 500, seed=1)
+    assert store.ingest_directory(str(incoming)) == 500
+    write_cube(cache_dir, cube)
+    assert read_cube(cache_dir) is None
+    df = load_data(csv_file_path)
+    assert int(load_cube(csv_file_path, df)["cells"]["count"].sum()) == 2500
+    assert_matches_rebuild(DataStore(df, cube=read_cube(cache_dir), cache_dir=cache_dir))
+
+
+def test_master_appends_waiting_batches_before_forking(tmp_path, monkeypatch):
+    csv_file_path = str(tmp_path / "log.csv")
+    write_data(csv_file_path, 5000)
+    incoming = tmp_path / "incoming"
+    incoming.mkdir()
+    for seed in range(1, 3):
+        write_batch(incoming / f"batch-{seed}.csv", 400, seed)
+    monkeypatch.setenv("DATA_FILE", csv_file_path)
+    monkeypatch.setenv("INGEST_DIR", str(incoming))
+    settings = runpy.run_path(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gunicorn.conf.py"))
+    settings["on_starting"](None)
+
+    # Workers map the batches with the rest and get an index covering them
+    df = load_data(csv_file_path)
+    store = DataStore(df, cube=load_cube(csv_file_path, df), filter_index=load_filter_index(csv_file_path, df),
+                      cache_dir=appendable_cache(csv_file_path))
+    assert len(store.snapshot.df) == 5800 and filter_index_length(store.snapshot.filter_index) == 5800
+    assert "segments" not in store.snapshot.filter_index
+    assert store.ingest_directory(str(incoming)) == 0
+    assert_mapped(store.snapshot.df)
+    assert_matches_rebuild(store)
+
+
+def test_api_rejects_a_batch_that_does_not_parse(dashboard):
+    client = dashboard.server.test_client()
+    headers = {"Authorization": f"Bearer {INGEST_TOKEN}"}
+    batch = generate_data(20, seed=5).astype({"age": object})
+    batch.loc[0, "age"] = "x"
+    before = sorted(os.listdir(dashboard.INGEST_DIR))
+    response = client.post("/api/ingest", data=batch.to_csv(index=False), headers=headers)
+    assert response.status_code == 400
+    assert sorted(os.listdir(dashboard.INGEST_DIR)) == before
+
+    records = len(dashboard.store.snapshot.df)
+    response = client.post("/api/ingest", data=generate_data(20, seed=6).to_csv(index=False), headers=headers)
+    assert response.status_code == 200 and response.get_json()["rows"] == 20
+    assert len(dashboard.store.snapshot.df) == records + 20
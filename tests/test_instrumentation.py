@@ -0,0 +1,19 @@
+# IMPORTS
+
+from instrumentation import REGISTRY
+
+
+# METRICS
+
+def request_paths():
+    return {dict(labels)["path"] for name, labels in REGISTRY.histograms if name == "modelmonitor_request_seconds"}
+
+
+def test_requests_are_labelled_by_route(dashboard):
+    client = dashboard.server.test_client()
+    for i in range(3):
+        client.get(f"/probe-{i}/x")  # Dash pages route
+        client.post(f"/_dash-probe-{i}")  # No route takes a POST
+    paths = request_paths()
+    assert not any("probe" in path for path in paths)
+    assert {"/<path:path>", "unmatched"} <= paths
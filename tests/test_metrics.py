@@ -0,0 +1,63 @@
+# IMPORTS
+
+import numpy as np
+import pytest
+from sklearn.metrics import confusion_matrix, roc_auc_score
+
+from metrics import auroc, build_grouped_sweep, build_threshold_sweep, confusion_counts, grouped_confusion_counts
+
+
+# THRESHOLD SWEEP
+#
+# Confusion counts read off the sweep match sklearn's confusion matrix at
+# any cutoff, including cutoffs equal to a score, and its AUROC matches
+# sklearn's.
+
+@pytest.fixture(scope="module")
+def scores():
+    rng = np.random.default_rng(5)
+    y_true = rng.integers(0, 2, 5000)
+    # Rounded, so many records share a score
+    return y_true, np.round(rng.beta(2, 8, 5000) + 0.1 * y_true, 3)
+
+
+@pytest.mark.parametrize("inclusive", [True, False])
+def test_confusion_counts_match_sklearn(scores, inclusive):
+    y_true, scores = scores
+    thresholds = np.concatenate([[0, 0.075, 0.5, 2], scores[:50]])
+    tn, fp, fn, tp = confusion_counts(build_threshold_sweep(y_true, scores), thresholds, inclusive)
+    for i, threshold in enumerate(thresholds):
+        y_pred = scores >= threshold if inclusive else scores > threshold
+        assert [tn[i], fp[i], fn[i], tp[i]] == list(confusion_matrix(y_true, y_pred, labels=[0, 1]).ravel()), threshold
+
+
+def test_auroc_matches_sklearn(scores):
+    y_true, scores = scores
+    assert auroc(build_threshold_sweep(y_true, scores)) == pytest.approx(roc_auc_score(y_true, scores), abs=1e-12)
+    assert auroc(build_threshold_sweep(np.zeros(10, dtype=int), scores[:10])) is None
+
+
+# GROUPED THRESHOLD SWEEP
+#
+# The sweep of many groups from one sort gives every group the AUROC and
+# confusion counts of its own rows.
+
+@pytest.mark.parametrize("inclusive", [True, False])
+def test_grouped_sweep_matches_each_group(scores, inclusive):
+    y_true, scores = scores
+    # Group -1 is a missing key and left out; group 11 has no positives
+    groups = np.random.default_rng(6).integers(-1, 12, len(scores))
+    y_true = np.where(groups == 11, 0, y_true)
+    sweep = build_grouped_sweep(groups, y_true, scores, 12)
+    counts = {threshold: grouped_confusion_counts(sweep, threshold, inclusive) for threshold in [0, 0.075, 0.2, scores[0]]}
+
+    for group in range(12):
+        rows = groups == group
+        if group == 11:
+            assert np.isnan(sweep["auroc"][group])
+        else:
+            assert sweep["auroc"][group] == pytest.approx(roc_auc_score(y_true[rows], scores[rows]), abs=1e-12)
+        for threshold, (tn, fp, fn, tp) in counts.items():
+            y_pred = scores[rows] >= threshold if inclusive else scores[rows] > threshold
+            expected = confusion_matrix(y_true[rows], y_pred, labels=[0, 1]).ravel()
+            assert [tn[group], fp[group], fn[group], tp[group]] == list(expected), (group, threshold)
@@ -0,0 +1,81 @@
+# IMPORTS
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from columnar import read_columns, read_manifest
+from data_generator import generate_data, write_data
+from helpers import prepare_data
+from streaming import stream_ingest
+
+
+# STREAMING INGEST
+
+# Run in a fresh interpreter: once the modules are imported, the address
+# space may only grow by the cap, and the CSV is several times larger
+MEMORY_CAPPED_INGEST = """
+import resource, sys
+import pandas as pd
+from helpers import csv_dtypes, prepare_data
+from streaming import stream_ingest
+
+def address_space():
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmSize:"))
+
+csv_file_path, directory, cap = sys.argv[1], sys.argv[2], int(sys.argv[3])
+dtype = csv_dtypes(csv_file_path)
+limit = address_space() + cap
+resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+if sys.argv[4] == "stream":
+    stream_ingest(csv_file_path, directory, dtype=dtype, prepare=prepare_data, chunksize=10_000)
+else:
+    prepare_data(pd.read_csv(csv_file_path, dtype=dtype, parse_dates=["date"]))
+"""
+
+
+def test_codes_hold_more_categories_than_int16(tmp_path):
+    csv_file_path = str(tmp_path / "data.csv")
+    df = generate_data(100_000, n_sites=40_000)
+    df.to_csv(csv_file_path, index=False)
+    directory = str(tmp_path / "columns")
+    # Without dtypes, pandas reads the text columns as object or string
+    # columns depending on its version; both are stored as categories
+    stream_ingest(csv_file_path, directory, prepare=prepare_data, chunksize=25_000)
+
+    entry = next(entry for entry in read_manifest(directory)["columns"] if entry["name"] == "site")
+    assert len(entry["categories"]) > np.iinfo(np.int16).max and entry["dtype"] == "int32"
+    site = read_columns(directory)["site"]
+    assert isinstance(site.dtype, pd.CategoricalDtype)
+    assert (site.astype(str).to_numpy() == df["site"].astype(str).to_numpy()).all()
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="reads the address space from /proc")
+def test_ingest_memory_is_bounded_by_the_chunk_size(tmp_path):
+    cap = 40 * 2 ** 20
+    csv_file_path = str(tmp_path / "data.csv")
+    # A log with few cells, so the cube is small next to the cap
+    write_data(csv_file_path, 50_000, n_sites=1, n_models=1, n_runs=1)
+    with open(csv_file_path) as f:
+        header, rows = f.readline(), f.read()
+    with open(csv_file_path, "w") as f:
+        f.write(header)
+        for _ in range(24):
+            f.write(rows)
+    assert os.path.getsize(csv_file_path) > 4 * cap
+
+    def run(mode):
+        return subprocess.run([sys.executable, "-c", MEMORY_CAPPED_INGEST, csv_file_path, str(tmp_path / mode),
+                               str(cap), mode], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              capture_output=True, text=True)
+
+    streamed = run("stream")
+    assert streamed.returncode == 0, streamed.stderr
+    assert read_manifest(str(tmp_path / "stream"))["length"] == 24 * 50_000
+    # The cap binds: reading the file at once does not fit
+    assert run("read").returncode != 0
@@ -0,0 +1,73 @@
+# IMPORTS
+
+import json
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+from plotly.io.json import to_json_plotly
+
+from helpers import (
+    calculate_confusion_matrix,
+    calculate_grouped_sensitivity_specificity,
+    create_confusion_matrix,
+    create_timeline_figure
+)
+
+
+# CLIENTSIDE REDRAW
+#
+# assets/thresholds.js redraws the confusion matrix and the timeline from the
+# threshold summary while a cutoff slider moves; run under node, it must draw
+# what the server would for the same cutoff.
+
+FILTERS = ("Female", "All", "All", "September 2022", "April 2023", "All", "All", "All")
+CUTOFFS = [0.0, 0.025, 0.075, 0.2, 0.5, 1.0]
+METRICS = ["auroc", "sensitivity", "specificity"]
+ASSET = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "assets", "thresholds.js")
+
+# Loads the asset with a stand-in window and redraws both figures at every cutoff
+REDRAW = """
+const fs = require("fs"), vm = require("vm");
+const input = JSON.parse(fs.readFileSync(0, "utf8"));
+const context = {window: {}};
+vm.runInNewContext(fs.readFileSync(input.asset, "utf8"), context);
+const thresholds = context.window.dash_clientside.thresholds;
+console.log(JSON.stringify(input.cutoffs.map(cutoff => ({
+    confusion: thresholds.confusion_matrix(input.summary, cutoff, input.figures["confusion-matrix"]),
+    timeline: thresholds.timeline(input.summary, cutoff, input.metrics, input.figures["timeline"]),
+}))));
+"""
+
+
+def values(array):
+    return np.array([np.nan if value is None else value for value in array], dtype=float)
+
+
+@pytest.mark.skipif(shutil.which("node") is None, reason="needs node")
+def test_clientside_redraw_matches_the_server(dashboard):
+    filters = dashboard.normalize_filters(*FILTERS)
+    summary = dashboard.get_threshold_summary("month", 0, *filters)
+    payload = {"asset": ASSET, "summary": summary, "figures": dashboard.static_figures, "cutoffs": CUTOFFS,
+               "metrics": METRICS}
+    redrawn = json.loads(subprocess.run(["node", "-e", REDRAW], input=to_json_plotly(payload), capture_output=True,
+                                        text=True, check=True).stdout)
+
+    sweep, monthly_sweep = dashboard.get_threshold_sweep(*filters), dashboard.get_monthly_sweep(*filters)
+    for cutoff, figures in zip(CUTOFFS, redrawn):
+        expected = json.loads(to_json_plotly(create_confusion_matrix(calculate_confusion_matrix(sweep, cutoff), cutoff)))
+        assert figures["confusion"]["data"][0]["z"] == expected["data"][0]["z"]
+        assert figures["confusion"]["layout"]["annotations"] == expected["layout"]["annotations"]
+        assert figures["confusion"]["layout"]["title"]["text"] == expected["layout"]["title"]["text"]
+
+        expected = json.loads(to_json_plotly(create_timeline_figure(
+            dashboard.get_monthly_auroc(*filters), calculate_grouped_sensitivity_specificity(monthly_sweep, cutoff),
+            METRICS)))
+        # Confidence bands are drawn as extra unnamed traces
+        traces = [trace for trace in figures["timeline"]["data"] if "name" in trace]
+        assert [trace["name"] for trace in traces] == [trace["name"] for trace in expected["data"]]
+        for trace, expected_trace in zip(traces, expected["data"]):
+            assert trace["x"] == list(expected_trace["x"])
+            np.testing.assert_allclose(values(trace["y"]), values(expected_trace["y"]), err_msg=trace["name"])
@@ -0,0 +1,54 @@
+# IMPORTS
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cube import confusion_counts_from_hist, score_to_bin, threshold_to_bin
+from data_generator import generate_data
+from helpers import log_dtypes, prepare_data
+from timeseries import GRANULARITIES, daily_score_hist, period_hist, prefix_sums, timeframe_days
+
+
+# TIME SERIES
+#
+# Period and rolling window counts from the prefix sums of daily histograms
+# equal those of a groupby per period, or of a mask per window, of the rows.
+
+START_MONTH, END_MONTH, CUTOFF = "2022-07", "2023-04", 0.075
+
+
+@pytest.fixture(scope="module")
+def rows():
+    df = generate_data(30_000, seed=17)
+    df = prepare_data(df.astype(log_dtypes(df.columns)))
+    return df.assign(high=score_to_bin(df["pred_prob"].to_numpy(), 200) >= threshold_to_bin(CUTOFF, 200))
+
+
+def row_counts(rows):
+    return [len(rows), int(rows["outcome"].sum()), int((rows["high"] & (rows["outcome"] == 1)).sum()),
+            int((rows["high"] & (rows["outcome"] == 0)).sum())]
+
+
+@pytest.mark.parametrize("granularity, window", [("day", 0), ("week", 0), ("month", 0), ("week", 30), ("month", 90)])
+def test_prefix_sums_match_the_rows(rows, granularity, window):
+    days = timeframe_days(START_MONTH, END_MONTH)
+    prefix = prefix_sums(daily_score_hist(rows["date"].to_numpy(), rows["outcome"].to_numpy(), rows["pred_prob"].to_numpy(),
+                                          days))
+    labels, hist = period_hist(prefix, days, granularity, window)
+    _, fp, _, tp = confusion_counts_from_hist(hist, [CUTOFF])
+    counts = np.column_stack([hist.sum(axis=(1, 2)), hist[:, 1].sum(axis=1), tp[:, 0], fp[:, 0]])
+
+    # Rows outside the timeframe are left out of every period
+    row_days = rows["date"].dt.normalize()
+    in_timeframe = (row_days >= days[0]) & (row_days <= days[-1])
+    if window:
+        expected = [row_counts(rows[(row_days > end - pd.Timedelta(days=window)) & (row_days <= end) & in_timeframe])
+                    for end in labels]
+    else:
+        periods = rows["date"].dt.to_period(GRANULARITIES[granularity])
+        expected = [row_counts(rows[(periods == period) & in_timeframe])
+                    for period in labels.to_period(GRANULARITIES[granularity])]
+    assert counts.tolist() == expected
+    if not window:
+        assert counts[:, 0].sum() == in_timeframe.sum()
@@ -0,0 +1,58 @@
+# IMPORTS
+
+import numpy as np
+import pandas as pd
+
+from cube import SCORE_BINS, score_to_bin
+
+
+# TIME SERIES
+#
+# Timeline metrics at any granularity and over rolling windows from a single
+# pass over the selected rows: the per-class score histogram of every day of
+# the timeframe, summed cumulatively along the days. The histogram of any run
+# of days is the difference of two of these prefix sums, so days, weeks,
+# months and rolling windows of any length cost a few array subtractions,
+# and the record counts, complication rates, AUROC and confusion counts at
+# every cutoff follow from the histograms as for the cube.
+
+GRANULARITIES = {"day": "D", "week": "W-SUN", "month": "M"}
+
+
+def timeframe_days(start_month, end_month):
+    # Every day from the first of the start month to the last of the end month
+    return pd.date_range(pd.Period(start_month, freq="M").start_time,
+                         pd.Period(end_month, freq="M").end_time.normalize(), freq="D")
+
+
+def daily_score_hist(dates, outcome, scores, days, n_bins=SCORE_BINS):
+    # (day, outcome, bin) histograms over the days; rows on other days are
+    # left out
+    day = (np.asarray(dates, dtype="datetime64[D]") - np.datetime64(days[0].date(), "D")).astype(np.int64)
+    kept = (day >= 0) & (day < len(days))
+    flat = (day[kept] * 2 + outcome[kept]) * n_bins + score_to_bin(scores[kept], n_bins)
+    return np.bincount(flat, minlength=len(days) * 2 * n_bins).reshape(len(days), 2, n_bins)
+
+
+def prefix_sums(hist):
+    # prefix[i] is the sum of the first i days
+    return np.concatenate([np.zeros((1,) + hist.shape[1:], dtype=np.int64), np.cumsum(hist, axis=0, dtype=np.int64)])
+
+
+def period_starts(days, granularity):
+    # Position of the first day of every period; the first and last periods
+    # may be cut short by the timeframe
+    periods = days.to_period(GRANULARITIES[granularity])
+    return np.concatenate([[0], np.flatnonzero(periods[1:] != periods[:-1]) + 1])
+
+
+def period_hist(prefix, days, granularity, window=0):
+    # The histograms of every period, labelled with its first day, or with
+    # a window, of the window days up to the last day of every period,
+    # labelled with that day (windows at the start of the timeframe hold
+    # fewer days)
+    starts = period_starts(days, granularity)
+    ends = np.append(starts[1:], len(days))
+    if window:
+        return days[ends - 1], prefix[ends] - prefix[np.maximum(ends - window, 0)]
+    return days[starts], prefix[ends] - prefix[starts]
@@ -0,0 +1,145 @@
+# IMPORTS
+
+import collections
+import concurrent.futures
+import contextvars
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# BACKGROUND WORK
+#
+# Computations that should not hold up a request run on thread pools of
+# their own. The cache warmer runs the stages behind the dashboard's views
+# for the most common selections, at startup and after every data update,
+# so their results are in the result cache before anyone asks for them.
+# Background tasks run long computations requested by callbacks: the
+# callback waits briefly for the result, and if it is not ready returns a
+# progress note and polls for it.
+
+RECENT_REQUESTS = 1000
+
+
+def single_dimension_selections(default, options):
+    # The default selection, then every value of every filter with the
+    # other filters at their defaults; options maps the position of a filter
+    # in the selection to its values
+    selections = [default]
+    for position, values in options.items():
+        for value in values:
+            selections.append(default[:position] + (value,) + default[position + 1:])
+    return list(dict.fromkeys(selections))
+
+
+class CacheWarmer:
+    def __init__(self, warm, selections, recent=20):
+        # warm(selection) computes the results of one selection; selections()
+        # returns the selections to warm besides the most requested ones
+        self.warm = warm
+        self.selections = selections
+        self.recent = recent
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="cache-warmer")
+        self.lock = threading.Lock()
+        self.requests = collections.deque(maxlen=RECENT_REQUESTS)
+        self.generation = 0
+        self.future = None
+        self.warmed = set()
+        self.status = {"runs": 0, "running": False, "selections": 0, "warmed": 0, "errors": 0, "seconds": 0.0,
+                       "requests": 0, "requests_warmed": 0}
+
+    def record(self, selection):
+        # A requested selection: counts towards the most requested ones, and
+        # towards the share of requests the warm-up covered
+        with self.lock:
+            self.requests.append(selection)
+            self.status["requests"] += 1
+            self.status["requests_warmed"] += selection in self.warmed
+
+    def most_requested(self):
+        with self.lock:
+            counts = collections.Counter(self.requests)
+        return [selection for selection, _ in counts.most_common(self.recent)]
+
+    def start(self):
+        # A run started while another one is going (new data arrived)
+        # takes over from it
+        with self.lock:
+            self.generation += 1
+            self.future = self.executor.submit(self.run, self.generation)
+        return self.future
+
+    def run(self, generation):
+        start = time.perf_counter()
+        selections = self.selections()
+        selections = list(dict.fromkeys(selections[:1] + self.most_requested() + selections[1:]))
+        with self.lock:
+            self.warmed = set()
+            self.status.update(running=True, selections=len(selections), warmed=0, errors=0, seconds=0.0)
+
+        for selection in selections:
+            if generation != self.generation:
+                return
+            try:
+                self.warm(selection)
+            except Exception:
+                logger.exception("Could not warm the results of %s", selection)
+                with self.lock:
+                    self.status["errors"] += 1
+                continue
+            with self.lock:
+                self.warmed.add(selection)
+                self.status["warmed"] += 1
+                self.status["seconds"] = time.perf_counter() - start
+
+        with self.lock:
+            self.status.update(running=False, seconds=time.perf_counter() - start)
+            self.status["runs"] += 1
+        logger.info("Warmed %d of %d selections in %.1f s", self.status["warmed"], len(selections), self.status["seconds"])
+
+    def stats(self):
+        with self.lock:
+            return dict(self.status)
+
+
+class BackgroundTasks:
+    def __init__(self, workers=2, keep=300):
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="background-task")
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.tasks = {}
+
+    def run(self, key, function, *args, wait=0.5):
+        # (result, None) if the task finishes within wait seconds, (None,
+        # seconds it has been running) otherwise. Tasks are keyed so a poll
+        # finds the one it started, and kept until a poll collects them.
+        with self.lock:
+            if key not in self.tasks:
+                self.prune()
+                # In a copy of the caller's context, so the task works on the
+                # data snapshot of the callback that started it
+                future = self.executor.submit(contextvars.copy_context().run, function, *args)
+                self.tasks[key] = (time.perf_counter(), future)
+            started, future = self.tasks[key]
+        try:
+            result = future.result(timeout=wait)
+        except concurrent.futures.TimeoutError:
+            return None, time.perf_counter() - started
+        except Exception:
+            self.discard(key, future)
+            raise
+        self.discard(key, future)
+        return result, None
+
+    def discard(self, key, future):
+        with self.lock:
+            if key in self.tasks and self.tasks[key][1] is future:
+                del self.tasks[key]
+
+    def prune(self):
+        # Finished tasks nobody came back for, as the selection changed
+        now = time.perf_counter()
+        for key in [key for key, (started, future) in self.tasks.items() if future.done() and now - started > self.keep]:
+            del self.tasks[key]